@@ -12,11 +12,15 @@ verbose=True
 write_all=False
 # save intermediate windows not after every time window, but after this many single windows have been stacked:
 interm_nstack = 1
+# Write a quality table for every station pair (id1.id2.corrtype.corrname.qc.npz, see TOOLS/window_qc.py): start time, rms, energy, range of standard deviations, fraction of zero and of clipped samples of every window, and whether it went into the stack.
+window_qc = False
 # provide a name that will appear as 'stamp' on all correlations calculated in this run
 corrname='noisy'
 
 # Set to True if updating on a previous run?
 update = False
+# Extend the stacks of an earlier run of corrname with new data? For every pair, only the windows after the end of the time covered by its stack (kt1 and user9 in the SAC header) are correlated and added to the stack, the phase weighted stack and the window count. The new windows are added to the intermediate windows file (write_all) and the quality table (window_qc) of the earlier run. Set enddate to the end of the new data. Only with output_format='SAC'.
+append = False
 	
 #*******************************************************************************
 # Specifics for data distribution to cores
@@ -25,6 +29,41 @@ update = False
 idfile = 'INPUT/correlationlist.txt'
 # How many station pairs for each core? Typically the number of files opened by that core is about n+1
 npairs = 1
+# Find the available data from the file names before reading any data, and leave out station pairs without common correlation windows?
+check_availability = False
+# Correlate only station pairs within this range of distance (in km) and of azimuth of the interstation path (in degrees, from the station that comes first in idfile, counted 0-180 as pairs are correlated in both directions; min_azimuth > max_azimuth selects a range across 180). Station coordinates are taken from the stationxml files; pairs with stations without coordinates are always correlated.
+min_distance = 0.
+max_distance = 20100.
+min_azimuth = 0.
+max_azimuth = 180.
+# Plan the blocks of station pairs from the available data instead of using npairs? Blocks are then filled with pairs sharing stations, as long as their station data take up less than block_memory (in MB). Predicted memory and runtime are printed before correlating.
+plan_blocks = False
+block_memory = 2000.
+# Load the station data needed by the ranks on one node only once per node, into shared memory (needs MPI-3). All ranks then correlate from the same copy of the data.
+shared_memory = False
+# Read the station data window by window, instead of holding all data of a station in memory? Only the files covering the current correlation window are then read. Only for components='Z'; not together with shared_memory.
+lazy_read = False
+# Station data are kept in memory from one block of pairs to the next, until they take up more than cache_memory (in MB). Then the least recently used stations are dropped.
+cache_memory = 4000.
+# Number of threads reading, decoding and filtering the files of one channel at the same time
+read_threads = 1
+# Read miniSEED files through a record index (built once per file, kept in the subdirectory .mseedidx of the data directory)? Only the records within startdate and enddate, or within the current window for lazy_read, are then decoded.
+record_index = False
+# Read the station data for the next pairs in the background while correlating? The data read ahead may take up at most prefetch_memory (in MB) in addition to the data being correlated; at least one station is always read ahead.
+prefetch = False
+prefetch_memory = 2000.
+# Keep the spectra of the treated windows of every channel on disk (in datadir/spectra), and form the correlations from them? Later runs with the same data and processing parameters (any station pairs, max_lag...) then read the stored spectra instead of the data. Only for components='Z' and corrtype 'ccc'; the windows are then taken on a fixed grid, every winlen-olap seconds from 1970-01-01. Remove the store if the data of a time range that was already processed change.
+spectra_store = False
+# Output: 'SAC' writes one SAC file per correlation (and a .npy file with the phase weight stack). 'container' collects the correlations of every rank in npz shards and merges them at the end into one HDF5 file corrname.h5 (needs h5py), with a float32 matrix (pair, lag) that can be memory-mapped and the header values as columns; see TOOLS/corr_container.py
+output_format = 'SAC'
+# Substacks written in the same pass as the stack over the whole time: a list of calendar bins, 'day', 'month' and/or 'year'. Every window is added to the substack of the bin in which it starts. The substacks are written like the stack, with the bin in the name (e.g. ...ccc.noisy.day2014002.SAC) or in the timestring column of the container.
+substacks = []
+# Rolling stacks over this many days, stepped daily (0: none). They are formed from daily partial stacks with a running sum and written with the number of days and the last day in the name (e.g. ...ccc.noisy.roll10d2014010.SAC). In append mode, the daily substacks of the earlier run are included; 'day' must then be in substacks (in both runs).
+rolling_days = 0
+# Number of correlation windows that are treated and Fourier transformed together as one array. Larger batches are faster but take more memory (about 50 times the size of one window per window in the batch)
+fft_batch = 64
+# Number of threads for the Fourier transforms of a batch (with scipy 1.4 or later; otherwise ignored)
+fft_workers = 1
 # channel: LH, BH, VH...
 channel='LH'
 # component: choose between Z, RT, T, R. 'All channels' is not implemented yet
@@ -37,9 +76,12 @@ mix_cha=False
 #*******************************************************************************
 
 # Input directory containing data. Can only handle one input directory at the moment.
+# indir may also be an ASDF (HDF5) file: the data are then read from the container, only within startdate and enddate, and the station coordinates are taken from its StationXML; prepname is not used then.
 indir='/Volumes/cowpox/DATA/processed/noisy'
 # Enter preprocessing run name(s). Put * for any preprocessing
 prepname='noisy'
+# Waveform tag to use from an ASDF input file (None: all tags)
+asdf_tag=None
     #*******************************************************************************
 # Time
 #*******************************************************************************
@@ -106,10 +148,120 @@ if type(interm_nstack) != int and type(interm_nstack) != float:
     msg = 'Control input file: interm_nstack must be str or float'
     raise TypeError(msg)
     
+if type(window_qc) != bool:
+    msg = 'Control input file: window_qc must be boolean'
+    raise TypeError(msg)
+    
 if type(update) != bool:
     msg = 'Control input file: update must be boolean'
     raise TypeError(msg)
     
+if type(append) != bool:
+    msg = 'Control input file: append must be boolean'
+    raise TypeError(msg)
+    
+if type(check_availability) != bool:
+    msg = 'Control input file: check_availability must be boolean'
+    raise TypeError(msg)
+    
+if type(min_distance) not in (float,int):
+    msg = 'Control input file: min_distance must be float or integer'
+    raise TypeError(msg)
+    
+if type(max_distance) not in (float,int):
+    msg = 'Control input file: max_distance must be float or integer'
+    raise TypeError(msg)
+    
+if type(min_azimuth) not in (float,int):
+    msg = 'Control input file: min_azimuth must be float or integer'
+    raise TypeError(msg)
+    
+if type(max_azimuth) not in (float,int):
+    msg = 'Control input file: max_azimuth must be float or integer'
+    raise TypeError(msg)
+    
+if type(plan_blocks) != bool:
+    msg = 'Control input file: plan_blocks must be boolean'
+    raise TypeError(msg)
+
+if type(block_memory) not in (float,int):
+    msg = 'Control input file: block_memory must be float or integer'
+    raise TypeError(msg)
+    
+if type(shared_memory) != bool:
+    msg = 'Control input file: shared_memory must be boolean'
+    raise TypeError(msg)
+    
+if type(lazy_read) != bool:
+    msg = 'Control input file: lazy_read must be boolean'
+    raise TypeError(msg)
+
+if lazy_read and (components != 'Z' or shared_memory):
+    msg = 'Control input file: lazy_read only works with components Z and\
+ without shared_memory'
+    raise ValueError(msg)
+
+if type(cache_memory) not in (float,int):
+    msg = 'Control input file: cache_memory must be float or integer'
+    raise TypeError(msg)
+
+if type(read_threads) != int:
+    msg = 'Control input file: read_threads must be integer'
+    raise TypeError(msg)
+    
+if type(record_index) != bool:
+    msg = 'Control input file: record_index must be boolean'
+    raise TypeError(msg)
+
+if type(spectra_store) != bool:
+    msg = 'Control input file: spectra_store must be boolean'
+    raise TypeError(msg)
+
+if output_format not in ('SAC','container'):
+    msg = 'Control input file: output_format must be \'SAC\' or \'container\''
+    raise ValueError(msg)
+
+if type(substacks) != list:
+    msg = 'Control input file: substacks must be a list'
+    raise TypeError(msg)
+    
+for level in substacks:
+    if level not in ['day','month','year']:
+        msg = 'Control input file: substacks can be \'day\', \'month\' or \'year\''
+        raise ValueError(msg)
+
+if type(rolling_days) != int:
+    msg = 'Control input file: rolling_days must be int'
+    raise TypeError(msg)
+    
+if rolling_days < 0:
+    msg = 'Control input file: rolling_days must be 0 or larger'
+    raise ValueError(msg)
+
+if append and rolling_days > 0 and 'day' not in substacks:
+    msg = 'Control input file: rolling_days with append needs \'day\' in substacks'
+    raise ValueError(msg)
+
+if append and output_format != 'SAC':
+    msg = 'Control input file: append only works with output_format \'SAC\''
+    raise ValueError(msg)
+
+if type(prefetch) != bool:
+    msg = 'Control input file: prefetch must be boolean'
+    raise TypeError(msg)
+
+if type(prefetch_memory) not in (float,int):
+    msg = 'Control input file: prefetch_memory must be float or integer'
+    raise TypeError(msg)
+    
+if type(fft_batch) != int:
+    msg = 'Control input file: fft_batch must be integer'
+    raise TypeError(msg)
+    
+if type(fft_workers) != int:
+    msg = 'Control input file: fft_workers must be integer'
+    raise TypeError(msg)
+    
 if type(mix_cha) != bool:
     msg = 'Control input file: mix_cha must be boolean'
     raise TypeError(msg)
@@ -162,6 +314,10 @@ if type(indir) != str:
     msg = 'Control input file: indir must be str'
     raise TypeError(msg)
     
+if asdf_tag is not None and type(asdf_tag) != str:
+    msg = 'Control input file: asdf_tag must be str or None'
+    raise TypeError(msg)
+    
 if type(startdate) != str:
     msg = 'Control input file: startdate must be str'
     raise TypeError(msg)
@@ -0,0 +1,220 @@
+from __future__ import print_function
+import os
+import io
+import numpy as np
+
+from warnings import warn
+from obspy import read_inventory, Stream, Trace, UTCDateTime
+from obspy.core import Stats
+from ANTS.TOOLS.availability import merge_spans
+from ANTS.TOOLS.windowed_reader import LazySegment
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Waveform containers are read with h5py directly, following the ASDF layout:
+# /Waveforms/NET.STA/ holds the embedded StationXML (dataset 'StationXML') and
+# one dataset per continuous trace, named NET.STA.LOC.CHA__start__end__tag,
+# with the attributes starttime (ns since 1970-01-01) and sampling_rate.
+
+
+def is_container(path):
+    """
+    True if path is an HDF5 (e.g. ASDF) file rather than a directory.
+    """
+    if not os.path.isfile(path):
+        return False
+    if h5py is None:
+        msg = 'Input is a file, but h5py is not available to read it: '+path
+        raise ImportError(msg)
+    return h5py.is_hdf5(path)
+
+
+def waveforms(filename,ids=None,tag=None):
+    """
+    List the traces in a container, from the dataset names and attributes;
+    no data are read.
+
+    ids: channel ids to list (default: all)
+    tag: waveform tag to list (default: all tags)
+
+    output:
+    list of (channel id, dataset path, start epoch, sampling rate, npts),
+    sorted by id and start
+    """
+
+    entries = list()
+    f = h5py.File(filename,'r')
+    try:
+        if 'Waveforms' not in f:
+            return entries
+        for staname in f['Waveforms']:
+            group = f['Waveforms'][staname]
+            for name in group:
+                inf = name.split('__')
+                if len(inf) != 4:
+                    continue
+                if ids is not None and inf[0] not in ids:
+                    continue
+                if tag is not None and inf[3] != tag:
+                    continue
+                ds = group[name]
+                entries.append((inf[0],ds.name,\
+                ds.attrs['starttime'] * 1.e-9,\
+                float(ds.attrs['sampling_rate']),ds.shape[0]))
+    finally:
+        f.close()
+    entries.sort(key=lambda e: (e[0],e[2]))
+    return entries
+
+
+def build_index(filename,startdate,enddate,ids=None,tag=None):
+    """
+    Index of the available data of all channels in a container; the same as
+    availability.build_index for a directory of files.
+
+    output:
+    dictionary of channel id and (sampling rate, array of (start, end) epoch
+    times of continuous data, sorted)
+    """
+
+    t0 = UTCDateTime(startdate).timestamp
+    t1 = UTCDateTime(enddate).timestamp
+
+    spans = dict()
+    rates = dict()
+    for (id,path,start,fs,npts) in waveforms(filename,ids,tag):
+        end = start + (npts - 1) / fs
+        if start > t1 or end < t0:
+            continue
+        spans.setdefault(id,list()).append((max(start,t0),min(end,t1)))
+        rates[id] = fs
+
+    index = dict()
+    for id in spans:
+        index[id] = (rates[id],merge_spans(spans[id],rates[id]))
+    return index
+
+
+def read_range(filename,path,starttime,endtime):
+    """
+    Read the samples of one dataset between starttime and endtime. Only this
+    range is read from the file (hyperslab selection).
+
+    output:
+    obspy stream with one trace, empty if the dataset has no data in the range
+    """
+
+    f = h5py.File(filename,'r')
+    try:
+        ds = f[path]
+        fs = float(ds.attrs['sampling_rate'])
+        start = ds.attrs['starttime'] * 1.e-9
+        i0 = max(int(np.ceil((UTCDateTime(starttime).timestamp-start)*fs \
+        - 1.e-6)),0)
+        i1 = min(int(np.floor((UTCDateTime(endtime).timestamp-start)*fs \
+        + 1.e-6)) + 1,ds.shape[0])
+        if i1 <= i0:
+            return Stream()
+        data = ds[i0:i1]
+    finally:
+        f.close()
+
+    (net,sta,loc,cha) = path.split('/')[-1].split('__')[0].split('.')
+    tr = Trace(data=data,header=dict(network=net,station=sta,location=loc,\
+    channel=cha,sampling_rate=fs,starttime=UTCDateTime(start+i0/fs)))
+    return Stream(tr)
+
+
+def read_channel(filename,id,startdate,enddate,tag=None):
+    """
+    Read all data of one channel between startdate and enddate.
+
+    output:
+    obspy stream, traces in temporal order
+    """
+
+    st = Stream()
+    for (cid,path,start,fs,npts) in waveforms(filename,[id],tag):
+        st += read_range(filename,path,startdate,enddate)
+    return st
+
+
+def windowed_channel(filename,id,startdate,enddate,minlen,prep=None,\
+rate=None,tag=None):
+    """
+    Map the traces of one channel in a container to lazily read continuous
+    segments (see windowed_reader.windowed_channel). A trace is read, within
+    startdate and enddate, only when a window of its data is requested.
+
+    output:
+    list of LazySegment objects, in temporal order
+    """
+
+    spans = list()
+    for (cid,path,start,fs,npts) in waveforms(filename,[id],tag):
+        t1 = UTCDateTime(start)
+        t2 = UTCDateTime(start + (npts - 1) / fs)
+        if t1 > enddate or t2 < startdate or t2 - t1 < minlen:
+            continue
+        spans.append((path,t1,t2))
+
+    if len(spans) == 0:
+        return list()
+    if rate is not None:
+        fs = rate(fs)
+    reader = lambda path: read_range(filename,path,startdate,enddate)
+
+    #- Group adjacent traces into segments
+    groups = [[spans[0]]]
+    for span in spans[1:]:
+        if span[1] - groups[-1][-1][2] <= 1.5/fs:
+            groups[-1].append(span)
+        else:
+            groups.append([span])
+
+    (net,sta,loc,cha) = id.split('.')
+    segments = list()
+    for group in groups:
+        stats = Stats(dict(network=net,station=sta,location=loc,channel=cha,\
+        sampling_rate=fs,starttime=group[0][1]))
+        stats.npts = int(round((group[-1][2]-group[0][1])*fs)) + 1
+        segments.append(LazySegment(group,stats,prep,reader))
+
+    return segments
+
+
+def coordinates(filename):
+    """
+    Station coordinates from the StationXML embedded in a container.
+
+    output:
+    dictionary of net.sta and (lat, lon, elevation), as coordinates.load_table
+    """
+
+    coords = dict()
+    f = h5py.File(filename,'r')
+    try:
+        if 'Waveforms' not in f:
+            return coords
+        for staname in f['Waveforms']:
+            group = f['Waveforms'][staname]
+            if 'StationXML' not in group:
+                continue
+            try:
+                inv = read_inventory(io.BytesIO(group['StationXML'][()]\
+                .tobytes()),format='STATIONXML')
+            except Exception:
+                msg = 'Faulty StationXML in container, no coordinates: '+\
+                staname
+                warn(msg)
+                continue
+            for net in inv:
+                for sta in net:
+                    coords[net.code+'.'+sta.code] = (sta.latitude,\
+                    sta.longitude,sta.elevation)
+    finally:
+        f.close()
+    return coords
@@ -0,0 +1,186 @@
+from __future__ import print_function
+import os
+import numpy as np
+
+from fnmatch import fnmatch
+
+from obspy import read, UTCDateTime
+
+#- File names hold times to the second; the data of a file may end up to this
+#- many seconds after the end time in its name
+NAME_TOL = 1.
+
+
+def file_span(filename):
+    """
+    Start and end time of a processed file, taken from its name.
+
+    The name is expected in the format written by ant_proc:
+    net.sta.loc.cha.yyyy.jjj.hh.mm.ss.yyyy.jjj.hh.mm.ss.prepname.format
+    """
+
+    inf = filename.split('/')[-1].split('.')
+    t = [int(i) for i in inf[4:14]]
+    t1 = UTCDateTime(year=t[0],julday=t[1],hour=t[2],minute=t[3],second=t[4])
+    t2 = UTCDateTime(year=t[5],julday=t[6],hour=t[7],minute=t[8],second=t[9])
+    return (t1,t2)
+
+
+def merge_spans(spans,fs,tol=0.):
+    """
+    Sort (start, end) epoch times and merge spans that are adjacent within
+    one sample, plus tol seconds (for times taken from file names). Returns 
+    an array of shape (n, 2).
+    """
+
+    if len(spans) == 0:
+        return np.zeros((0,2))
+    spans = np.array(sorted(spans),dtype=np.float64)
+
+    # A new span begins where the start lies more than one sample (and tol)
+    # after the end of all previous spans
+    ends = np.maximum.accumulate(spans[:,1])
+    new = np.concatenate(([True],spans[1:,0] - ends[:-1] > tol + 1.5/fs))
+    first = np.flatnonzero(new)
+    last = np.concatenate((first[1:],[len(spans)])) - 1
+    return np.column_stack((spans[first,0],ends[last]))
+
+
+def build_index(indir,prepname,startdate,enddate,ids=None):
+    """
+    Index of the available data of all channels in indir, from the file
+    names. The directory is listed once; only the headers of the first file
+    of every channel and of the last file of every span of continuous data
+    are read, to get the sampling rate and the end of the span (file names
+    only give times to the second).
+
+    input:
+    indir, prepname: directory and processing name of the data files
+    startdate, enddate: only data within this time range are considered
+    ids: channel ids to index (default: all channels found)
+
+    output:
+    dictionary of channel id and (sampling rate, array of (start, end) epoch
+    times of continuous data, sorted)
+    """
+
+    t0 = UTCDateTime(startdate).timestamp
+    t1 = UTCDateTime(enddate).timestamp
+
+    files = dict()
+    for filename in sorted(os.listdir(indir)):
+        inf = filename.split('.')
+        if len(inf) < 16 or not fnmatch(inf[14],prepname):
+            continue
+        id = '.'.join(inf[0:4])
+        if ids is not None and id not in ids:
+            continue
+        try:
+            (sf,ef) = file_span(filename)
+        except (ValueError, IndexError):
+            continue
+        if sf.timestamp > t1 or ef.timestamp < t0:
+            continue
+        files.setdefault(id,list()).append((filename,max(sf.timestamp,t0),\
+        min(ef.timestamp,t1)))
+
+    index = dict()
+    for id in files:
+        try:
+            fs = read(os.path.join(indir,files[id][0][0]),\
+            headonly=True)[0].stats.sampling_rate
+        except Exception:
+            continue
+        spans = merge_spans([f[1:] for f in files[id]],fs,NAME_TOL)
+
+        #- The end of a span is taken from the header of its last file
+        last = dict([(f[2],f[0]) for f in files[id]])
+        for span in spans:
+            if span[1] >= t1:
+                continue
+            try:
+                st = read(os.path.join(indir,last[span[1]]),headonly=True)
+                span[1] = min(max([tr.stats.endtime.timestamp for tr in st]),\
+                t1)
+            except Exception:
+                pass
+        index[id] = (fs,spans)
+
+    return index
+
+
+def channel_spans(index,id):
+    """
+    Sampling rate and available spans of a channel (0 and no spans if the
+    channel has no data).
+    """
+    return index.get(id,(0.,np.zeros((0,2))))
+
+
+def station_spans(index,ids):
+    """
+    Sampling rate and spans of the time in which all channels of a station
+    that are in the index have data (e.g. both horizontal channels for
+    rotated components). Channels without data, such as 1 and 2 at a station
+    with E and N, are left out. Returns the lowest sampling rate of the
+    channels.
+    """
+    (fs,spans) = (0.,None)
+    for id in ids:
+        (cfs,cspans) = channel_spans(index,id)
+        if len(cspans) == 0:
+            continue
+        if spans is None:
+            (fs,spans) = (cfs,cspans)
+            continue
+        fs = min(fs,cfs)
+        t1 = np.maximum.outer(spans[:,0],cspans[:,0]).ravel()
+        t2 = np.minimum.outer(spans[:,1],cspans[:,1]).ravel()
+        keep = t2 >= t1
+        spans = np.column_stack((t1[keep],t2[keep]))
+        spans = spans[np.argsort(spans[:,0])]
+    if spans is None:
+        return (0.,np.zeros((0,2)))
+    return (fs,spans)
+
+
+def count_windows(spans1,spans2,winlen,olap,fs=None):
+    """
+    Number of correlation windows in the common time of two channels.
+
+    The overlaps of all spans of the first with all spans of the second
+    channel are found at once; every overlap holds the windows that fit into
+    it, shifted by winlen-olap. Spans end at their last sample; with the
+    sampling rate fs, the duration of that sample is counted as well.
+    """
+
+    if len(spans1) == 0 or len(spans2) == 0:
+        return 0
+    step = winlen - olap
+    l = np.minimum.outer(spans1[:,1],spans2[:,1]) - \
+    np.maximum.outer(spans1[:,0],spans2[:,0])
+    if fs:
+        l = l + 1./fs
+    l = l[l >= winlen]
+    return int(np.sum((l - winlen) // step + 1))
+
+
+def pair_windows(index,pairs,chids,winlen,olap):
+    """
+    Number of common correlation windows of station pairs.
+
+    index: availability index, see build_index
+    pairs: list of tuples of station ids
+    chids: function returning the channel ids of a station id; windows are
+    counted in the time in which all of them have data (see station_spans)
+
+    output:
+    array with the number of windows of every pair
+    """
+
+    nwin = np.zeros(len(pairs),dtype=np.int64)
+    for (i,p) in enumerate(pairs):
+        (fs1,spans1) = station_spans(index,chids(p[0]))
+        (fs2,spans2) = station_spans(index,chids(p[1]))
+        nwin[i] = count_windows(spans1,spans2,winlen,olap,min(fs1,fs2))
+    return nwin
@@ -0,0 +1,92 @@
+from __future__ import print_function
+import os
+import numpy as np
+
+from glob import glob
+from warnings import warn
+from obspy import read_inventory
+
+
+def build_table(xmldir,tablefile,verbose=False):
+    """
+    Collect the station coordinates of all stationxml files in xmldir into a
+    table (CSV: net.sta,lat,lon,elevation).
+
+    Every stationxml file is parsed once here, instead of whenever the
+    coordinates of a station are needed.
+    """
+
+    rows = list()
+    for filename in sorted(glob(os.path.join(xmldir,'*.xml'))):
+        try:
+            inv = read_inventory(filename)
+        except Exception:
+            msg = 'Faulty stationxml file, no coordinates: '+filename
+            warn(msg)
+            continue
+        for net in inv:
+            for sta in net:
+                rows.append((net.code+'.'+sta.code,sta.latitude,\
+                sta.longitude,sta.elevation))
+
+    fid = open(tablefile,'w')
+    fid.write('# net.sta,lat,lon,elevation\n')
+    for row in rows:
+        fid.write('%s,%.6f,%.6f,%.1f\n' %row)
+    fid.close()
+
+    if verbose:
+        print('Wrote coordinates of %g stations to %s' %(len(rows),tablefile),\
+        file=None)
+
+
+def load_table(tablefile):
+    """
+    Read a coordinate table.
+
+    output:
+    dictionary of net.sta and (lat, lon, elevation)
+    """
+
+    coords = dict()
+    fid = open(tablefile,'r')
+    for line in fid:
+        if line.startswith('#') or line.strip() == '':
+            continue
+        inf = line.strip().split(',')
+        coords[inf[0]] = (float(inf[1]),float(inf[2]),float(inf[3]))
+    fid.close()
+    return coords
+
+
+def get_table(xmldir,tablefile=None,verbose=False):
+    """
+    Station coordinates from the table in xmldir, which is (re)built if it is
+    missing or older than one of the stationxml files.
+
+    output:
+    dictionary of net.sta and (lat, lon, elevation)
+    """
+
+    if tablefile is None:
+        tablefile = os.path.join(xmldir,'coordinates.csv')
+    if not os.path.isdir(xmldir):
+        msg = 'No stationxml directory, no station coordinates: '+xmldir
+        warn(msg)
+        return dict()
+
+    xmlfiles = glob(os.path.join(xmldir,'*.xml'))
+    if not os.path.exists(tablefile) or \
+    max([os.path.getmtime(f) for f in xmlfiles]+[0.]) > \
+    os.path.getmtime(tablefile):
+        build_table(xmldir,tablefile,verbose)
+
+    return load_table(tablefile)
+
+
+def lookup(coords,id):
+    """
+    (lat, lon) of a station or channel id (net.sta...), (nan, nan) if the
+    station is not in the table.
+    """
+    return coords.get('.'.join(id.split('.')[0:2]),(np.nan,np.nan))[0:2]
@@ -0,0 +1,174 @@
+from __future__ import print_function
+import os
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+#- Header columns, one row per correlation (user3 to user8: as in the SAC
+#- header written by savecorrs)
+HEADER_DTYPE = np.dtype([('id1','S32'),('id2','S32'),('corrtype','S8'),\
+('timestring','S32'),('startday','S8'),('endday','S8'),('prepstring','S8'),\
+('n_stack','i8'),('lat1','f8'),('lon1','f8'),('lat2','f8'),('lon2','f8'),\
+('dist','f8'),('az','f8'),('baz','f8'),('user3','f8'),('user4','f8'),\
+('user5','f8'),('user6','f8'),('user7','f8'),('user8','f8'),('pws','?')])
+
+#- Rows collected by a shard writer before they are written to a file
+SHARD_ROWS = 1000
+
+_writers = dict()
+
+
+class ShardWriter(object):
+
+    """
+    Collects the correlations of one rank and writes them to numbered npz
+    shards (prefix.00000.shard.npz, ...) of at most SHARD_ROWS rows: header
+    columns, correlations (float32, pair x lag) and phase weight stacks
+    (complex64, zero where there is none).
+    """
+
+    def __init__(self, prefix):
+
+        self.prefix = prefix
+        self.nshard = 0
+        self.header = list()
+        self.data = list()
+        self.pws = list()
+
+    def add(self, header, correlation, phaseweight=None):
+
+        self.header.append(header)
+        self.data.append(np.asarray(correlation,dtype=np.float32))
+        if phaseweight is None:
+            self.pws.append(np.zeros(len(correlation),dtype=np.complex64))
+        else:
+            self.pws.append(np.asarray(phaseweight,dtype=np.complex64))
+        if len(self.header) >= SHARD_ROWS:
+            self.flush()
+
+    def flush(self):
+
+        if len(self.header) == 0:
+            return
+        filename = '%s.%05d.shard.npz' %(self.prefix,self.nshard)
+        np.savez(filename,header=np.array(self.header,dtype=HEADER_DTYPE),\
+        correlation=np.array(self.data),pws=np.array(self.pws))
+        self.nshard += 1
+        self.header = list()
+        self.data = list()
+        self.pws = list()
+
+
+def writer(outdir,corrname):
+    """
+    Shard writer for an output directory (one per rank), created when it is
+    first needed. The shards are named corrname.<directory name>.
+    """
+    if outdir not in _writers:
+        name = os.path.basename(os.path.normpath(outdir))
+        _writers[outdir] = ShardWriter(os.path.join(outdir,corrname+'.'+name))
+    return _writers[outdir]
+
+
+def close_writers():
+    """
+    Write the remaining rows of all shard writers of this process.
+    """
+    for outdir in list(_writers.keys()):
+        _writers.pop(outdir).flush()
+
+
+def merge(shards,filename,attrs=None,remove=True):
+    """
+    Merge shards into one HDF5 container:
+    correlation: float32 matrix (pair, lag), stored contiguously so that it
+    can be memory-mapped (see load)
+    pws: complex64 matrix (pair, lag) of phase weight stacks, if any row has
+    one
+    header/<column>: one dataset per header column
+    attrs: dictionary of attributes of the container (sampling rate...)
+
+    Rows are in the order of the shards. The shards are removed afterwards
+    if remove is True.
+    """
+
+    if h5py is None:
+        msg = 'h5py is needed to merge correlation shards into '+filename
+        raise ImportError(msg)
+
+    shards = sorted(shards)
+    header = list()
+    nlag = 0
+    for shard in shards:
+        s = np.load(shard)
+        header.append(s['header'])
+        nlag = s['correlation'].shape[1]
+        s.close()
+    if len(header) > 0:
+        header = np.concatenate(header)
+    else:
+        header = np.zeros(0,dtype=HEADER_DTYPE)
+    n = len(header)
+
+    f = h5py.File(filename,'w')
+    try:
+        corr = f.create_dataset('correlation',shape=(n,nlag),dtype='<f4')
+        if header['pws'].any():
+            pws = f.create_dataset('pws',shape=(n,nlag),dtype='<c8')
+        else:
+            pws = None
+        i = 0
+        for shard in shards:
+            s = np.load(shard)
+            m = len(s['header'])
+            corr[i:i+m] = s['correlation']
+            if pws is not None:
+                pws[i:i+m] = s['pws']
+            i += m
+            s.close()
+        for name in HEADER_DTYPE.names:
+            f.create_dataset('header/'+name,data=header[name])
+        for key in (attrs or dict()):
+            f.attrs[key] = attrs[key]
+    finally:
+        f.close()
+
+    if remove:
+        for shard in shards:
+            os.remove(shard)
+    return n
+
+
+def load(filename,mmap=True):
+    """
+    Load a correlation container.
+
+    output:
+    structured array of the header columns (HEADER_DTYPE), correlation matrix
+    (pair, lag; memory-mapped if mmap is True), phase weight stacks (None if
+    there are none), dictionary of attributes
+    """
+
+    f = h5py.File(filename,'r')
+    try:
+        header = np.zeros(f['correlation'].shape[0],dtype=HEADER_DTYPE)
+        for name in HEADER_DTYPE.names:
+            header[name] = f['header/'+name][()]
+        attrs = dict(f.attrs)
+        ds = f['correlation']
+        offset = ds.id.get_offset()
+        if mmap and offset is not None:
+            corr = np.memmap(filename,dtype='<f4',mode='r',offset=offset,\
+            shape=ds.shape)
+        else:
+            corr = ds[()]
+        if 'pws' in f:
+            pws = f['pws'][()]
+        else:
+            pws = None
+    finally:
+        f.close()
+    return header,corr,pws,attrs
@@ -0,0 +1,276 @@
+from __future__ import print_function
+import os
+import shutil
+import numpy as np
+
+from obspy import UTCDateTime
+
+# Files of intermediate correlation windows (write_all in ant_corr).
+#
+# Layout (all values little-endian):
+# - a header of HEADER_SIZE bytes (HEADER_DTYPE, zero padded);
+# - the windows, float32 records of npts samples each, one after the other,
+#   starting at HEADER_SIZE, so that they can be memory-mapped as an array
+#   of shape (nrec, npts);
+# - the index table: start and end time (epoch) of every record
+#   (INDEX_DTYPE), written behind the records when the file is closed.
+#   index_offset in the header is 0 as long as the file is open.
+
+MAGIC = b'ANTSWIN'
+VERSION = 2
+HEADER_SIZE = 512
+
+HEADER_DTYPE = np.dtype([('magic','S8'),('version','<u4'),\
+('header_size','<u4'),('fs','<f8'),('npts','<i8'),('nstack','<i8'),\
+('nrec','<i8'),('index_offset','<i8'),('prepstring','S64'),('id1','S32'),\
+('id2','S32'),('corrtype','S8')])
+
+INDEX_DTYPE = np.dtype([('tstart','<f8'),('tend','<f8')])
+
+
+class WindowWriter(object):
+
+    """
+    Write correlation windows to a new file, one record at a time.
+
+    filename: name of the file (replaced if it exists, unless append)
+    fs: sampling rate; npts: samples per window
+    nstack: number of windows per record (interm_nstack)
+    prepstring, id1, id2, corrtype: stored in the header
+    append: add the records to those of an existing file. The records are
+    written to a copy of the file, which replaces the file on close; the
+    file keeps its old records and index until then.
+    """
+
+    def __init__(self, filename, fs, npts, nstack=1, prepstring='', id1='',\
+    id2='', corrtype='', append=False):
+
+        self.filename = filename
+        self.tmpfile = None
+        self.header = np.zeros(1,dtype=HEADER_DTYPE)
+        self.header['magic'] = MAGIC
+        self.header['version'] = VERSION
+        self.header['header_size'] = HEADER_SIZE
+        self.header['fs'] = fs
+        self.header['npts'] = npts
+        self.header['nstack'] = nstack
+        self.header['prepstring'] = prepstring
+        self.header['id1'] = id1
+        self.header['id2'] = id2
+        self.header['corrtype'] = corrtype
+        self.index = list()
+
+        if append and os.path.exists(filename):
+            if not is_windows_file(filename):
+                msg = 'Old windows file format, convert before appending: '+\
+                filename
+                raise ValueError(msg)
+            (header,index,records) = open_windows(filename)
+            if header['npts'] != npts or header['fs'] != fs:
+                msg = 'Cannot append windows of %g samples at %g Hz to '\
+                %(npts,fs)+filename
+                raise ValueError(msg)
+            nrec = len(index)
+            self.index = [tuple(i) for i in index]
+            del records
+            self.tmpfile = filename + '.%g.tmp' % os.getpid()
+            shutil.copyfile(filename,self.tmpfile)
+            self.fid = open(self.tmpfile,'r+b')
+            self.fid.seek(HEADER_SIZE + 4 * npts * nrec)
+            self.fid.truncate()
+        else:
+            self.fid = open(filename,'wb')
+            self._write_header()
+
+    def write(self, tstart, tend, trace):
+        """
+        Append one record; tstart, tend: UTCDateTime or epoch seconds.
+        """
+        trace = np.asarray(trace,dtype='<f4')
+        if len(trace) != self.header['npts'][0]:
+            msg = 'Window has %g samples, expected %g' \
+            %(len(trace),self.header['npts'][0])
+            raise ValueError(msg)
+        trace.tofile(self.fid)
+        self.index.append((_epoch(tstart),_epoch(tend)))
+
+    def close(self):
+        """
+        Write the index table and complete the header.
+        """
+        self.header['nrec'] = len(self.index)
+        self.header['index_offset'] = self.fid.tell()
+        np.array(self.index,dtype=INDEX_DTYPE).tofile(self.fid)
+        self.fid.seek(0)
+        self._write_header()
+        self.fid.close()
+        if self.tmpfile is not None:
+            os.rename(self.tmpfile,self.filename)
+
+    def _write_header(self):
+        buf = np.zeros(HEADER_SIZE,dtype=np.uint8)
+        buf[0:HEADER_DTYPE.itemsize] = np.frombuffer(self.header.tobytes(),\
+        dtype=np.uint8)
+        buf.tofile(self.fid)
+
+
+def _epoch(t):
+    # epoch seconds of a number, UTCDateTime or time string
+    if isinstance(t,(int,float,np.number)):
+        return float(t)
+    return UTCDateTime(t).timestamp
+
+
+def is_windows_file(filename):
+    """
+    True if filename is in the format of this module (not the old format).
+    """
+    fid = open(filename,'rb')
+    magic = fid.read(len(MAGIC))
+    fid.close()
+    return magic == MAGIC
+
+
+def read_header(filename):
+    """
+    Header of a windows file, as a dictionary. For a file that was not
+    closed, nrec is taken from the file size and index_offset is 0.
+    """
+    header = np.fromfile(filename,dtype=HEADER_DTYPE,count=1)[0]
+    if header['magic'] != MAGIC:
+        msg = 'Not a correlation windows file: '+filename
+        raise ValueError(msg)
+    if header['version'] > VERSION:
+        msg = 'Windows file version %g is newer than this reader (%g)' \
+        %(header['version'],VERSION)
+        raise ValueError(msg)
+
+    out = dict()
+    for name in HEADER_DTYPE.names:
+        value = header[name]
+        if isinstance(value,bytes):
+            value = value.decode('utf-8')
+        out[name] = value
+    if out['index_offset'] == 0:
+        out['nrec'] = (os.path.getsize(filename) - out['header_size']) // \
+        (4 * out['npts'])
+    return out
+
+
+def open_windows(filename):
+    """
+    Open a windows file without reading the records.
+
+    output:
+    header (dictionary), index table (INDEX_DTYPE; times are nan if the file
+    was not closed), records as a read-only memory map of shape (nrec, npts)
+    """
+    header = read_header(filename)
+    nrec = int(header['nrec'])
+    npts = int(header['npts'])
+    if header['index_offset'] > 0:
+        fid = open(filename,'rb')
+        fid.seek(int(header['index_offset']))
+        index = np.fromfile(fid,dtype=INDEX_DTYPE,count=nrec)
+        fid.close()
+    else:
+        index = np.zeros(nrec,dtype=INDEX_DTYPE)
+        index['tstart'] = np.nan
+        index['tend'] = np.nan
+    if nrec > 0:
+        records = np.memmap(filename,dtype='<f4',mode='r',\
+        offset=int(header['header_size']),shape=(nrec,npts))
+    else:
+        records = np.zeros((0,npts),dtype='<f4')
+    return header,index,records
+
+
+def read_windows(filename, starttime=None, endtime=None):
+    """
+    Read the records of a windows file that lie between starttime and
+    endtime (UTCDateTime, time string or epoch seconds; None: no limit). Only these
+    records are read from the file.
+
+    output:
+    index entries and 2-D array (record, sample) of the records
+    """
+    (header,index,records) = open_windows(filename)
+    sel = np.ones(len(index),dtype=bool)
+    if starttime is not None:
+        sel &= index['tstart'] >= _epoch(starttime)
+    if endtime is not None:
+        sel &= index['tend'] <= _epoch(endtime)
+    rows = np.flatnonzero(sel)
+    return index[rows],np.array(records[rows])
+
+
+def read_old(filename, size_of_float=4, nbytes_stringhead=256,\
+nbytes_windowname=24):
+    """
+    Read a windows file in the old format (header of three floats and two
+    strings of 256 bytes, then window names of 24 bytes and float32 traces).
+
+    output:
+    header (dictionary), list of window names, 2-D array of traces
+    """
+    f_in = open(filename,'rb')
+    (fs,npts,nsub) = np.fromfile(f_in,dtype='f'+str(size_of_float),count=3)
+    npts = int(npts)
+    endianness = f_in.read(nbytes_stringhead).decode('utf-8').strip('\x00 ')
+    preproc = f_in.read(nbytes_stringhead).decode('utf-8').strip('\x00 ')
+
+    nbytes_header = nbytes_stringhead * 2 + size_of_float * 3
+    ntraces = (os.path.getsize(filename) - nbytes_header) // \
+    (size_of_float * npts + nbytes_windowname)
+
+    dtype = 'f'+str(size_of_float)
+    if endianness == 'big':
+        dtype = '>' + dtype
+    elif endianness == 'little':
+        dtype = '<' + dtype
+    rec = np.dtype([('name','S%g' %nbytes_windowname),('trace',dtype,npts)])
+    data = np.fromfile(f_in,dtype=rec,count=ntraces)
+    f_in.close()
+
+    names = [n.decode('utf-8').strip('\x00 ') for n in data['name']]
+    header = dict(fs=float(fs),npts=npts,nstack=int(nsub),\
+    prepstring=preproc,endianness=endianness)
+    return header,names,data['trace']
+
+
+def convert(oldfile, newfile=None, winlen=None):
+    """
+    Convert a windows file from the old format.
+
+    The old format has the end time of every window in its name; the start
+    time is the end time minus winlen (in seconds) if given, else nan.
+    Without newfile, the old file is replaced. Files that are already in
+    the new format are left as they are.
+    """
+    if is_windows_file(oldfile):
+        return oldfile
+    if newfile is None:
+        outfile = oldfile + '.%g.tmp' % os.getpid()
+    else:
+        outfile = newfile
+    (header,names,traces) = read_old(oldfile)
+
+    inf = os.path.basename(oldfile).split('.')
+    (id1,id2,corrtype) = ('.'.join(inf[0:4]),'.'.join(inf[4:8]),inf[8]) \
+    if len(inf) >= 9 else ('','','')
+
+    writer = WindowWriter(outfile,header['fs'],header['npts'],\
+    header['nstack'],header['prepstring'],id1,id2,corrtype)
+    for (name,trace) in zip(names,traces):
+        tend = UTCDateTime.strptime(name,'end%Y.%j.%H.%M.%S').timestamp
+        if winlen is None:
+            tstart = np.nan
+        else:
+            tstart = tend - winlen
+        writer.write(tstart,tend,trace)
+    writer.close()
+
+    if newfile is None:
+        os.rename(outfile,oldfile)
+        return oldfile
+    return newfile
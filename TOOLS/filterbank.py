@@ -0,0 +1,124 @@
+from __future__ import print_function
+import numpy as np
+
+from warnings import warn
+from obspy.core import Trace
+from scipy.signal import iirfilter, cheby2, cheb2ord, sosfilt
+
+#==================================================================================================
+# Filter designs, cached by (type, band, order, sampling rate)
+#==================================================================================================
+
+_sos = dict()
+
+
+def get_sos(ftype, band, order, fs):
+
+    """
+    Second-order sections of a filter; designed only once for every filter type,
+    band, order and sampling rate.
+
+    ftype: 'bandpass', 'highpass', 'lowpass' (Butterworth) or 'cheby_lowpass'
+    (Chebychev type II anti-alias filter; order is determined from the band)
+    band: (freqmin, freqmax) for bandpass, corner frequency otherwise
+    order: filter order (number of corners)
+    fs: sampling rate
+
+    Returns None if the filter cannot be designed for this sampling rate (corner
+    above Nyquist for lowpass).
+    """
+
+    key = (ftype, band, order, float(fs))
+    try:
+        return _sos[key]
+    except KeyError:
+        pass
+
+    fe = 0.5 * fs
+
+    if ftype == 'bandpass':
+        if band[1] >= fe:
+            msg = 'Selected high corner frequency is above Nyquist. Applying a high-pass instead.'
+            warn(msg)
+            sos = get_sos('highpass', band[0], order, fs)
+        else:
+            sos = iirfilter(order, [band[0]/fe, band[1]/fe], btype='band',
+                            ftype='butter', output='sos')
+
+    elif ftype == 'highpass':
+        sos = iirfilter(order, band/fe, btype='highpass', ftype='butter',
+                        output='sos')
+
+    elif ftype == 'lowpass':
+        if band >= fe:
+            msg = 'Selected corner frequency is above Nyquist. Not filtering.'
+            warn(msg)
+            sos = None
+        else:
+            sos = iirfilter(order, band/fe, btype='lowpass', ftype='butter',
+                            output='sos')
+
+    elif ftype == 'cheby_lowpass':
+        # rp - maximum ripple of passband, rs - attenuation of stopband
+        rp, rs, order = 1, 96, 1e99
+        ws = band / fe  # stop band frequency
+        wp = ws  # pass band frequency
+
+        while True:
+            if order <= 12:
+                break
+            wp *= 0.99
+            order, wn = cheb2ord(wp, ws, rp, rs, analog=0)
+
+        sos = cheby2(order, rs, wn, btype='low', analog=0, output='sos')
+
+    else:
+        msg = 'Unknown filter type: '+str(ftype)
+        raise ValueError(msg)
+
+    _sos[key] = sos
+    return sos
+
+
+#==================================================================================================
+# Apply filters
+#==================================================================================================
+
+def filter_data(data, ftype, band, order, fs, zerophase=True, axis=-1):
+
+    """
+    Filter an array of samples of sampling rate fs along axis, using the
+    cached filter design. Returns the filtered samples as a new array.
+    zerophase filtering runs the filter forward, then backward over the
+    result, without padding, as obspy does.
+    """
+
+    sos = get_sos(ftype, band, order, fs)
+    if sos is None or data.shape[axis] == 0:
+        return np.array(data, dtype=np.float64)
+    if zerophase:
+        firstpass = sosfilt(sos, np.require(data, np.float64), axis=axis)
+        return np.flip(sosfilt(sos, np.flip(firstpass, axis), axis=axis),
+                       axis)
+    else:
+        return sosfilt(sos, np.require(data, np.float64), axis=axis)
+
+
+def apply_filter(data, ftype, band, order=4, zerophase=True):
+
+    """
+    Filter an obspy trace or all traces of a stream, using the cached filter
+    design. zerophase filtering runs the filter forward and backward (see
+    filter_data). The filtered data replace the data of each trace.
+    """
+
+    if isinstance(data, Trace):
+        traces = [data]
+    else:
+        traces = data
+
+    for tr in traces:
+        tr.data = filter_data(tr.data, ftype, band, order,
+                              tr.stats.sampling_rate, zerophase)
+
+    return data
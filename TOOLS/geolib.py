@@ -151,4 +151,112 @@ def wgs84():
     # squared eccentricity e
     e_2 = (a**2-b**2)/a**2
     
-    return(a,b,e_2)
\ No newline at end of file
+    return(a,b,e_2)
+
+def inverse(lat1,lon1,lat2,lon2,maxiter=50,tol=1.e-12):
+    
+    """
+    Distance (m), azimuth and backazimuth (degrees) between points 1 and 2 
+    on the WGS84 ellipsoid, for arrays of coordinates at once. 
+    
+    Same output as obspy's gps2dist_azimuth, element by element: the azimuth 
+    is taken at point 1 towards point 2, the backazimuth at point 2 towards 
+    point 1.
+    
+    Vincenty's inverse formula is iterated on all points together; the few
+    (nearly antipodal) points where it does not converge are passed to 
+    geographiclib.
+    """
+    
+    (a,b,e_2) = wgs84()
+    f = (a-b)/a
+    
+    lat1 = np.atleast_1d(np.asarray(lat1,dtype=np.float64))
+    lon1 = np.atleast_1d(np.asarray(lon1,dtype=np.float64))
+    lat2 = np.atleast_1d(np.asarray(lat2,dtype=np.float64))
+    lon2 = np.atleast_1d(np.asarray(lon2,dtype=np.float64))
+    (lat1,lon1,lat2,lon2) = np.broadcast_arrays(lat1,lon1,lat2,lon2)
+    
+    # reduced latitudes
+    u1 = np.arctan((1-f)*np.tan(np.radians(lat1)))
+    u2 = np.arctan((1-f)*np.tan(np.radians(lat2)))
+    L = np.radians(lon2-lon1)
+    (su1,cu1,su2,cu2) = (np.sin(u1),np.cos(u1),np.sin(u2),np.cos(u2))
+    
+    lam = L.copy()
+    done = np.zeros(L.shape,dtype=bool)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        for i in range(maxiter):
+            (sl,cl) = (np.sin(lam),np.cos(lam))
+            ssig = np.sqrt((cu2*sl)**2+(cu1*su2-su1*cu2*cl)**2)
+            csig = su1*su2+cu1*cu2*cl
+            sig = np.arctan2(ssig,csig)
+            salpha = np.where(ssig==0.,0.,cu1*cu2*sl/ssig)
+            c2alpha = 1.-salpha**2
+            # on the equator, c2alpha is 0
+            c2sm = np.where(c2alpha==0.,0.,csig-2*su1*su2/c2alpha)
+            C = f/16*c2alpha*(4+f*(4-3*c2alpha))
+            lamold = lam
+            lam = L+(1-C)*f*salpha*(sig+C*ssig*(c2sm+C*csig*(-1+2*c2sm**2)))
+            done = np.abs(lam-lamold) < tol
+            if done.all():
+                break
+        
+        usq = c2alpha*(a**2-b**2)/b**2
+        A = 1+usq/16384*(4096+usq*(-768+usq*(320-175*usq)))
+        B = usq/1024*(256+usq*(-128+usq*(74-47*usq)))
+        dsig = B*ssig*(c2sm+B/4*(csig*(-1+2*c2sm**2)-\
+        B/6*c2sm*(-3+4*ssig**2)*(-3+4*c2sm**2)))
+        dist = b*A*(sig-dsig)
+        
+        az = np.degrees(np.arctan2(cu2*np.sin(lam),cu1*su2-su1*cu2*np.cos(lam)))
+        baz = np.degrees(np.arctan2(cu1*np.sin(lam),\
+        -su1*cu2+cu1*su2*np.cos(lam)))+180.
+    
+    az = az % 360.
+    baz = baz % 360.
+    
+    # Identical points
+    same = (lat1==lat2) & (np.radians(lon2-lon1)%(2*np.pi)==0.)
+    dist[same] = 0.
+    az[same] = 0.
+    baz[same] = 0.
+    
+    # Not converged: geographiclib
+    for k in np.flatnonzero(~(done & np.isfinite(dist)) & ~same):
+        p = geodesic.Geodesic.WGS84.Inverse(lat1.flat[k],lon1.flat[k],\
+        lat2.flat[k],lon2.flat[k])
+        dist.flat[k] = p['s12']
+        az.flat[k] = p['azi1'] % 360.
+        baz.flat[k] = (p['azi2']+180.) % 360.
+    
+    return (dist,az,baz)
+    
+    
+def geodesic_table(lat,lon):
+    
+    """
+    Distance (m), azimuth and backazimuth (degrees) between all pairs of 
+    points; matrices of shape (n, n), where element [i,j] refers to the path 
+    from point i to point j (as gps2dist_azimuth(lat[i],lon[i],lat[j],lon[j])).
+    
+    Every pair is computed once; the other direction follows by symmetry.
+    """
+    
+    n = len(lat)
+    lat = np.asarray(lat,dtype=np.float64)
+    lon = np.asarray(lon,dtype=np.float64)
+    (i,j) = np.triu_indices(n,1)
+    (d,az,baz) = inverse(lat[i],lon[i],lat[j],lon[j])
+    
+    dist = np.zeros((n,n))
+    azim = np.zeros((n,n))
+    bazim = np.zeros((n,n))
+    dist[i,j] = d
+    dist[j,i] = d
+    azim[i,j] = az
+    bazim[i,j] = baz
+    azim[j,i] = baz
+    bazim[j,i] = az
+    
+    return (dist,azim,bazim)
@@ -1,6 +1,7 @@
 from __future__ import print_function
 import numpy as np
-from obspy import Stream
+from obspy import Stream, Trace
+from ANTS.TOOLS import segment as sg
 
 def mergetraces(data, Fs, maxgap=10.0, ofid=None):
     
@@ -49,39 +50,45 @@ def mergetraces(data, Fs, maxgap=10.0, ofid=None):
     
     # loop through ids
     for id in list(traces_dict.keys()):
-        #print('===================')
         
         trace_list = traces_dict[id]
-        cur_trace = Stream(trace_list.pop(0))
-
-        # work through all traces of same id
-        while trace_list:
-            trace = trace_list.pop(0)
-            #print('===================')
-            #print(cur_trace)
-            #print('Next trace:')
-            #print(trace)
-            # Case 1: Overlap =================================================
-            # Overlaps should be removed in any case, as we don't want to correlate the data twice; especially if they differ between traces (which is most likely the case due to different tapering etc.)
-            # Case 2: Perfectly adjacent ======================================
-            # Case 3: Short gap ===============================================
-            if trace.stats.starttime - cur_trace[-1].stats.endtime <= maxgap:
-                #print('Overlap or adjacent or short gap.')
-                
-                cur_trace += trace
-                cur_trace.merge(method=1,interpolation_samples=0,\
-                fill_value=0)
-            # Case 4: Long gap ================================================
-            else:
-                #print('Long gap.')
-                # Add to output stream
-                data += cur_trace
-                # Start new stream
-                cur_trace = Stream(trace)
-            
-        # Add the last trace of this id
-        # This is actually a stream, but that is ok, adding streams just adds their traces
-        data += cur_trace
+        
+        # Segments on the sample grid of the first trace
+        origin = trace_list[0].stats.starttime.timestamp
+        segs = [sg.from_trace(tr,origin) for tr in trace_list]
+        starts = np.array([seg.start for seg in segs])
+        ends = np.array([seg.end for seg in segs])
+        fs = segs[0].fs
+        
+        # Case 1: Overlap =================================================
+        # Overlaps should be removed in any case, as we don't want to correlate the data twice; especially if they differ between traces (which is most likely the case due to different tapering etc.)
+        # Case 2: Perfectly adjacent ======================================
+        # Case 3: Short gap ===============================================
+        # A new group begins where the gap to the end of all previous traces
+        # is longer than maxgap (Case 4: Long gap)
+        # (gap measured from the last sample, like endtime)
+        covered = np.maximum.accumulate(ends)
+        gaps = (starts[1:] - covered[:-1] + 1) / fs
+        newgroup = np.concatenate(([0],np.flatnonzero(gaps > maxgap) + 1,\
+        [len(segs)]))
+        
+        for (g0,g1) in zip(newgroup[:-1],newgroup[1:]):
+            if g1 - g0 == 1:
+                data += trace_list[g0]
+                continue
+            start = starts[g0]
+            merged = np.zeros(np.max(ends[g0:g1])-start,\
+            dtype=segs[g0].data.dtype)
+            # Later traces overwrite overlapping samples of earlier ones, 
+            # unless they are contained in them, as in obspy's merge 
+            # (method 1); short gaps are filled with zeros
+            for j in range(g0,g1):
+                if j > g0 and ends[j] <= covered[j-1]:
+                    continue
+                merged[starts[j]-start:ends[j]-start] = segs[j].data
+            tr = Trace(header=trace_list[g0].stats.copy())
+            tr.data = merged
+            data += tr
 
     return data
 
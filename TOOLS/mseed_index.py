@@ -0,0 +1,191 @@
+from __future__ import print_function
+import os
+import io
+import numpy as np
+
+from glob import glob
+from obspy import read, Stream, UTCDateTime
+
+#- Index entries, one per miniSEED record
+INDEX_DTYPE = np.dtype([('offset','i8'),('reclen','i4'),('start','f8'),\
+('nsamp','i4'),('fs','f8'),('encoding','i1')])
+
+#- Index files are kept in this subdirectory of the data directory, so that
+#- they do not match the patterns of the data files
+INDEX_DIR = '.mseedidx'
+
+
+def index_path(filename):
+    """
+    Name of the index file of a miniSEED file.
+    """
+    (dirname,basename) = os.path.split(os.path.abspath(filename))
+    return os.path.join(dirname,INDEX_DIR,basename+'.npy')
+
+
+def _btime(hdr,bo):
+    (year,jday) = np.frombuffer(hdr[20:24],dtype=bo+'u2')
+    (hour,minute,sec) = np.frombuffer(hdr[24:27],dtype='u1')
+    frac = np.frombuffer(hdr[28:30],dtype=bo+'u2')[0]
+    t = UTCDateTime(year=int(year),julday=int(jday),hour=int(hour),\
+    minute=int(minute),second=int(sec))
+    return t.timestamp + frac * 1.e-4
+
+
+def _rate(factor,mult):
+    if factor == 0:
+        return 0.
+    if factor > 0 and mult > 0:
+        return float(factor) * mult
+    if factor > 0 and mult < 0:
+        return -float(factor) / mult
+    if factor < 0 and mult > 0:
+        return -float(mult) / factor
+    if factor < 0 and mult < 0:
+        return 1. / (float(factor) * mult)
+    return float(factor)
+
+
+def scan_records(filename):
+    """
+    Read the fixed headers and blockettes 1000/1001 of all records of a
+    (version 2) miniSEED file, without decoding any data.
+
+    output:
+    structured array (INDEX_DTYPE): byte offset and length, start time
+    (epoch), number of samples, sampling rate and encoding of every record
+    """
+
+    data = np.memmap(filename,dtype=np.uint8,mode='r')
+    size = len(data)
+    rows = list()
+    offset = 0
+
+    while offset + 48 <= size:
+        hdr = data[offset:offset+64].tobytes()
+        # Byte order: the year has to be plausible
+        if 1900 <= np.frombuffer(hdr[20:22],dtype='>u2')[0] <= 2100:
+            bo = '>'
+        else:
+            bo = '<'
+        nsamp = int(np.frombuffer(hdr[30:32],dtype=bo+'u2')[0])
+        (factor,mult) = np.frombuffer(hdr[32:36],dtype=bo+'i2')
+        actflags = np.frombuffer(hdr[36:37],dtype='u1')[0]
+        tcorr = int(np.frombuffer(hdr[40:44],dtype=bo+'i4')[0])
+        nextb = int(np.frombuffer(hdr[46:48],dtype=bo+'u2')[0])
+
+        start = _btime(hdr,bo)
+        if not actflags & 2:
+            start += tcorr * 1.e-4
+
+        #- Walk the blockettes for record length, encoding and microseconds
+        reclen = 0
+        encoding = -1
+        while nextb != 0 and offset + nextb + 8 <= size:
+            b = data[offset+nextb:offset+nextb+8].tobytes()
+            (btype,bnext) = np.frombuffer(b[0:4],dtype=bo+'u2')
+            if btype == 1000:
+                encoding = np.frombuffer(b[4:5],dtype='i1')[0]
+                reclen = 2 ** int(np.frombuffer(b[6:7],dtype='u1')[0])
+            elif btype == 1001:
+                start += np.frombuffer(b[5:6],dtype='i1')[0] * 1.e-6
+            if bnext <= nextb:
+                break
+            nextb = int(bnext)
+
+        if reclen == 0:
+            msg = 'No blockette 1000 in record at byte %g of %s' \
+            %(offset,filename)
+            raise ValueError(msg)
+
+        rows.append((offset,reclen,start,nsamp,_rate(factor,mult),encoding))
+        offset += reclen
+
+    del data
+    return np.array(rows,dtype=INDEX_DTYPE)
+
+
+def build_index(filename):
+    """
+    Scan a miniSEED file and store its record index (see index_path).
+    The index is written to a temporary file first, so that several
+    processes may build it at the same time.
+    """
+
+    index = scan_records(filename)
+    path = index_path(filename)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    tmp = path + '.%g.tmp' % os.getpid()
+    fid = open(tmp,'wb')
+    np.save(fid,index)
+    fid.close()
+    os.rename(tmp,path)
+    return index
+
+
+def load_index(filename):
+    """
+    Record index of a miniSEED file; built if it is missing or older than
+    the file.
+    """
+
+    path = index_path(filename)
+    if os.path.exists(path) and \
+    os.path.getmtime(path) >= os.path.getmtime(filename):
+        return np.load(path)
+    return build_index(filename)
+
+
+def read_span(filename,starttime,endtime):
+    """
+    Read the data of a miniSEED file between starttime and endtime.
+
+    Only the records overlapping this time span are decoded: they are
+    looked up in the record index, taken from the memory-mapped file and
+    passed to obspy.
+
+    output:
+    obspy stream, trimmed to starttime and endtime
+    """
+
+    index = load_index(filename)
+    t1 = UTCDateTime(starttime).timestamp
+    t2 = UTCDateTime(endtime).timestamp
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        last = index['start'] + np.where(index['fs'] > 0,\
+        (index['nsamp'] - 1) / index['fs'],0.)
+    use = np.flatnonzero((index['start'] <= t2) & (last >= t1))
+    if len(use) == 0:
+        return Stream()
+
+    if len(use) == len(index):
+        st = read(filename,format='MSEED')
+    else:
+        data = np.memmap(filename,dtype=np.uint8,mode='r')
+        buf = b''.join([data[o:o+l].tobytes() for (o,l) in \
+        zip(index['offset'][use],index['reclen'][use])])
+        del data
+        st = read(io.BytesIO(buf),format='MSEED')
+
+    st.trim(UTCDateTime(t1),UTCDateTime(t2))
+    return st
+
+
+def index_directory(indir,pattern='*',verbose=False):
+    """
+    Build the record index of all miniSEED files in indir matching pattern.
+    Files that are not miniSEED are skipped.
+    """
+
+    for filename in sorted(glob(os.path.join(indir,pattern))):
+        if not os.path.isfile(filename):
+            continue
+        try:
+            build_index(filename)
+        except Exception as e:
+            if verbose:
+                print('Could not index '+filename+': '+str(e),file=None)
@@ -0,0 +1,124 @@
+from __future__ import print_function
+import time
+import numpy as np
+
+from math import ceil
+from ANTS.TOOLS.availability import build_index, channel_spans, \
+station_spans, count_windows
+
+
+def time_window(npts,nrep=5):
+    """
+    Measure the time to correlate two windows of npts samples (via FFT).
+    """
+
+    nfft = 1
+    while nfft < 2*npts:
+        nfft *= 2
+
+    d1 = np.random.randn(npts)
+    d2 = np.random.randn(npts)
+    t = time.time()
+    for i in range(nrep):
+        np.fft.irfft(np.fft.rfft(d1,nfft)*np.fft.rfft(d2[::-1],nfft),nfft)
+    return (time.time() - t) / nrep
+
+
+def plan_blocks(pairs,chids,size,budget,indir,prepname,startdate,enddate,\
+    winlen,olap,Fs,ncorr=1,verbose=True,index=None):
+    """
+    Arrange station pairs in blocks that fit into memory.
+
+    input:
+    pairs: list of tuples of station ids
+    chids: function returning the channel ids of a station id
+    size: number of ranks
+    budget: maximum memory in bytes for the station data of one block
+    indir, prepname, startdate, enddate: where and when to look for data
+    winlen, olap: correlation window length and overlap in seconds
+    Fs: sampling rate of the correlation
+    ncorr: number of correlations per pair (components)
+    index: availability index of the data (see availability.build_index); 
+    built here if None
+
+    Pairs are ordered so that pairs sharing a station follow each other, and
+    a block is closed when the station data of its pairs would exceed the
+    budget, or when it holds its share of pairs for one rank. The blocks are
+    sorted by predicted cost, largest first, so that the round-robin
+    distribution to ranks is balanced.
+
+    output:
+    list of blocks (lists of station pairs)
+    """
+
+    #- Scan the available data ------------------------------------------------
+    stations = sorted(set([p[0] for p in pairs] + [p[1] for p in pairs]))
+    if index is None:
+        index = build_index(indir,prepname,startdate,enddate,\
+        set([id for sta in stations for id in chids(sta)]))
+    info = dict()
+    mem = dict()
+    for sta in stations:
+        for id in chids(sta):
+            info[id] = channel_spans(index,id)
+            (fs,spans) = info[id]
+            # Filtered data are held as 8 byte floats, downsampled to Fs
+            mem[id] = np.sum(spans[:,1]-spans[:,0]) * min(fs,Fs) * 8
+
+    #- Windows per pair -------------------------------------------------------
+    nwin = dict()
+    for pair in pairs:
+        (fs1,spans1) = station_spans(index,chids(pair[0]))
+        (fs2,spans2) = station_spans(index,chids(pair[1]))
+        nwin[pair] = count_windows(spans1,spans2,winlen,olap,min(fs1,fs2))
+
+    #- Fill blocks ------------------------------------------------------------
+    maxpairs = max(1,int(ceil(len(pairs)/float(size))))
+    blocks = list()
+    blockmem = list()
+    block = list()
+    chans = set()
+    bmem = 0.
+
+    for pair in sorted(pairs):
+        new = set(chids(pair[0])+chids(pair[1])) - chans
+        newmem = sum([mem[id] for id in new])
+        if len(block) > 0 and (bmem + newmem > budget or len(block) >= maxpairs):
+            blocks.append(block)
+            blockmem.append(bmem)
+            block = list()
+            chans = set()
+            new = set(chids(pair[0])+chids(pair[1]))
+            newmem = sum([mem[id] for id in new])
+            bmem = 0.
+        block.append(pair)
+        chans |= new
+        bmem += newmem
+    if len(block) > 0:
+        blocks.append(block)
+        blockmem.append(bmem)
+
+    cost = [sum([nwin[p] for p in b]) for b in blocks]
+    order = np.argsort(cost)[::-1]
+    blocks = [blocks[i] for i in order]
+    blockmem = [blockmem[i] for i in order]
+    cost = [cost[i] for i in order]
+
+    #- Predict runtime and memory ---------------------------------------------
+    if verbose:
+        twin = time_window(int(winlen*Fs))
+        rankwin = [sum(cost[r:len(cost):size]) for r in range(size)]
+        npb = [len(b) for b in blocks] or [0]
+        print('Planned %g pairs in %g blocks of %g to %g pairs'\
+        %(len(pairs),len(blocks),min(npb),max(npb)),file=None)
+        print('Number of correlation windows: %g, up to %g per rank'\
+        %(sum(cost),max(rankwin+[0])),file=None)
+        print('Predicted peak memory of station data per block: %.1f MB'\
+        %(max(blockmem+[0])/1.e6),file=None)
+        print('Predicted correlation time (without reading): %.1f s'\
+        %(max(rankwin+[0])*twin*ncorr),file=None)
+        if max(blockmem+[0]) > budget:
+            print('Some single station pairs exceed the memory budget.',\
+            file=None)
+
+    return blocks
@@ -0,0 +1,140 @@
+from __future__ import print_function
+import threading
+import numpy as np
+
+
+def data_nbytes(data):
+    """
+    Memory held by an obspy trace or stream, or a segment or list of 
+    segments (data and mask), in bytes.
+    """
+    if isinstance(data,list):
+        traces = data
+    else:
+        try:
+            traces = data.traces
+        except AttributeError:
+            traces = [data]
+
+    nbytes = 0
+    for tr in traces:
+        nbytes += tr.data.nbytes
+        if isinstance(tr.data,np.ma.MaskedArray) and \
+        tr.data.mask is not np.ma.nomask:
+            nbytes += tr.data.mask.nbytes
+        if getattr(tr,'mask',None) is not None:
+            nbytes += tr.mask.nbytes
+    return nbytes
+
+
+class Prefetcher(object):
+
+    """
+    Read station data in a background thread, ahead of the correlation.
+
+    plan: list of channel ids in the order in which they will be requested
+    reader: function that takes a channel id and returns (trace, success),
+    like ant_corr.addtr
+    budget: maximum memory in bytes to be held by data that were read but
+    not requested yet. At least one item is always read ahead.
+
+    get(id) returns the data of the next planned occurrence of id, waiting
+    for the reader if necessary. Planned items that were passed over are
+    dropped. Ids that are not in the rest of the plan are read directly.
+    An exception raised by the reader in the background thread is raised
+    again by get() when data that were not read before are requested.
+    """
+
+    def __init__(self, plan, reader, budget):
+
+        self.plan = list(plan)
+        self.reader = reader
+        self.budget = budget
+        self.ready = dict()
+        self.nbytes = dict()
+        self.used = 0
+        self.pos = 0
+        self.next = 0
+        self.stopped = False
+        self.error = None
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+
+        try:
+            while True:
+                with self.cond:
+                    #- Skip the items that the consumer has passed already
+                    self.next = max(self.next,self.pos)
+                    if self.stopped or self.next >= len(self.plan):
+                        break
+                    i = self.next
+                    id = self.plan[i]
+
+                data = self.reader(id)
+                size = data_nbytes(data[0])
+
+                with self.cond:
+                    while not self.stopped and self.used > 0 and \
+                    self.used + size > self.budget and i >= self.pos:
+                        self.cond.wait()
+                    if not self.stopped and i >= self.pos:
+                        self.ready[i] = data
+                        self.nbytes[i] = size
+                        self.used += size
+                    self.next = max(self.next,i+1)
+                    self.cond.notify_all()
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.stopped = True
+                self.cond.notify_all()
+
+    def _drop(self, i):
+        self.used -= self.nbytes.pop(i)
+        return self.ready.pop(i)
+
+    def get(self, id):
+
+        with self.cond:
+            try:
+                i = self.plan.index(id,self.pos)
+            except ValueError:
+                i = None
+
+            if i is not None:
+                #- Release whatever was read ahead but is not needed anymore
+                for j in list(self.ready.keys()):
+                    if j < i:
+                        self._drop(j)
+                self.pos = i
+                self.cond.notify_all()
+
+                while i not in self.ready and not self.stopped:
+                    self.cond.wait()
+                self.pos = i + 1
+                if i in self.ready:
+                    data = self._drop(i)
+                    self.cond.notify_all()
+                    return data
+                if self.error is not None:
+                    raise self.error
+
+        #- Not planned or the reader thread has ended: read here
+        return self.reader(id)
+
+    def stop(self):
+
+        with self.cond:
+            self.stopped = True
+            for j in list(self.ready.keys()):
+                self._drop(j)
+            self.cond.notify_all()
+        self.thread.join()
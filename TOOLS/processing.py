@@ -6,7 +6,7 @@ from obspy.core import read
 
 from scipy.interpolate import interp1d
 from obspy.core import Trace, Stream, UTCDateTime
-from scipy.signal import cheby2,  cheb2ord,  filtfilt
+from ANTS.TOOLS import filterbank as fb
 from glob import glob
 from gc import collect
 
@@ -127,7 +127,7 @@ def bandpass(data,corners,f_min,f_max,verbose, ofid):
         print('* bandpass between '+str(f_min)+' and '+str(f_max)+' Hz\n',file=ofid)
         print ('* filter order '+str(corners)+' \n',file=ofid)
         
-    data.filter('bandpass',freqmin=f_min, freqmax=f_max,corners=corners,zerophase=True)
+    fb.apply_filter(data,'bandpass',(f_min,f_max),corners,zerophase=True)
     
     return data
 
@@ -161,23 +161,13 @@ def zerophase_chebychev_lowpass_filter(trace, freqmax, verbose, ofid=None):
     :param freqmax: The desired lowpass frequency.
 
     Will be replaced once ObsPy has a proper decimation filter.
+    
+    The filter design is cached in the filterbank module and applied as 
+    second-order sections.
     """ 
-        
-    # rp - maximum ripple of passband, rs - attenuation of stopband
-    rp, rs, order = 1, 96, 1e99
-    ws = freqmax / (trace.stats.sampling_rate * 0.5)  # stop band frequency
-    wp = ws  # pass band frequency
-
-    while True:
-        if order <= 12:
-            break
-        wp *= 0.99
-        order, wn = cheb2ord(wp, ws, rp, rs, analog=0)
-
-    b, a = cheby2(order, rs, wn, btype="low", analog=0, output="ba")
-
+    
     # Apply twice to get rid of the phase distortion.
-    trace.data = filtfilt(b, a, trace.data)
+    fb.apply_filter(trace,'cheby_lowpass',freqmax,None,zerophase=True)
     
 #==================================================================================================
 # BUTTERWORTH LOWPASS FILTER
@@ -188,7 +178,7 @@ def lowpass(data,corners,f_max,verbose, ofid):
     if verbose==True:
         print('* lowpass below '+str(f_max)+' Hz\n',file=ofid)
         
-    data.filter('lowpass', freq=f_max,corners=corners,zerophase=False)
+    fb.apply_filter(data,'lowpass',f_max,corners,zerophase=False)
     
 
     return data
@@ -1,18 +1,33 @@
 import numpy as np
 import os
 
+from obspy import UTCDateTime
+from ANTS.TOOLS import corr_windows as cw
+
 def read_corr_windows(inputfile,size_of_float=4,nbytes_stringhead=256,nbytes_windowname=24):
     """
     Intermediate correlation windows from ant_corr are saved in a specific binary format.
     The header contains: sampling rate (4 byte), number of samples per trace (4 byte), 
     number of subwindows per substack (4 byte), endianness (256 byte), preprocessing string(256 byte)
     Then the data follow in 4-byte floats.
+    
+    Files in the current format (see corr_windows) are read as well; use 
+    corr_windows.read_windows to read only part of them.
     """
     
+    if cw.is_windows_file(inputfile):
+        (index,traces) = cw.read_windows(inputfile)
+        winnames = dict()
+        for i in range(len(index)):
+            winname = 'end'+UTCDateTime(index['tend'][i]).\
+            strftime('%Y.%j.%H.%M.%S')
+            winnames[winname] = i
+        return winnames, traces
+    
     f_in = open(inputfile,'rb')
     
     Fs = np.fromfile(f_in,dtype='f'+str(size_of_float),count=1)[0]
-    npts = np.fromfile(f_in,dtype='f'+str(size_of_float),count=1)[0]
+    npts = int(np.fromfile(f_in,dtype='f'+str(size_of_float),count=1)[0])
     nsub = np.fromfile(f_in,dtype='f'+str(size_of_float),count=1)[0]
     
     endianness = f_in.read(nbytes_stringhead)
@@ -21,7 +36,7 @@ def read_corr_windows(inputfile,size_of_float=4,nbytes_stringhead=256,nbytes_win
     preproc = str(preproc.decode('utf-8')).strip()
     
     nbytes_header = nbytes_stringhead * 2 + size_of_float * 3
-    ntraces = (os.path.getsize(inputfile)-nbytes_header)/\
+    ntraces = (os.path.getsize(inputfile)-nbytes_header)//\
     (size_of_float*npts+nbytes_windowname)
     
     print "This file contains %g traces of sampling rate %g Hz, each of which contains a stack of %g subtrace(s). \
@@ -1,5 +1,7 @@
 from __future__ import print_function
+import numpy as np
 from obspy import Stream
+from ANTS.TOOLS import segment as sg
 
 
 def rotate_streams(str1,str2,baz,rot='NE->RT',verbose=False,outfile=None):
@@ -13,78 +15,78 @@ def rotate_streams(str1,str2,baz,rot='NE->RT',verbose=False,outfile=None):
         raise ValueError(msg)
         
     
-    (str1new,str2new,perck) = find_common_segments(str1,str2)
+    (seg1new,seg2new,perck) = find_common_segments(\
+    [sg.from_trace(tr) for tr in str1.split()],\
+    [sg.from_trace(tr) for tr in str2.split()])
     
     if perck > 75 and verbose:
         print('Warning! Less than 75 % of original streams could be rotated.',file=outfile)
     
-    str = str1new + str2new
+    str = Stream([sg.to_trace(seg) for seg in seg1new+seg2new])
     str.rotate(rot,baz)
 
     return str
 
 
-def find_common_segments(str1,str2,verbose=False):
+def rotate_segments(segn,sege,baz,verbose=False,outfile=None):
+    """
+    Rotate north and east segments to radial and transverse.
     
-    if len(str1) == 0 or len(str2) == 0:
-        msg = 'One or both streams are empty.'
+    segn, sege: lists of segments of the N and E component
+    baz: backazimuth in degrees
+    
+    output:
+    lists of segments of the R and the T component, covering the common time
+    of N and E
+    """
+    
+    if len(segn) == 0 or len(sege) == 0:
+        msg = 'One or both streams are empty. Cannot rotate'
         raise ValueError(msg)
     
-    str1new = Stream()
-    str2new = Stream()
+    (segn,sege,perck) = find_common_segments(segn,sege)
     
-    n1 = 0
-    n2 = 0
+    if perck > 75 and verbose:
+        print('Warning! Less than 75 % of original streams could be rotated.',file=outfile)
     
-    numsamp1 = 0
-    numsampnew = 0
+    # as obspy.signal.rotate.rotate_ne_rt
+    ba = np.radians(baz)
+    segr = list()
+    segt = list()
+    for (n,e) in zip(segn,sege):
+        r = - e.data * np.sin(ba) - n.data * np.cos(ba)
+        t = - e.data * np.cos(ba) + n.data * np.sin(ba)
+        segr.append(sg.Segment(n.id[:-1]+'R',n.start,n.fs,r,None,n.origin))
+        segt.append(sg.Segment(n.id[:-1]+'T',n.start,n.fs,t,None,n.origin))
     
-    for i in range(len(str1)):
-        numsamp1 += len(str1[i].data)
+    return (segr,segt)
+
+
+def find_common_segments(str1,str2,verbose=False):
+    """
+    Common time of two lists of gap-free segments (on the same sample grid).
     
-    while n1 < len(str1) and n2 < len(str2):
-        
-        start1 = str1[n1].stats.starttime
-        start2 = str2[n2].stats.starttime
-        
-        end1 = str1[n1].stats.endtime
-        end2 = str2[n2].stats.endtime
-        
-        # Test if segments overlap at all
-        
-        if start1 > end2:
-            n2 += 1
-            continue
-        if start2 > end1:
-            n1 += 1
-            continue
-        
-        # Find start and endtime
-        
-        start = max(start1,start2)
-        end = min(end1, end2)
-        
-        str1new += str1[n1].slice(starttime=start,endtime=end)
-        str2new += str2[n2].slice(starttime=start,endtime=end)
-        
-        # increase index
-        
-        if end1 > end2:
-            n2 += 1
-        elif end1 == end2:
-            n1 += 1
-            n2 += 1
-        else:
-            n1 += 1
+    output:
+    lists of segments of str1 and str2 (views of their data) that cover the 
+    same samples, percentage of samples of str1 kept
+    """
+    
+    if len(str1) == 0 or len(str2) == 0:
+        msg = 'One or both streams are empty.'
+        raise ValueError(msg)
+    
+    overlaps = sg.intersect(str1,str2)
+    
+    str1new = [str1[k1].slice(i0,i1) for (k1,k2,i0,i1) in overlaps]
+    str2new = [str2[k2].slice(i0,i1) for (k1,k2,i0,i1) in overlaps]
         
-    for i in range(len(str1new)):
-        numsampnew += len(str1new[i].data)
-    if numsampnew > 0:
-        percentkept = numsamp1/numsampnew * 100 
+    numsamp1 = sum([len(seg) for seg in str1])
+    numsampnew = np.sum(overlaps[:,3]-overlaps[:,2])
+    if numsamp1 > 0:
+        percentkept = numsampnew/float(numsamp1) * 100
     else:
         percentkept = 0.
     
     return(str1new,str2new,percentkept)
     
 
-
@@ -0,0 +1,174 @@
+from __future__ import print_function
+import numpy as np
+
+from obspy.core import Trace, UTCDateTime
+
+
+class Segment(object):
+
+    """
+    Data of one channel on a regular sample grid, without obspy headers.
+
+    id: channel id (net.sta.loc.cha)
+    start: index of the first sample, counted in samples of rate fs from the
+    origin
+    fs: sampling rate
+    data: samples (numpy array; slices of a segment are views of its data)
+    mask: boolean array, True where samples are missing, or None
+    origin: epoch time of sample index 0 (default 1970-01-01)
+
+    Segments are converted from and to obspy traces only when data are read
+    or written (from_trace, to_trace).
+    """
+
+    __slots__ = ('id', 'start', 'fs', 'data', 'mask', 'origin')
+
+    def __init__(self, id, start, fs, data, mask=None, origin=0.):
+
+        self.id = id
+        self.start = int(start)
+        self.fs = float(fs)
+        self.data = data
+        self.mask = mask
+        self.origin = origin
+
+    @property
+    def npts(self):
+        return len(self.data)
+
+    @property
+    def end(self):
+        # index of the sample after the last one
+        return self.start + len(self.data)
+
+    @property
+    def starttime(self):
+        return UTCDateTime(self.origin + self.start / self.fs)
+
+    @property
+    def endtime(self):
+        return UTCDateTime(self.origin + (self.end - 1) / self.fs)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '%s | %s - %s | %g Hz, %g samples' % (self.id, self.starttime,
+                                                     self.endtime, self.fs,
+                                                     self.npts)
+
+    def slice(self, i0, i1):
+        """
+        Samples with index i0 to i1 (excluded), as a segment holding a view
+        of the data. The range is limited to the segment.
+        """
+        i0 = max(i0, self.start)
+        i1 = max(min(i1, self.end), i0)
+        j0 = i0 - self.start
+        j1 = i1 - self.start
+        if self.mask is None:
+            mask = None
+        else:
+            mask = self.mask[j0:j1]
+        return Segment(self.id, i0, self.fs, self.data[j0:j1], mask,
+                       self.origin)
+
+    def samples(self, i0, i1):
+        """
+        Samples with index i0 to i1 (excluded). Within the segment, this is a
+        view of the data; samples outside the segment are set to zero (in a
+        copy).
+        """
+        if i0 >= self.start and i1 <= self.end:
+            return self.data[i0 - self.start:i1 - self.start]
+        data = np.zeros(i1 - i0, dtype=self.data.dtype)
+        sl = self.slice(i0, i1)
+        data[sl.start - i0:sl.end - i0] = sl.data
+        return data
+
+    def split(self):
+        """
+        Split at masked samples into a list of segments without gaps (views of
+        the data).
+        """
+        if self.mask is None or not self.mask.any():
+            return [Segment(self.id, self.start, self.fs, self.data, None,
+                            self.origin)]
+
+        # Runs of valid samples: from every switch masked -> valid to the
+        # following switch valid -> masked
+        valid = np.concatenate(([0], (~self.mask).view(np.int8), [0]))
+        edges = np.flatnonzero(np.diff(valid))
+        return [Segment(self.id, self.start + j0, self.fs, self.data[j0:j1],
+                        None, self.origin)
+                for (j0, j1) in edges.reshape(-1, 2)]
+
+
+#==================================================================================================
+# Conversion to and from obspy
+#==================================================================================================
+
+def from_trace(tr, origin=0.):
+    """
+    Segment from an obspy trace. A masked array is split into data (masked
+    samples set to 0) and mask; the data are not copied otherwise. The start
+    is rounded to the nearest sample counted from origin.
+    """
+    fs = tr.stats.sampling_rate
+    start = int(round((tr.stats.starttime.timestamp - origin) * fs))
+    if isinstance(tr.data, np.ma.MaskedArray):
+        mask = np.ma.getmaskarray(tr.data)
+        data = tr.data.filled(0)
+    else:
+        mask = None
+        data = tr.data
+    return Segment(tr.id, start, fs, data, mask, origin)
+
+
+def to_trace(seg):
+    """
+    obspy trace from a segment (a masked array if the segment has a mask).
+    """
+    (net, sta, loc, cha) = seg.id.split('.')
+    if seg.mask is not None and seg.mask.any():
+        data = np.ma.masked_array(seg.data, seg.mask)
+    else:
+        data = seg.data
+    return Trace(data=data, header=dict(network=net, station=sta,
+                                        location=loc, channel=cha,
+                                        sampling_rate=seg.fs,
+                                        starttime=seg.starttime))
+
+
+def select(segments, component):
+    """
+    Segments of one component (last letter of the channel).
+    """
+    return [seg for seg in segments if seg.id[-1] == component]
+
+
+#==================================================================================================
+# Common time of two lists of segments
+#==================================================================================================
+
+def intersect(segs1, segs2):
+    """
+    Common sample ranges of two lists of segments (on the same grid).
+
+    output:
+    array of (index in segs1, index in segs2, first sample, end sample), one
+    row per overlap, sorted by time
+    """
+    if len(segs1) == 0 or len(segs2) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    s1 = np.array([seg.start for seg in segs1])
+    e1 = np.array([seg.end for seg in segs1])
+    s2 = np.array([seg.start for seg in segs2])
+    e2 = np.array([seg.end for seg in segs2])
+
+    i0 = np.maximum.outer(s1, s2)
+    i1 = np.minimum.outer(e1, e2)
+    (k1, k2) = np.nonzero(i1 > i0)
+    overlaps = np.column_stack((k1, k2, i0[k1, k2], i1[k1, k2]))
+    return overlaps[np.argsort(overlaps[:, 2], kind='mergesort')]
@@ -0,0 +1,95 @@
+from __future__ import print_function
+import numpy as np
+from mpi4py import MPI
+from obspy import Stream, Trace
+
+
+def load_node_shared(ids, reader, comm=MPI.COMM_WORLD, verbose=False, ofid=None):
+
+    """
+    Load station data once per node into a shared memory window (MPI-3).
+
+    ids: list of channel ids (net.sta.loc.cha) needed by this rank
+    reader: function that takes a channel id and returns (trace, success),
+    like ant_corr.addtr
+    comm: communicator; all ranks of comm have to call this function
+
+    Every rank on the node reads a part of the channels needed by any rank on
+    that node and copies the samples into one shared buffer. Returns a
+    dictionary channel id -> obspy stream, where the trace data are read-only
+    numpy views of the shared buffer (no copies), and the window. The buffer
+    has the common data type of all traces on the node (float32 if there are
+    none), so that the data are not converted. The window
+    must be kept and freed (win.Free(), collective) when the data are not
+    needed anymore.
+
+    """
+
+    nodecomm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    noderank = nodecomm.Get_rank()
+    nodesize = nodecomm.Get_size()
+
+    #- Union of all channels needed on this node, shared out among its ranks
+    allids = nodecomm.allgather(list(ids))
+    nodeids = sorted(set([id for rankids in allids for id in rankids]))
+    myids = nodeids[noderank:len(nodeids):nodesize]
+
+    mydata = dict()
+    mysize = 0
+    mytypes = set()
+    for id in myids:
+        (colltr,readsuccess) = reader(id)
+        if readsuccess:
+            mydata[id] = colltr.split()
+            for tr in mydata[id]:
+                mysize += tr.stats.npts
+                mytypes.add(tr.data.dtype.str)
+        else:
+            mydata[id] = Stream()
+        if verbose:
+            print('Read in traces for shared channel '+id,file=ofid)
+
+    #- Offset of this rank's data in the shared buffer (in samples)
+    sizes = nodecomm.allgather(mysize)
+    myoffset = sum(sizes[0:noderank])
+    total = max(sum(sizes),1)
+
+    #- Common data type of the traces of all ranks on the node
+    types = [t for rtypes in nodecomm.allgather(mytypes) for t in rtypes]
+    if len(types) > 0:
+        dtype = np.result_type(*[np.dtype(t) for t in types])
+    else:
+        dtype = np.dtype('f4')
+
+    itemsize = dtype.itemsize
+    if noderank == 0:
+        win = MPI.Win.Allocate_shared(total*itemsize,itemsize,comm=nodecomm)
+    else:
+        win = MPI.Win.Allocate_shared(0,itemsize,comm=nodecomm)
+    (buf,itemsize) = win.Shared_query(0)
+    buffer = np.ndarray(buffer=buf,dtype=dtype,shape=(total,))
+
+    #- Copy own data to the shared buffer and keep only the headers
+    myheads = dict()
+    offset = myoffset
+    win.Fence()
+    for id in myids:
+        myheads[id] = list()
+        for tr in mydata[id]:
+            buffer[offset:offset+tr.stats.npts] = tr.data
+            myheads[id].append((tr.stats,offset))
+            offset += tr.stats.npts
+    del mydata
+    win.Fence()
+
+    #- Everybody on the node builds traces on views of the shared buffer
+    shared = dict()
+    for heads in nodecomm.allgather(myheads):
+        for id in heads.keys():
+            shared[id] = Stream()
+            for (stats,offset) in heads[id]:
+                view = buffer[offset:offset+stats.npts]
+                view.flags.writeable = False
+                shared[id] += Trace(data=view,header=stats)
+
+    return shared, win
@@ -0,0 +1,105 @@
+from __future__ import print_function
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+# Mean Earth radius in km; distances for the pair selection are measured on
+# the sphere
+R_EARTH = 6371.
+
+
+def unit_vectors(lat,lon):
+    """
+    Cartesian coordinates of points on the unit sphere, array of shape (n, 3).
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack((np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),\
+    np.sin(lat)))
+
+
+def distance(lat1,lon1,lat2,lon2):
+    """
+    Great circle distance in km on the sphere (arrays or floats).
+    """
+    chord = np.sqrt(np.sum((unit_vectors(lat1,lon1)-\
+    unit_vectors(lat2,lon2))**2,axis=1))
+    return 2. * R_EARTH * np.arcsin(np.minimum(chord/2.,1.))
+
+
+def azimuth(lat1,lon1,lat2,lon2):
+    """
+    Azimuth in degrees (0-360) of the great circle from point 1 to point 2 on
+    the sphere (arrays or floats).
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlon = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    az = np.arctan2(np.sin(dlon)*np.cos(lat2),np.cos(lat1)*np.sin(lat2)-\
+    np.sin(lat1)*np.cos(lat2)*np.cos(dlon))
+    return np.degrees(az) % 360.
+
+
+def select_pairs(lat,lon,mindist=0.,maxdist=None,minaz=0.,maxaz=180.):
+    """
+    Pairs of stations within a range of distance and azimuth.
+
+    input:
+    lat, lon: arrays of station coordinates in degrees; nan where they are
+    unknown (pairs with these stations are always selected)
+    mindist, maxdist: distance range in km (maxdist None: no maximum)
+    minaz, maxaz: range of the azimuth from station j to station i in
+    degrees, counted modulo 180 (a pair is correlated in both directions).
+    If minaz is larger than maxaz, the range wraps around 180 degrees.
+
+    Pairs within maxdist are found by a range query on a KD-tree of the
+    stations on the unit sphere, so that distant pairs are never formed.
+
+    output:
+    array of shape (npairs, 2) of station indices (i, j) with i > j, sorted
+    """
+
+    lat = np.asarray(lat,dtype=np.float64)
+    lon = np.asarray(lon,dtype=np.float64)
+    known = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    unknown = np.flatnonzero(~(np.isfinite(lat) & np.isfinite(lon)))
+
+    #- Pairs within the maximum distance -------------------------------------
+    if maxdist is None or maxdist >= np.pi * R_EARTH:
+        (i,j) = np.tril_indices(len(known),-1)
+        pairs = np.column_stack((i,j))
+    else:
+        tree = cKDTree(unit_vectors(lat[known],lon[known]))
+        # chord length of the maximum distance
+        r = 2. * np.sin(maxdist / (2. * R_EARTH))
+        pairs = np.array(sorted(tree.query_pairs(r)),dtype=np.int64)
+        pairs = pairs.reshape(-1,2)[:,::-1]
+    pairs = known[pairs].reshape(-1,2)
+
+    #- Distance and azimuth filters ------------------------------------------
+    if len(pairs) > 0:
+        (i,j) = (pairs[:,1],pairs[:,0])
+        dist = distance(lat[i],lon[i],lat[j],lon[j])
+        keep = dist >= mindist
+        if maxdist is not None:
+            keep &= dist <= maxdist
+        if (maxaz - minaz) % 180. != 0.:
+            az = azimuth(lat[i],lon[i],lat[j],lon[j]) % 180.
+            if minaz <= maxaz:
+                keep &= (az >= minaz) & (az <= maxaz)
+            else:
+                keep &= (az >= minaz) | (az <= maxaz)
+        pairs = pairs[keep]
+
+    #- Stations without coordinates are paired with all others ---------------
+    if len(unknown) > 0:
+        (i,j) = np.meshgrid(unknown,np.arange(len(lat)),indexing='ij')
+        extra = np.column_stack((np.maximum(i,j).ravel(),\
+        np.minimum(i,j).ravel()))
+        extra = extra[extra[:,0] != extra[:,1]]
+        pairs = np.unique(np.concatenate((pairs,extra)),axis=0)
+
+    if len(pairs) == 0:
+        return np.zeros((0,2),dtype=np.int64)
+    order = np.lexsort((pairs[:,1],pairs[:,0]))
+    return pairs[order]
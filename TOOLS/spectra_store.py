@@ -0,0 +1,184 @@
+from __future__ import print_function
+import os
+import time
+import hashlib
+import numpy as np
+
+#- Index entries, one per stored window
+INDEX_DTYPE = np.dtype([('k','i8'),('row','i8'),('scale','f8'),\
+('energy','f8'),('rng','f8'),('ok','?')])
+
+
+class SpectraStore(object):
+
+    """
+    Spectra of the treated correlation windows of one channel, kept on disk
+    from one correlation run to the next.
+
+    root: directory of the store (one per set of processing parameters)
+    id: channel id
+    nfreq: number of frequencies of a spectrum
+
+    Windows are numbered on a global grid: window k starts at sample k*step
+    (counted from 1970-01-01). For every channel, the store holds
+    - id.spec: the spectra, complex64 rows of nfreq values, in the order in
+      which they were added (read through a memory map);
+    - id.index.npy: window number, row, scale, energy, std range and a flag
+      for every window (ok False: the window had gaps, nan or zeros);
+    - id.cover.npy: ranges (k0, k1) of window numbers that were processed,
+      whether there were data or not.
+    Rows are only appended; the index and cover files are replaced as a
+    whole. Writes are serialized by a lock file, so that several processes
+    can fill the store of a channel.
+    """
+
+    def __init__(self, root, id, nfreq):
+
+        self.id = id
+        self.nfreq = nfreq
+        self.specfile = os.path.join(root,id+'.spec')
+        self.indexfile = os.path.join(root,id+'.index.npy')
+        self.coverfile = os.path.join(root,id+'.cover.npy')
+        self.lockfile = os.path.join(root,id+'.lock')
+        self.reload()
+
+    def reload(self):
+
+        if os.path.exists(self.indexfile):
+            self.index = np.load(self.indexfile)
+            self.cover = np.load(self.coverfile)
+        else:
+            self.index = np.zeros(0,dtype=INDEX_DTYPE)
+            self.cover = np.zeros((0,2),dtype=np.int64)
+
+    def missing(self, k0, k1):
+        """
+        Ranges of window numbers within [k0, k1) that were not processed.
+        """
+        ranges = list()
+        for (c0,c1) in self.cover:
+            if c1 <= k0:
+                continue
+            if c0 >= k1:
+                break
+            if c0 > k0:
+                ranges.append((k0,c0))
+            k0 = max(k0,c1)
+        if k0 < k1:
+            ranges.append((k0,k1))
+        return ranges
+
+    def windows(self, k0, k1):
+        """
+        Index entries of the good windows with numbers in [k0, k1), sorted.
+        """
+        sel = (self.index['k'] >= k0) & (self.index['k'] < k1) & \
+        self.index['ok']
+        return self.index[sel]
+
+    def spectra(self, rows):
+        """
+        Spectra of the given rows (copied from the memory map).
+        """
+        nrows = os.path.getsize(self.specfile) // (8 * self.nfreq)
+        spec = np.memmap(self.specfile,dtype=np.complex64,mode='r',\
+        shape=(nrows,self.nfreq))
+        out = np.array(spec[rows])
+        del spec
+        return out
+
+    def add(self, k0, k1, entries, spec, timeout=600.):
+        """
+        Add the windows processed for the range [k0, k1) of window numbers.
+
+        entries: array of INDEX_DTYPE (the rows are set here)
+        spec: 2-D array (window, frequency) of the spectra of the entries
+        timeout: seconds to wait for the lock of another process
+        """
+
+        self._lock(timeout)
+        try:
+            #- Another process may have added windows in the meantime
+            self.reload()
+            new = ~np.isin(entries['k'],self.index['k'])
+            entries = entries[new].copy()
+            spec = np.asarray(spec[new],dtype=np.complex64)
+
+            if os.path.exists(self.specfile):
+                row0 = os.path.getsize(self.specfile) // (8 * self.nfreq)
+            else:
+                row0 = 0
+            entries['row'] = row0 + np.arange(len(entries))
+            fid = open(self.specfile,'ab')
+            spec.tofile(fid)
+            fid.close()
+
+            index = np.concatenate((self.index,entries))
+            index = index[np.argsort(index['k'],kind='mergesort')]
+            cover = merge_ranges(np.concatenate((self.cover,[[k0,k1]])))
+            self._save(self.indexfile,index)
+            self._save(self.coverfile,cover)
+            (self.index,self.cover) = (index,cover)
+        finally:
+            os.remove(self.lockfile)
+
+    def _lock(self, timeout):
+
+        t = time.time()
+        while True:
+            try:
+                fd = os.open(self.lockfile,os.O_CREAT|os.O_EXCL|os.O_WRONLY)
+                os.close(fd)
+                return
+            except OSError:
+                if time.time() - t > timeout:
+                    msg = 'Spectra store is locked; remove '+self.lockfile+\
+                    ' if no other process is writing to it'
+                    raise IOError(msg)
+                time.sleep(0.5)
+
+    def _save(self, filename, arr):
+
+        tmp = filename + '.%g.tmp' % os.getpid()
+        fid = open(tmp,'wb')
+        np.save(fid,arr)
+        fid.close()
+        os.rename(tmp,filename)
+
+
+def merge_ranges(ranges):
+    """
+    Sort ranges (k0, k1) and merge overlapping or adjacent ones.
+    """
+    if len(ranges) == 0:
+        return np.zeros((0,2),dtype=np.int64)
+    ranges = np.array(sorted([tuple(r) for r in ranges]),dtype=np.int64)
+    ends = np.maximum.accumulate(ranges[:,1])
+    new = np.concatenate(([True],ranges[1:,0] > ends[:-1]))
+    first = np.flatnonzero(new)
+    last = np.concatenate((first[1:],[len(ranges)])) - 1
+    return np.column_stack((ranges[first,0],ends[last]))
+
+
+def store_dir(root, name, params):
+    """
+    Directory of the store for a set of processing parameters (a dictionary):
+    root/name.hash, where hash is taken from the parameters. The parameters
+    are written to params.txt in this directory.
+    """
+
+    text = '\n'.join(['%s = %r' %(k,params[k]) for k in sorted(params)])+'\n'
+    dirname = os.path.join(root,name+'.'+\
+    hashlib.md5(text.encode('utf-8')).hexdigest()[0:10])
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        pass
+    pfile = os.path.join(dirname,'params.txt')
+    if not os.path.exists(pfile):
+        tmp = pfile + '.%g.tmp' % os.getpid()
+        fid = open(tmp,'w')
+        fid.write(text)
+        fid.close()
+        os.rename(tmp,pfile)
+    return dirname
@@ -0,0 +1,73 @@
+from __future__ import print_function
+import numpy as np
+
+from scipy.signal import hilbert
+try:
+    from obspy.signal.util import nextpow2
+except ImportError:
+    from obspy.signal.util import next_pow_2 as nextpow2
+
+
+def phase_coherence(corr):
+    """
+    Instantaneous phase of correlations, for the phase weighted stack 
+    (cf Schimmel and Paulssen 2007).
+    
+    corr: 2-D array (window, lag)
+    
+    Windows are tapered and zero padded to make the Hilbert transform faster.
+    """
+    n = corr.shape[1]
+    coh = np.zeros((len(corr),nextpow2(n)))
+    startindex = int(0.5*(coh.shape[1] - n))
+    coh[:,startindex:startindex+n] += corr*np.hanning(n)
+    coh = hilbert(coh,axis=1)
+    tol = np.max(coh,axis=1)[:,np.newaxis]/10000.
+    coh = coh/(np.absolute(coh)+tol)
+    return coh[:,startindex:startindex+n]
+
+
+def robust_stack(corr,rows=None,chunk=None,maxiter=20,tol=1.e-6):
+    """
+    Robust stack of correlation windows: the geometric median of the windows
+    (Weiszfeld iteration), so that windows far from the bulk of the others 
+    get little weight.
+    
+    corr: 2-D array (window, lag), may be a memory map
+    rows: indices of the windows to stack (default: all)
+    chunk: number of windows read (as 8 byte floats) at a time (default: all)
+    
+    With chunk, every iteration reads the windows twice, chunk by chunk, and
+    the iteration starts from the median of at most chunk windows spread over
+    the selection instead of the median of all windows. Memory then grows
+    with chunk, not with the number of windows.
+    
+    output:
+    stack (mean scale, like the linear stack divided by the number of 
+    windows) and the weights of the windows (summing to 1)
+    """
+    if rows is None:
+        rows = np.arange(len(corr))
+    if chunk is None:
+        chunk = max(len(rows),1)
+    parts = [rows[i:i+chunk] for i in range(0,len(rows),chunk)]
+    
+    step = max(len(rows) // chunk,1)
+    stack = np.median(np.asarray(corr[rows[::step][:chunk]],dtype=np.float64),\
+    axis=0)
+    for i in range(maxiter):
+        dist = np.concatenate([np.sqrt(np.sum((np.asarray(corr[part],\
+        dtype=np.float64)-stack)**2,axis=1)) for part in parts])
+        w = 1. / np.maximum(dist,tol * (np.max(dist) + tol))
+        w /= np.sum(w)
+        new = np.zeros(len(stack))
+        j = 0
+        for part in parts:
+            new += np.dot(w[j:j+len(part)],np.asarray(corr[part],\
+            dtype=np.float64))
+            j += len(part)
+        change = np.sqrt(np.sum((new-stack)**2))
+        stack = new
+        if change <= tol * np.sqrt(np.sum(stack**2)):
+            break
+    return stack,w
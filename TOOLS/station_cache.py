@@ -0,0 +1,64 @@
+from __future__ import print_function
+from collections import OrderedDict
+from ANTS.TOOLS.prefetch import data_nbytes
+
+
+class StationCache(object):
+
+    """
+    Least-recently-used cache of station data, keyed by channel id.
+
+    budget: maximum memory in bytes held by the cached data. When a new item
+    does not fit, the least recently used items are evicted. Items larger
+    than the budget are not cached at all.
+
+    hits, misses and evictions are counted for the output file.
+    """
+
+    def __init__(self, budget):
+
+        self.budget = budget
+        self.data = OrderedDict()
+        self.nbytes = dict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, id):
+
+        try:
+            item = self.data.pop(id)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # Re-insert to mark as most recently used
+        self.data[id] = item
+        self.hits += 1
+        return item
+
+    def put(self, id, item):
+
+        size = data_nbytes(item)
+        if id in self.data:
+            self.data.pop(id)
+            self.used -= self.nbytes.pop(id)
+        if size > self.budget:
+            return
+
+        while self.used + size > self.budget:
+            (oldid,olditem) = self.data.popitem(last=False)
+            self.used -= self.nbytes.pop(oldid)
+            self.evictions += 1
+
+        self.data[id] = item
+        self.nbytes[id] = size
+        self.used += size
+
+    def __contains__(self, id):
+        return id in self.data
+
+    def stats(self):
+        return 'Station cache: %g hits, %g misses, %g evictions, %.1f MB held'\
+        %(self.hits,self.misses,self.evictions,self.used/1.e6)
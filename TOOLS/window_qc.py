@@ -0,0 +1,107 @@
+from __future__ import print_function
+import os
+import sys
+import numpy as np
+
+# Quality table of the correlation windows of a station pair, one row per
+# window that was considered (whether it went into the stack or not):
+# tstart, tend: window start and end (epoch seconds)
+# rms1, rms2, energy1, energy2, rng1, rng2: rms, energy and range of standard
+#   deviations of the treated windows of both stations, as computed for the
+#   correlation (nan if the window was rejected before)
+# zero1, zero2: fraction of samples that are zero, before treatment
+# clip1, clip2: fraction of samples within CLIP_TOL of the largest absolute
+#   value of the window, before treatment (high for clipped data)
+# accepted: True if the window went into the stack
+# The table is saved as an npz file with one array per column.
+
+QC_DTYPE = np.dtype([('tstart','f8'),('tend','f8'),('rms1','f8'),\
+('rms2','f8'),('energy1','f8'),('energy2','f8'),('rng1','f8'),('rng2','f8'),\
+('zero1','f4'),('zero2','f4'),('clip1','f4'),('clip2','f4'),('accepted','?')])
+
+CLIP_TOL = 1.e-3
+
+
+def new_rows(tstart,tend):
+    """
+    Rows for windows with the given start and end times; all values nan,
+    not accepted.
+    """
+    rows = np.zeros(len(tstart),dtype=QC_DTYPE)
+    for name in QC_DTYPE.names[2:-1]:
+        rows[name] = np.nan
+    rows['tstart'] = tstart
+    rows['tend'] = tend
+    return rows
+
+
+def zero_fraction(data):
+    """
+    Fraction of samples of every window (2-D array, window x sample) that are
+    zero (below machine epsilon).
+    """
+    return np.mean(np.abs(data) < sys.float_info.epsilon,axis=1)
+
+
+def clip_fraction(data):
+    """
+    Fraction of samples of every window (2-D array, window x sample) that are
+    within CLIP_TOL of the largest absolute value of the window.
+    """
+    amp = np.abs(data)
+    top = np.max(amp,axis=1,keepdims=True)
+    return np.mean(amp >= (1. - CLIP_TOL) * top,axis=1)
+
+
+def window_params(data1,data2):
+    """
+    rms, energy and range of standard deviations of the windows of two
+    stations (2-D arrays, window x sample), as computed by cross_covar_batch;
+    for correlations that do not compute them (pcc).
+    """
+    params = list()
+    for data in (data1,data2):
+        data = data - np.mean(data,axis=1,keepdims=True)
+        n = data.shape[1]
+        ren = np.sum(np.square(data,dtype=np.float64),axis=1)
+        nsmp = n // 4
+        std = np.std(data[:,0:4*nsmp].reshape(-1,4,nsmp),axis=2)
+        params.append((np.sqrt(ren / n),ren,\
+        np.max(std,axis=1) / np.min(std,axis=1)))
+    return (params[0][0],params[1][0],params[0][1],params[1][1],\
+    params[0][2],params[1][2])
+
+
+def set_params(rows,index,params,accepted):
+    """
+    Enter the window parameters of cross_covar_batch (rms1, rms2, energy1,
+    energy2, std range1, std range2) and the accepted flags for the given
+    rows.
+    """
+    for (name,values) in zip(QC_DTYPE.names[2:8],params):
+        rows[name][index] = values
+    rows['accepted'][index] = accepted
+
+
+def save(filename,rows,append=False):
+    """
+    Save a table. With append, the rows are added to those of an existing
+    file.
+    """
+    if append and os.path.exists(filename):
+        rows = np.concatenate((load(filename),rows))
+    np.savez(filename,**dict([(name,rows[name]) for name in QC_DTYPE.names]))
+
+
+def load(filename):
+    """
+    Load a table as a structured array (QC_DTYPE).
+    """
+    f = np.load(filename)
+    try:
+        rows = np.zeros(len(f['tstart']),dtype=QC_DTYPE)
+        for name in QC_DTYPE.names:
+            rows[name] = f[name]
+    finally:
+        f.close()
+    return rows
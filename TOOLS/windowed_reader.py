@@ -0,0 +1,182 @@
+from __future__ import print_function
+import numpy as np
+
+from obspy.core import read, Stream, Trace, Stats, UTCDateTime
+from ANTS.TOOLS.availability import file_span, NAME_TOL
+
+
+class LazySegment(object):
+
+    """
+    Continuous data of one channel, spread over adjacent files, that are read
+    only when a window of the data is requested.
+
+    files: sorted list of (filename, starttime, endtime); the end times may
+    be up to NAME_TOL too early (times from file names)
+    stats: obspy stats describing the whole segment
+    prep: function applied to every trace after reading (e.g. filtering),
+    returning the trace
+    reader: function reading a file into a stream (default: obspy read)
+
+    Like an obspy trace, the segment has an id, stats and slice(); like a
+    Segment, it has start, end, fs and samples(). slice()
+    reads the files overlapping the requested window and drops the files that
+    end before it, so windows have to be requested in increasing time. Only
+    the files covering the current window are held in memory.
+    """
+
+    def __init__(self, files, stats, prep=None, reader=None):
+
+        self.files = files
+        self.stats = stats
+        self.prep = prep
+        self.reader = reader
+        self.loaded = dict()
+
+    @property
+    def id(self):
+        return '.'.join([self.stats.network,self.stats.station,\
+        self.stats.location,self.stats.channel])
+
+    #- Sample grid, as for Segment objects: sample indices count from 
+    #- 1970-01-01 at the sampling rate of the segment
+    @property
+    def fs(self):
+        return self.stats.sampling_rate
+
+    @property
+    def start(self):
+        return int(round(self.stats.starttime.timestamp*self.fs))
+
+    @property
+    def end(self):
+        return self.start + self.stats.npts
+
+    def _load(self, filename):
+
+        try:
+            if self.reader is None:
+                st = read(filename)
+            else:
+                st = self.reader(filename)
+        except Exception:
+            print('Problems opening data file:\n'+filename,file=None)
+            return Stream()
+        if self.prep is not None:
+            st = Stream([self.prep(tr) for tr in st])
+        return st
+
+    def slice(self, starttime, endtime):
+
+        #- Evict files ending before the window, read files overlapping it
+        for (filename,t1,t2) in self.files:
+            if t2 + NAME_TOL < starttime:
+                self.loaded.pop(filename,None)
+            elif t1 <= endtime and filename not in self.loaded:
+                self.loaded[filename] = self._load(filename)
+            if t1 > endtime:
+                break
+
+        st = Stream()
+        for (filename,t1,t2) in self.files:
+            if filename in self.loaded and t2 + NAME_TOL >= starttime and \
+            t1 <= endtime:
+                st += self.loaded[filename].slice(starttime,endtime)
+        st.merge(method=1)
+
+        if len(st) == 0:
+            tr = self._empty()
+        else:
+            tr = st[0]
+        if isinstance(tr.data,np.ma.MaskedArray):
+            tr.data = tr.data.filled(0.)
+        return tr
+
+    def samples(self, i0, i1):
+
+        """
+        Samples with indices i0 to i1 (excluded), counted at the sampling rate
+        of the segment from 1970-01-01. Samples without data are set to zero.
+        """
+
+        fs = self.stats.sampling_rate
+        tr = self.slice(UTCDateTime(i0/float(fs)),UTCDateTime((i1-1)/float(fs)))
+        data = np.zeros(i1-i0)
+        if tr.stats.npts == 0:
+            return data
+        j = max(int(round(tr.stats.starttime.timestamp*fs)) - i0,0)
+        n = min(tr.stats.npts,i1-i0-j)
+        data[j:j+n] = tr.data[0:n]
+        return data
+
+    def _empty(self):
+        return Trace(header=dict(network=self.stats.network,\
+        station=self.stats.station,location=self.stats.location,\
+        channel=self.stats.channel,sampling_rate=self.stats.sampling_rate))
+
+
+def windowed_channel(id,files,startdate,enddate,minlen,prep=None,rate=None,\
+reader=None):
+
+    """
+    Map the files of one channel to lazily read continuous segments.
+
+    id: channel id
+    files: file names, as written by ant_proc
+    startdate, enddate: UTCDateTime, files outside this range are ignored
+    minlen: files shorter than this (in seconds) are ignored
+    prep: function to apply to every trace when it is read; returns the trace
+    rate: function returning the sampling rate of the data after prep, given
+    the sampling rate in the file (if prep resamples the data)
+    reader: function reading a file into a stream (default: obspy read)
+
+    Only the headers of the first file and of the last file of every segment
+    are read, to get the sampling rate and the end of the segment (file names
+    only give times to the second).
+
+    output:
+    list of LazySegment objects, in temporal order
+    """
+
+    spans = list()
+    for filename in sorted(files):
+        try:
+            (t1,t2) = file_span(filename)
+        except (ValueError, IndexError):
+            continue
+        if t1 > enddate or t2 < startdate or t2 - t1 < minlen:
+            continue
+        spans.append((filename,t1,t2))
+
+    if len(spans) == 0:
+        return list()
+
+    try:
+        fs = read(spans[0][0],headonly=True)[0].stats.sampling_rate
+    except Exception:
+        return list()
+    if rate is not None:
+        fs = rate(fs)
+
+    #- Group adjacent files into segments
+    groups = [[spans[0]]]
+    for span in spans[1:]:
+        if span[1] - groups[-1][-1][2] <= NAME_TOL + 1.5/fs:
+            groups[-1].append(span)
+        else:
+            groups.append([span])
+
+    (net,sta,loc,cha) = id.split('.')
+    segments = list()
+    for group in groups:
+        stats = Stats(dict(network=net,station=sta,location=loc,channel=cha,\
+        sampling_rate=fs,starttime=group[0][1]))
+        try:
+            t2 = max([tr.stats.endtime for tr in \
+            read(group[-1][0],headonly=True)])
+        except Exception:
+            t2 = group[-1][2]
+        stats.npts = int(round((t2-group[0][1])*fs)) + 1
+        segments.append(LazySegment(group,stats,prep,reader))
+
+    return segments
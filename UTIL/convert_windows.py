@@ -0,0 +1,33 @@
+#- Script to convert intermediate correlation window files (write_all) from
+#- the old format to the indexed format of TOOLS/corr_windows.py
+from __future__ import print_function
+from glob import glob
+import sys
+
+from ANTS.TOOLS import corr_windows as cw
+
+if __name__=='__main__':
+    from ANTS.UTIL import convert_windows as cv
+    if len(sys.argv)==2:
+        cv.convert_windows(sys.argv[1])
+    elif len(sys.argv)==3:
+        cv.convert_windows(sys.argv[1],float(sys.argv[2]))
+    else:
+        print('Usage: python convert_windows.py "pattern" [winlen]')
+
+
+def convert_windows(pattern,winlen=None):
+    """
+    pattern: files to convert, e.g. 'correlations/run/*.windows.bin' (string)
+    winlen: correlation window length in seconds; the old format only has
+    the end time of every window, the start times are set to end - winlen
+    (or left empty if winlen is not given)
+
+    The files are replaced by their converted version; files that are
+    already converted are skipped.
+    """
+    for filename in sorted(glob(pattern)):
+        if cw.is_windows_file(filename):
+            continue
+        cw.convert(filename,winlen=winlen)
+        print('Converted '+filename,file=None)
@@ -0,0 +1,195 @@
+#- Script to build new stacks from the correlation windows stored by ant_corr
+#- (write_all), with a selection of windows, without correlating again
+from __future__ import print_function
+from glob import glob
+from multiprocessing import Pool
+import os
+import sys
+import numpy as np
+
+from obspy import Trace, UTCDateTime
+from ANTS.TOOLS import corr_windows as cw
+from ANTS.TOOLS import window_qc as wq
+from ANTS.TOOLS.stacking import phase_coherence, robust_stack
+
+if __name__=='__main__':
+    from ANTS.UTIL import restack as rs
+    if len(sys.argv)==3:
+        rs.restack(sys.argv[1],sys.argv[2])
+    elif len(sys.argv)==4:
+        rs.restack(sys.argv[1],sys.argv[2],sys.argv[3])
+    elif len(sys.argv)==5:
+        rs.restack(sys.argv[1],sys.argv[2],sys.argv[3],sys.argv[4])
+    elif len(sys.argv)==6:
+        rs.restack(sys.argv[1],sys.argv[2],sys.argv[3],sys.argv[4],\
+        nproc=int(sys.argv[5]))
+    else:
+        print('Usage: python restack.py "pattern" stackname [select] \
+[method] [nproc]')
+
+#- Windows are summed this many at a time
+CHUNK = 1024
+
+
+def restack(pattern,stackname,select=None,method='linear',outdir=None,\
+nproc=1):
+    """
+    pattern: windows files to restack, e.g.
+    'correlations/run/*.windows.bin' (string); files in the old format must
+    be converted first (see convert_windows.py)
+    stackname: name of the new stacks, in place of corrname (string)
+    select: expression that selects windows (see window_table), e.g.
+    'accepted & (energy1 < 3*np.median(energy1)) & ((hour < 6) | (hour > 20))';
+    None: all windows
+    method: 'linear', 'pws' (linear stack and phase weight stack, as from
+    ant_corr) or 'robust' (see stacking.robust_stack; scaled by the number of
+    windows like the linear stack; the windows are read CHUNK at a time, in
+    every iteration)
+    outdir: directory of the new stacks (default: that of the windows files)
+    nproc: number of files restacked in parallel
+
+    The stacks are written as id1.id2.corrtype.stackname.SAC (and .npy for
+    the phase weight stack).
+
+    output:
+    list of (windows file, number of windows stacked)
+    """
+    if method not in ['linear','pws','robust']:
+        msg = 'method must be \'linear\', \'pws\' or \'robust\''
+        raise ValueError(msg)
+
+    jobs = [(filename,stackname,select,method,outdir) for filename in \
+    sorted(glob(pattern))]
+    if nproc > 1 and len(jobs) > 1:
+        pool = Pool(min(nproc,len(jobs)))
+        try:
+            result = pool.map(_restack_job,jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        result = [_restack_job(job) for job in jobs]
+
+    for (filename,n) in result:
+        print('%s: %g windows' %(os.path.basename(filename),n),file=None)
+    return result
+
+
+def _restack_job(job):
+    return (job[0],restack_file(*job))
+
+
+def window_table(filename,header,index):
+    """
+    Columns that a selection expression can use, one value per window of a
+    windows file:
+    tstart, tend: epoch seconds; year, month, doy (day of year), hour (UTC,
+    fractional) of the window start; and, if a quality table
+    (.qc.npz, see window_qc) exists for the file, its columns. Quality values
+    are nan for windows that are not in the table, and for files in which a
+    record is a stack of several windows (interm_nstack > 1).
+    """
+    t = (index['tstart'] * 1.e6).astype('datetime64[us]')
+    table = dict(tstart=index['tstart'],tend=index['tend'])
+    table['year'] = t.astype('datetime64[Y]').astype(int) + 1970
+    table['month'] = t.astype('datetime64[M]').astype(int) % 12 + 1
+    table['doy'] = (t.astype('datetime64[D]') - t.astype('datetime64[Y]'))\
+    .astype(int) + 1
+    table['hour'] = (index['tstart'] % 86400.) / 3600.
+
+    qcfile = filename[:-len('.windows.bin')] + '.qc.npz'
+    if os.path.exists(qcfile):
+        qc = wq.load(qcfile)
+        rows = wq.new_rows(index['tstart'],index['tend'])
+        if header['nstack'] == 1 and len(qc) > 0:
+            order = np.argsort(qc['tstart'])
+            i = np.searchsorted(qc['tstart'][order],index['tstart'])
+            i = np.minimum(i,len(qc)-1)
+            found = (qc['tstart'][order][i] == index['tstart'])
+            rows[found] = qc[order][i[found]]
+        for name in wq.QC_DTYPE.names[2:]:
+            table[name] = rows[name]
+    return table
+
+
+def restack_file(filename,stackname,select=None,method='linear',outdir=None):
+    """
+    Restack the windows of one windows file; see restack. The records are
+    read through a memory map, only the selected ones.
+
+    output:
+    number of windows stacked
+    """
+    if not cw.is_windows_file(filename):
+        print('Old windows file format, convert first: '+filename,file=None)
+        return 0
+    (header,index,records) = cw.open_windows(filename)
+
+    sel = np.ones(len(index),dtype=bool)
+    if select is not None:
+        table = window_table(filename,header,index)
+        table['np'] = np
+        sel &= np.asarray(eval(select,{'__builtins__':{}},table),dtype=bool)
+    rows = np.flatnonzero(sel)
+    if len(rows) == 0:
+        return 0
+
+    npts = int(header['npts'])
+    stack = np.zeros(npts)
+    cstack = None
+    if method == 'robust':
+        (stack,weights) = robust_stack(records,rows,CHUNK)
+        stack *= len(rows)
+    else:
+        if method == 'pws':
+            cstack = np.zeros(npts,dtype=np.complex128)
+        for i in range(0,len(rows),CHUNK):
+            corr = np.array(records[rows[i:i+CHUNK]],dtype=np.float64)
+            stack += np.sum(corr,axis=0)
+            if cstack is not None:
+                cstack += np.sum(phase_coherence(corr),axis=0)
+    nstack = len(rows) * int(header['nstack'])
+
+    if outdir is None:
+        outdir = os.path.dirname(filename)
+    write_stack(header,index[rows],stack,cstack,nstack,stackname,outdir)
+    return nstack
+
+
+def write_stack(header,index,stack,cstack,nstack,stackname,outdir):
+    """
+    Write a stack in the SAC format of ant_corr (savecorrs), with the
+    header values that are known from the windows file.
+    """
+    (id1,id2) = (header['id1'],header['id2'])
+    fs = float(header['fs'])
+    max_lag = (int(header['npts']) - 1) // 2 / fs
+    startday = UTCDateTime(np.min(index['tstart']))
+    endday = UTCDateTime(np.max(index['tend']))
+
+    tr = Trace(data=np.asarray(stack,dtype=np.float32))
+    tr.stats.sac = {}
+    tr.stats.sampling_rate = fs
+    tr.stats.starttime = UTCDateTime(2000,1,1) - max_lag * fs
+    (tr.stats.network,tr.stats.station,tr.stats.location,\
+    tr.stats.channel) = id1.split('.')
+
+    tr.stats.sac['kt2'] = header['prepstring']
+    tr.stats.sac['kt8'] = header['corrtype']
+    tr.stats.sac['user0'] = nstack
+    tr.stats.sac['b'] = -max_lag
+    tr.stats.sac['e'] = max_lag
+    tr.stats.sac['kt0'] = startday.strftime('%Y%j')
+    tr.stats.sac['kt1'] = endday.strftime('%Y%j')
+    tr.stats.sac['user9'] = endday.timestamp % 86400.
+    tr.stats.sac['iftype'] = 1
+    tr.stats.sac['kevnm'] = id2.split('.')[1]
+    tr.stats.sac['kuser0'] = id2.split('.')[0]
+    tr.stats.sac['kuser1'] = id2.split('.')[2]
+    tr.stats.sac['kuser2'] = id2.split('.')[3]
+
+    fileid = os.path.join(outdir,id1+'.'+id2+'.'+header['corrtype']+'.'+\
+    stackname)
+    tr.write(fileid+'.SAC',format='SAC')
+    if cstack is not None:
+        np.save(fileid+'.npy',cstack)
@@ -10,7 +10,26 @@ import numpy as np
 from ANTS.TOOLS import read_xml as rxml
 from ANTS import antconfig as cfg
 from ANTS.TOOLS import processing as proc
+from ANTS.TOOLS import filterbank as fb
 from ANTS.TOOLS import rotationtool as rt
+from ANTS.TOOLS import segment as sg
+from ANTS.TOOLS.tukey import tukeywin
+from ANTS.TOOLS import shared_data as shd
+from ANTS.TOOLS import prefetch as pf
+from ANTS.TOOLS import station_cache as sc
+from ANTS.TOOLS import planner as pl
+from ANTS.TOOLS import availability as av
+from ANTS.TOOLS import spatial as sp
+from ANTS.TOOLS import coordinates as cd
+from ANTS.TOOLS import geolib as gl
+from ANTS.TOOLS import windowed_reader as wr
+from ANTS.TOOLS import mseed_index as mi
+from ANTS.TOOLS import asdf_reader as ah
+from ANTS.TOOLS import spectra_store as ss
+from ANTS.TOOLS import corr_container as ct
+from ANTS.TOOLS import corr_windows as cw
+from ANTS.TOOLS import window_qc as wq
+from ANTS.TOOLS.stacking import phase_coherence
 from ANTS.INPUT import input_correlation as inp
 
 from math import sqrt
@@ -19,14 +38,19 @@ from obspy.core import Stats, Trace, Stream, UTCDateTime, read
 #from obspy.noise.correlation import Correlation
 #from obspy.noise.correlation_functions import phase_xcorr
 from obspy.signal.cross_correlation import xcorr
-from obspy.signal.filter import envelope
-try:
-    from obspy.signal.util import nextpow2
-except ImportError:
-    from obspy.signal.util import next_pow_2 as nextpow2
 from obspy.signal.tf_misfit import cwt
 from scipy.signal import hilbert
-from scipy.signal.signaltools import fftconvolve
+from numpy.lib.stride_tricks import as_strided
+from warnings import warn
+from multiprocessing.pool import ThreadPool
+from collections import deque
+try:
+    from scipy.fft import rfft, irfft, next_fast_len
+    fft_opts = {'workers': inp.fft_workers}
+except ImportError:
+    from numpy.fft import rfft, irfft
+    from scipy.fftpack import next_fast_len
+    fft_opts = {}
 
 if __name__=='__main__':
     from ANTS import ant_corr as pc
@@ -36,7 +60,8 @@ if __name__=='__main__':
     #rank = int(os.environ[inp.rankvariable])
     #size = int(sys.argv[1])
     
-    if rank==0 and inp.update == False and os.path.exists(cfg.datadir+\
+    if rank==0 and inp.update == False and inp.append == False and \
+    os.path.exists(cfg.datadir+\
     '/correlations/input/'+inp.corrname+'.txt') == True:
         print('Choose a new correlation name tag or set update=True.\
          Aborting all processes.',file=None)
@@ -81,12 +106,62 @@ def par_st(size,rank):
         print('Copied input file',file=None)
         print(time.strftime('%H.%M.%S')+'\n',file=None)
         
+    #- Index of the available data, from the file names ---------------------
+    if inp.check_availability or inp.plan_blocks:
+        if rank==0 and ah.is_container(inp.indir):
+            index=ah.build_index(inp.indir,inp.startdate,inp.enddate,\
+            tag=inp.asdf_tag)
+        elif rank==0:
+            index=av.build_index(inp.indir,inp.prepname,inp.startdate,\
+            inp.enddate)
+        else:
+            index=None
+        index=MPI.COMM_WORLD.bcast(index,root=0)
+    else:
+        index=None
+    
+    #- Station coordinates, from the table of the stationxml files ---------
+    #- or from the StationXML in the input container
+    if rank==0 and ah.is_container(inp.indir):
+        table=ah.coordinates(inp.indir)
+    elif rank==0:
+        table=cd.get_table(os.path.join(cfg.datadir,'stationxml'),\
+        verbose=inp.verbose)
+    else:
+        table=None
+    table=MPI.COMM_WORLD.bcast(table,root=0)
+    
+    #- Coordinates to select pairs by distance and azimuth
+    if select_geometry():
+        coords=station_coords(station_list(inp.idfile),table)
+    else:
+        coords=None
+    
     #- Get list of correlation pairs----------------------------------------
-    idpairs=parlistpairs(corrname)
+    if inp.check_availability:
+        idpairs=parlistpairs(corrname,index,coords)
+    else:
+        idpairs=parlistpairs(corrname,coords=coords)
+    
+    #- Plan blocks from the available data, instead of npairs per block -----
+    if inp.plan_blocks:
+        if rank==0:
+            if inp.components=='Z':
+                ncorr=1
+            elif inp.mix_cha:
+                ncorr=4
+            else:
+                ncorr=2
+            idpairs=pl.plan_blocks([pair for block in idpairs for pair in block],\
+            channel_ids,size,inp.block_memory*1.e6,inp.indir,inp.prepname,\
+            inp.startdate,inp.enddate,inp.winlen,inp.olap,inp.Fs[-1],ncorr,\
+            index=index)
+        idpairs=MPI.COMM_WORLD.bcast(idpairs,root=0)
     
     if rank == 0:
         print('Obtained list with correlations',file=None)
-        print('Approx. number of possible correlations: '+str(len(idpairs)*inp.npairs))
+        print('Approx. number of possible correlations: '+\
+        str(sum([len(block) for block in idpairs])))
         print(time.strftime('%H.%M.%S')+'\n',file=None)
         
 #==============================================================================
@@ -126,6 +201,45 @@ def par_st(size,rank):
     else:
         ofid=None
     
+    #- Station data shared by all ranks on a node -----------------------------
+    shared=None
+    if inp.shared_memory:
+        chids=list()
+        for block in ids:
+            for pair in block:
+                chids.extend(channel_ids(pair[0]))
+                chids.extend(channel_ids(pair[1]))
+        (shared,win)=shd.load_node_shared(chids,lambda id: addtr(id,rank),\
+            MPI.COMM_WORLD,inp.verbose,ofid)
+        if rank==0:
+            print('Loaded station data to shared memory',file=None)
+            print(time.strftime('%H.%M.%S')+'\n',file=None)
+    
+    #- Distances and azimuths of all station pairs of this rank, at once -----
+    stations=list()
+    for block in ids:
+        for pair in block:
+            stations.extend(pair)
+    geo=pair_geometry(stations,table)
+    
+    #- Station data are kept from block to block, up to a memory limit --------
+    cache=sc.StationCache(inp.cache_memory*1.e6)
+    
+    #- Read station data in the background, ahead of the correlations ---------
+    #- The plan follows the order in which corrblock first requests the 
+    #- channels; channels that were evicted from the cache are read directly.
+    prefetcher=None
+    if inp.prefetch and not inp.shared_memory and not inp.lazy_read and \
+    not use_spectra_store():
+        plan=list()
+        for block in ids:
+            for pair in block:
+                for id in channel_ids(pair[0])+channel_ids(pair[1]):
+                    if id not in plan:
+                        plan.append(id)
+        prefetcher=pf.Prefetcher(plan,lambda id: addtr(id,rank),\
+            inp.prefetch_memory*1.e6)
+    
     if rank==0:
         print('Station pairs assigned, start correlating',file=None)
         print(time.strftime('%H.%M.%S')+'\n',file=None)
@@ -133,15 +247,25 @@ def par_st(size,rank):
     #- Run correlation for blocks ----------------------------------------------
     for block in ids:
         
-        corrblock(block,dir,corrname,rank,ofid)
+        corrblock(block,dir,corrname,rank,ofid,shared,prefetcher,cache,geo)
         if rank==0:
             print('Finished a block of correlations',file=None)
             print(time.strftime('%H.%M.%S'),file=None)
+        if inp.verbose==True and not (inp.shared_memory or inp.lazy_read):
+            print(cache.stats(),file=ofid)
         
         # Flush the outfile buffer every now and then...
         if inp.verbose==True:
 	    ofid.flush()
     
+    if inp.shared_memory:
+        del shared
+        win.Free()
+    if prefetcher is not None:
+        prefetcher.stop()
+    if inp.output_format=='container':
+        ct.close_writers()
+    
     print('\nTrying to move computed calculations from: ',file=None)
     print(dir+'* ',file=None)
     print('to:',file=None)
@@ -151,15 +275,28 @@ def par_st(size,rank):
     dir2 = os.path.join(cfg.datadir,'correlations',corrname)
     os.system('mv '+dir1+' '+dir2)
     os.system('rmdir '+dir)
+    
+    #- Merge the shards of all ranks into one container ----------------------
+    if inp.output_format=='container':
+        MPI.COMM_WORLD.Barrier()
+        if rank==0:
+            attrs=dict(corrname=corrname,sampling_rate=inp.Fs[-1],\
+            max_lag=inp.max_lag,winlen=inp.winlen,olap=inp.olap,\
+            prepstring=get_prepstring())
+            n=ct.merge(glob(os.path.join(dir2,corrname+'.rank*.shard.npz')),\
+            os.path.join(dir2,corrname+'.h5'),attrs)
+            print('Merged %g correlations into ' %n+\
+            os.path.join(dir2,corrname+'.h5'),file=None)
     print('Rank %g finished correlations.' %rank,file=None)
         
-def corrblock(block,dir,corrname,rank,ofid=None):
+def corrblock(block,dir,corrname,rank,ofid=None,shared=None,prefetcher=None,\
+    cache=None,geo=None):
     """
     Receives a block with station pairs
     Loops through those station pairs
     Checks if the required station data are already
-    in memory by checking the list of ids in memory;
-    if not, read the data and enter them into the list of ids in memory
+    in memory by checking the station cache;
+    if not, read the data and enter them into the cache
     then assigns the two traces in question to dat1, dat2 
     These are passed on to stacking routine, which passes
     back the correlation stack and writes this stack to sac file. 
@@ -173,7 +310,15 @@ def corrblock(block,dir,corrname,rank,ofid=None):
     dir: Directory ro write to; needed so that every rank can write to its own 
     directory
     ofid: output file id
-    verbose: talk or shut up
+    shared: dictionary of channel id and stream, holding the station data in 
+    node shared memory (None if these are not used)
+    prefetcher: Prefetcher object reading the station data in the background
+    (None if data are read here)
+    cache: StationCache object of this rank, kept from block to block (None: 
+    the data are only kept for this block)
+    geo: coordinates, distances and azimuths of the station pairs, see 
+    pair_geometry (None: coordinates are read from the stationxml file of 
+    every pair)
     
     ouput:
     None
@@ -182,10 +327,15 @@ def corrblock(block,dir,corrname,rank,ofid=None):
     print('Rank %g: Working on a block of station pairs...\n' %rank,file=None)
     
     
-    datstr=Stream()
-    idlist=list()
     verbose=inp.verbose
     
+    if prefetcher is not None:
+        getdata=prefetcher.get
+    else:
+        getdata=lambda id: addtr(id,rank)
+    if cache is None:
+        cache=sc.StationCache(inp.cache_memory*1.e6)
+    
 #==============================================================================
     #- Get some information needed for the cross correlation   
 #============================================================================== 
@@ -197,93 +347,45 @@ def corrblock(block,dir,corrname,rank,ofid=None):
     
 
     for pair in block:
-        str1=Stream()
-        str2=Stream()
-        id1 = pair[0]
-        id2 = pair[1]
-        
-        if comp=='Z':
-            
-            id1 = [id1+cha+'Z']
-            id2 = [id2+cha+'Z']
-            
-        elif comp=='RT' or comp=='R' or comp=='T':
-            id1=[id1+cha+'E', id1+cha+'N', id1+cha+'1', id1+cha+'2']
-            id2=[id2+cha+'E', id2+cha+'N', id2+cha+'1', id2+cha+'2']
+        str1=list()
+        str2=list()
+        id1 = channel_ids(pair[0])
+        id2 = channel_ids(pair[1])
             
         
 #==============================================================================
-        #- check if data for first station is in memory
-        #- if it isn't, it needs to be read in
-        #- typically if should be filtered 
+        #- Get the data of the first station: from node shared memory, from 
+        #- the station cache, or read them (typically they are filtered)
 #==============================================================================
-        for id in id1:
-            
-            station = id.split('.')[1]
-            channel = id.split('.')[-1]
-            
-            if id in idlist:
-                str1 += datstr.select(station=station, channel=channel).split()
-            else:
-                (colltr,readsuccess) = addtr(id,rank)
-        
-                #- add this entire trace (which contains all data of this 
-                #- station that are available in this directory) to datstr and 
-                #- update the idlist
-                if readsuccess == True:
-                    datstr += colltr
-                    str1 += colltr.split()
-                    idlist += id
-                    
-                    if verbose:
-                        print('Read in traces for channel '+id,file=ofid)
-                    del colltr
-                else:
-                    if verbose:
-                        print('No traces found for channel '+id,file=ofid)
-                    continue
+        #- With the spectra store, the data are only read for windows that
+        #- are not stored yet
+        stores=None
+        if use_spectra_store():
+            stores=(open_store(id1[0]),open_store(id2[0]))
+            if id2 == id1:
+                stores=(stores[0],stores[0])
+            for store in set(stores):
+                fill_store(store,shared,cache,getdata,ofid)
+        else:
+            for id in id1:
+                str1 += station_data(id,shared,cache,getdata,ofid)
             
         
 #==============================================================================
         #- Same thing for the second station, unless it's identical to the 1st
-        #- check if data is in memory
-        #- if it isn't, it needs to be read in
-        #- typically if should be filtered        
 #==============================================================================
-        if id2 == id1:
+        if stores is None and id2 == id1:
             str2 = str1
-        else:
+        elif stores is None:
             for id in id2:
-                station = id.split('.')[1]
-                channel = id.split('.')[-1]
-                
-                if id in idlist:
-                    str2 += datstr.select(station=station, \
-                        channel=channel).split()
-                else:
-                    (colltr,readsuccess)=addtr(id,rank)
+                str2 += station_data(id,shared,cache,getdata,ofid)
                     
-                    if readsuccess == True:
-                        datstr += colltr
-                        str2 += colltr.split()
-                        idlist += id
-                        
-                        
-                        if inp.verbose:
-                            print('Read in traces for channel '+id,file=ofid)
-                        del colltr
-                    else:
-                        if inp.verbose:
-                            print('No traces found for channel '+id,file=ofid)
-                        continue
-                    
-        
 #==============================================================================
         #- No files found?
         
 #==============================================================================
            
-        if len(str1) == 0 or len(str2) == 0:
+        if stores is None and (len(str1) == 0 or len(str2) == 0):
 
             if inp.verbose==True:
                 print('No data found for one or both of:\n',file=ofid)
@@ -297,45 +399,35 @@ def corrblock(block,dir,corrname,rank,ofid=None):
         #- Rotate horizontal traces        
 #==============================================================================
         #- Get information on the geography of the two traces
-        #- This is all not very beautiful, could be done up sometime
-        try: 
-            lat1 = str1[0].stats['lat']
-            lon1 = str1[0].stats['lon']
-            lat2 = str2[0].stats['lat']
-            lon2 = str2[0].stats['lon']
-        except KeyError:
+        #- Geoinf: (lat1, lon1, lat2, lon2, dist, az, baz)
+        if geo is not None:
+            geoinf=pair_geoinf(geo,pair[0],pair[1])
+        else:
             (lat1,lon1) = rxml.get_coord_staxml(id1[0].\
             split('.')[0],id1[0].split('.')[1])
             (lat2,lon2) = rxml.get_coord_staxml(id2[0].\
             split('.')[0],id2[0].split('.')[1])
-                        
-            if (lat1,lon1) == (0,0) or (lat2,lon2) == (0,0):
-                print('Problems with metadata: No station coordinates \
+            geoinf=rxml.get_geoinf(lat1,lon1,lat2,lon2)
+                    
+        if geoinf[0:2] == (0,0) or geoinf[2:4] == (0,0):
+            print('Problems with metadata: No station coordinates \
 found, setting distance to zero for station pair:')
-                print(id1[0].\
-            split('.')[0],id1[0].split('.')[1],\
-            id2[0].split('.')[0],id2[0].split('.')[1]+'\n')
-            
-        #- Geoinf: (lat1, lon1, lat2, lon2, dist, az, baz)
-        geoinf=rxml.get_geoinf(lat1,lon1,lat2,lon2)
+            print(id1[0].\
+        split('.')[0],id1[0].split('.')[1],\
+        id2[0].split('.')[0],id2[0].split('.')[1]+'\n')
         
         if comp=='RT' or comp=='R' or comp=='T':
             try:
-                str1 = rt.rotate_streams(str1.select(component='N'),\
-                    str1.select(component='E'),geoinf[6],'NE->RT')
-                str2 = rt.rotate_streams(str2.select(component='N'),\
-                    str2.select(component='E'),geoinf[6],'NE->RT')
+                (str1_R,str1_T) = rt.rotate_segments(sg.select(str1,'N'),\
+                    sg.select(str1,'E'),geoinf[6])
+                (str2_R,str2_T) = rt.rotate_segments(sg.select(str2,'N'),\
+                    sg.select(str2,'E'),geoinf[6])
             
             except ValueError:
                 print('East and North traces do not cover same time span,not\
                     rotated',file=None)
                 continue
             
-            str1_T=str1.select(channel=cha+'T').split()
-            str1_R=str1.select(channel=cha+'R').split()
-            str2_T=str2.select(channel=cha+'T').split()
-            str2_R=str2.select(channel=cha+'R').split()
-            
             if len(str1_T) == 0 or len(str1_R) == 0 \
                 or len(str2_T) == 0 or len(str2_R) == 0:
                         
@@ -355,14 +447,16 @@ found, setting distance to zero for station pair:')
         #- Case: Mix channels True or false and channel==z: Nothing special
         #======================================================================
         if comp=='Z':
-            id_1=str1[0].id
-            id_2=str2[0].id
+            if stores is not None:
+                (id_1,id_2)=(stores[0].id,stores[1].id)
+            else:
+                (id_1,id_2)=(str1[0].id,str2[0].id)
             if inp.verbose == True:
                 print(id_1,file=ofid)
                 print(id_2,file=ofid)
             
-            (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc)=corr_pairs(str1,str2,\
-                corrname,geoinf)
+            (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs)=corr_pairs(str1,\
+                str2,corrname,geoinf,stores)
             
             
             
@@ -372,6 +466,7 @@ found, setting distance to zero for station pair:')
             if nccc != 0:
                 savecorrs(ccc,cstack_ccc,nccc,id_1,\
                     id_2,geoinf,corrname,'ccc',dir)
+            save_substacks(subs,id_1,id_2,geoinf,corrname,dir)
             if nccc != 0 or npcc != 0 and inp.verbose:
                 print('Correlated traces from stations '+id1[0]+\
                 ' and '+id2[0],file=ofid)
@@ -386,7 +481,7 @@ found, setting distance to zero for station pair:')
             id2_R=str2_R[0].id
             
             
-            (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc)=corr_pairs(str1_T,\
+            (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs)=corr_pairs(str1_T,\
                 str2_T,corrname,geoinf)
             
             # Component TT    
@@ -396,11 +491,12 @@ found, setting distance to zero for station pair:')
             if nccc != 0:
                 savecorrs(ccc,cstack_ccc,nccc,id1_T,\
                     id2_T,geoinf,corrname,'ccc',dir)
+            save_substacks(subs,id1_T,id2_T,geoinf,corrname,dir)
                 
-            del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc
+            del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs
             
             # Component RR
-            (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc)=corr_pairs(str1_R,\
+            (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs)=corr_pairs(str1_R,\
                 str2_R,corrname,geoinf)
             if npcc != 0:
                 savecorrs(pcc,cstack_pcc,npcc,id1_R,\
@@ -408,30 +504,187 @@ found, setting distance to zero for station pair:')
             if nccc != 0:
                 savecorrs(ccc,cstack_ccc,nccc,id1_R,\
                     id2_R,geoinf,corrname,'ccc',dir)
-            del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc
+            save_substacks(subs,id1_R,id2_R,geoinf,corrname,dir)
+            del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs
             
             if mix_cha == True:
             # Get the remaining component combinations
             # Component T1R2
-                (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc)=corr_pairs(str1_T,\
-                    str2_R,corrname,geoinf)
-                if npcc != 0 or nccc != 0:
-                    savecorrs(ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,id1_T,\
-                    id2_R,geoinf,corrname,dir)
-                del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc
+                (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs)=corr_pairs(\
+                    str1_T,str2_R,corrname,geoinf)
+                if npcc != 0:
+                    savecorrs(pcc,cstack_pcc,npcc,id1_T,\
+                    id2_R,geoinf,corrname,'pcc',dir)
+                if nccc != 0:
+                    savecorrs(ccc,cstack_ccc,nccc,id1_T,\
+                    id2_R,geoinf,corrname,'ccc',dir)
+                save_substacks(subs,id1_T,id2_R,geoinf,corrname,dir)
+                del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs
             # Component R1T2
-                (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc)=corr_pairs(str1_R,\
-                    str2_T,corrname,geoinf)
+                (ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs)=corr_pairs(\
+                    str1_R,str2_T,corrname,geoinf)
                 if npcc != 0:
                     savecorrs(pcc,cstack_pcc,npcc,id1_R,\
                     id2_T,geoinf,corrname,'pcc',dir)
                 if nccc != 0:
                     savecorrs(ccc,cstack_ccc,nccc,id1_R,\
                     id2_T,geoinf,corrname,'ccc',dir)
-                del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc
+                save_substacks(subs,id1_R,id2_T,geoinf,corrname,dir)
+                del ccc,pcc,cstack_ccc,cstack_pcc,nccc,npcc,subs
+
+
+def station_data(id,shared,cache,getdata,ofid=None):
+    """
+    Get the data of one channel as a stream of traces without gaps.
+    
+    input:
+    id: channel id
+    shared: dictionary of channel id and stream in node shared memory, or None
+    cache: StationCache object
+    getdata: function that reads the data of a channel, returning 
+    (trace, success)
+    ofid: output file id
+    
+    output:
+    list of segments, empty if no data were found; LazySegment objects if 
+    lazy_read is set
+    """
+    
+    if shared is not None:
+        data = [sg.from_trace(tr) for tr in shared[id]]
+    elif inp.lazy_read and ah.is_container(inp.indir):
+        data = ah.windowed_channel(inp.indir,id,UTCDateTime(inp.startdate),\
+        UTCDateTime(inp.enddate),inp.winlen-1,preptr,prep_rate,inp.asdf_tag)
+    elif inp.lazy_read:
+        #- Segments that read their files window by window
+        files = glob(inp.indir+'/'+id+'.*.'+inp.prepname+'.*')
+        data = wr.windowed_channel(id,files,UTCDateTime(inp.startdate),\
+        UTCDateTime(inp.enddate),inp.winlen-1,preptr,prep_rate,readfile)
+    else:
+        data = cache.get(id)
+        if data is None:
+            (colltr,readsuccess) = getdata(id)
+            if readsuccess == True:
+                data = sg.from_trace(colltr).split()
+                if inp.verbose:
+                    print('Read in traces for channel '+id,file=ofid)
+            else:
+                data = list()
+            del colltr
+            #- Channels without data are cached, too, so they are not 
+            #- searched for again
+            cache.put(id,data)
+    
+    if len(data) == 0 and inp.verbose:
+        print('No traces found for channel '+id,file=ofid)
+    return data
+    
 
+def channel_ids(staid):
+    """
+    Get the ids of the channels to be read for one station.
+    
+    input:
+    staid: station id in the format net.sta.loc.
+    
+    output:
+    list of channel ids (net.sta.loc.cha) depending on channel and components 
+    in the input file
+    """
+    cha=inp.channel
+    comp=inp.components
+    
+    if comp=='Z':
+        return [staid+cha+'Z']
+    elif comp=='RT' or comp=='R' or comp=='T':
+        return [staid+cha+'E', staid+cha+'N', staid+cha+'1', staid+cha+'2']
+    else:
+        return []
+        
 
-def parlistpairs(corrname):
+def pair_geometry(staids,table):
+    """
+    Coordinates, distances and azimuths between all of the stations in 
+    staids, computed at once. Stations that are not in the coordinate table
+    get coordinates (0,0), and distance and azimuths zero to all others.
+    
+    output:
+    (dictionary of station id and index, lat, lon, dist, az, baz), where dist, 
+    az and baz are matrices of the paths from station i to station j
+    """
+    staids=sorted(set(staids))
+    index=dict([(staid,i) for (i,staid) in enumerate(staids)])
+    latlon=np.array([cd.lookup(table,staid) for staid in staids],\
+    dtype=np.float64).reshape(-1,2)
+    unknown=np.isnan(latlon[:,0])
+    latlon[unknown]=0.
+    
+    (dist,az,baz)=gl.geodesic_table(latlon[:,0],latlon[:,1])
+    for arr in (dist,az,baz):
+        arr[unknown,:]=0.
+        arr[:,unknown]=0.
+    return (index,latlon[:,0],latlon[:,1],dist,az,baz)
+    
+    
+def pair_geoinf(geo,staid1,staid2):
+    """
+    Geoinf of a station pair from pair_geometry: 
+    (lat1, lon1, lat2, lon2, dist, az, baz)
+    """
+    (index,lat,lon,dist,az,baz)=geo
+    i=index[staid1]
+    j=index[staid2]
+    return (float(lat[i]),float(lon[i]),float(lat[j]),float(lon[j]),\
+    float(dist[i,j]),float(az[i,j]),float(baz[i,j]))
+    
+    
+def select_geometry():
+    """
+    Are pairs to be selected by distance or azimuth?
+    """
+    return inp.min_distance>0. or inp.max_distance<np.pi*sp.R_EARTH or \
+    (inp.max_azimuth-inp.min_azimuth)%180.!=0.
+    
+    
+def station_coords(idlist,table):
+    """
+    Coordinates of the stations in idlist.
+    
+    table: dictionary of net.sta and (lat, lon, elevation), see 
+    TOOLS/coordinates.py
+    
+    output:
+    dictionary of station id and (lat, lon); nan if no coordinates were found
+    """
+    coords=dict()
+    for id in idlist:
+        staid=id.split()[0]
+        coords[staid]=cd.lookup(table,staid)
+        if np.isnan(coords[staid][0]) and inp.verbose and \
+        MPI.COMM_WORLD.Get_rank()==0:
+            print('No station coordinates found for '+staid,file=None)
+    return coords
+    
+    
+def station_list(infile):
+    """
+    Station ids from the correlation list, without empty lines and doubles.
+    """
+    fid=open(infile,'r')
+    ids=fid.read().split('\n')
+    fid.close()
+    idlist=list()
+    
+    for item in ids:
+        #- Sort out empty lines
+        if item=='': continue
+        #- Sort out doubles
+        if item not in idlist:
+            idlist.append(item)
+    return idlist
+    
+    
+def parlistpairs(corrname,index=None,coords=None):
     """
     Find the 'blocks' to be processed by a single node.
     
@@ -440,6 +693,10 @@ def parlistpairs(corrname):
     nf: number of pairs that should be in one block (to be held in memory and 
     processed by one node)
     auto: whether or not to calculate autocorrelation
+    index: availability index of the data (see TOOLS/availability.py); if 
+    given, pairs without common correlation windows are left out
+    coords: dictionary of station id and (lat, lon); if given, only pairs 
+    within the distance and azimuth range of the input file are formed
     
     output:
     idpairs, python list object: list of tuples where each tuple contains two 
@@ -453,70 +710,72 @@ def parlistpairs(corrname):
     corrtype=inp.corrtype
     auto=inp.autocorr
     
-    fid=open(infile,'r')
-    ids=fid.read().split('\n')
-    idlist=list()
-    
+    idlist=station_list(infile)
     
+    pairs=list()
     
-    for item in ids:
-        #- Sort out empty lines
-        if item=='': continue
-        #- Sort out doubles
-        if item not in idlist:
-            idlist.append(item)
-    
-    idpairs=list()
-    idcore=list()
-    pcount=0
-    
-    for i in range(0,len(idlist)):
-       
-        for j in range(0,i+1):
-            
-            #- In update mode: Check if the correlation is there already
-            if idlist[i]<=idlist[j]:
-                fileid = cfg.datadir + 'correlations/' + corrname + '/' +\
-                idlist[i] + '???.' + idlist[j] + '???.'+corrtype+'.' + corrname + '.SAC'
-                fileid1 = cfg.datadir + 'correlations/' + corrname + '/rank*/' +\
-                idlist[i] + '???.' + idlist[j] + '???.'+corrtype+'.' + corrname + '.SAC'
-            else:
-                fileid = cfg.datadir + 'correlations/' + corrname + '/' + \
-                idlist[j] + '???.' + idlist[i] + '???.'+ corrtype + '.' + corrname + '.SAC'
-                fileid1 = cfg.datadir + 'correlations/' + corrname + '/rank*/' + \
-                idlist[j] + '???.' + idlist[i] + '???.'+ corrtype + '.' + corrname + '.SAC'
-            
-            if glob(fileid) != [] and inp.update == True:
-                print('Correlation already available, continuing...')
-                continue
-            if glob(fileid1) != [] and inp.update == True:
-                print('Correlation already available, continuing...')
-                continue
+    #- Candidate pairs (i,j) with j<=i: all pairs, or the pairs within the 
+    #- distance and azimuth range, found without testing all of them
+    if coords is None:
+        candidates=[(i,j) for i in range(len(idlist)) for j in range(0,i+1)]
+    else:
+        latlon=np.array([coords.get(id.split()[0],(np.nan,np.nan)) \
+        for id in idlist],dtype=np.float64).reshape(-1,2)
+        selected=sp.select_pairs(latlon[:,0],latlon[:,1],inp.min_distance,\
+        inp.max_distance,inp.min_azimuth,inp.max_azimuth)
+        candidates=sorted([(i,i) for i in range(len(idlist))]+\
+        [(i,j) for (i,j) in selected])
+        if inp.verbose and MPI.COMM_WORLD.Get_rank()==0:
+            print('%g station pairs within distance and azimuth range'\
+            %len(selected),file=None)
+    
+    for (i,j) in candidates:
+        
+        #- In update mode: Check if the correlation is there already
+        if idlist[i]<=idlist[j]:
+            fileid = cfg.datadir + 'correlations/' + corrname + '/' +\
+            idlist[i] + '???.' + idlist[j] + '???.'+corrtype+'.' + corrname + '.SAC'
+            fileid1 = cfg.datadir + 'correlations/' + corrname + '/rank*/' +\
+            idlist[i] + '???.' + idlist[j] + '???.'+corrtype+'.' + corrname + '.SAC'
+        else:
+            fileid = cfg.datadir + 'correlations/' + corrname + '/' + \
+            idlist[j] + '???.' + idlist[i] + '???.'+ corrtype + '.' + corrname + '.SAC'
+            fileid1 = cfg.datadir + 'correlations/' + corrname + '/rank*/' + \
+            idlist[j] + '???.' + idlist[i] + '???.'+ corrtype + '.' + corrname + '.SAC'
+        
+        if glob(fileid) != [] and inp.update == True:
+            print('Correlation already available, continuing...')
+            continue
+        if glob(fileid1) != [] and inp.update == True:
+            print('Correlation already available, continuing...')
+            continue
+        
+        #- Autocorrelation?
+        if idlist[i]==idlist[j] and auto==False:
+            continue
             
-            #- Autocorrelation?
-            if idlist[i]==idlist[j] and auto==False:
-                continue
-                
-            if pcount<nf:
-                if idlist[i]<=idlist[j]:
-                    idcore.append((idlist[i].split()[0],idlist[j].split()[0]))
-                else:
-                    idcore.append((idlist[j].split()[0],idlist[i].split()[0]))
-                pcount+=1
-            else:
-                idpairs.append(idcore)
-                idcore=list()
-                if idlist[i]<=idlist[j]:
-                    idcore.append((idlist[i].split()[0],idlist[j].split()[0])) 
-                else:
-                    idcore.append((idlist[j].split()[0],idlist[i].split()[0]))
-                pcount=1
-    idpairs.append(idcore) 
+        if idlist[i]<=idlist[j]:
+            pairs.append((idlist[i].split()[0],idlist[j].split()[0]))
+        else:
+            pairs.append((idlist[j].split()[0],idlist[i].split()[0]))
+    
+    #- Leave out pairs without common data, before reading any of them
+    if index is not None:
+        nwin=av.pair_windows(index,pairs,channel_ids,inp.winlen,inp.olap)
+        if inp.verbose and MPI.COMM_WORLD.Get_rank()==0:
+            print('%g of %g station pairs have common data, %g correlation \
+windows' %(np.sum(nwin>0),len(pairs),np.sum(nwin)),file=None)
+        pairs=[pairs[k] for k in np.flatnonzero(nwin>0)]
+    
+    #- Blocks of nf pairs
+    idpairs=[pairs[k:k+nf] for k in range(0,len(pairs),nf)]
+    if len(idpairs)==0:
+        idpairs.append(list())
      
     return idpairs
     
     
-def corr_pairs(str1,str2,corrname,geoinf):
+def corr_pairs(str1,str2,corrname,geoinf,stores=None):
     """
     Step through the traces in the relevant streams and correlate whatever 
     overlaps enough.
@@ -540,6 +799,9 @@ def corr_pairs(str1,str2,corrname,geoinf):
     frequency)
     onebit: Boolean, do one-bitting or not
     verbose, boolean: loud or quiet
+    stores: tuple of the SpectraStore objects of the two channels; the 
+    correlations are then formed from the stored spectra, and str1, str2 are
+    not used (None: correlate the data in str1, str2)
     
     output:
     
@@ -547,32 +809,45 @@ def corr_pairs(str1,str2,corrname,geoinf):
     pccstack, numpy array: phase cross correlation
     ccccnt, int: Number of windows stacked for cccstack
     pcccnt, int: Number of windows stacked for pccstack
+    substacks, dictionary: substacks by calendar bin (see add_substacks), 
+    empty unless inp.substacks or inp.rolling_days is set
     
     
     """
     
+    if stores is not None:
+        (id_1,id_2)=(stores[0].id,stores[1].id)
+    else:
+        (id_1,id_2)=(str1[0].id,str2[0].id)
     print('Computing correlation stack for:',file=None)
     print('-------------',file=None)
-    print(str1[0].id)
-    print(str2[0].id)
+    print(id_1)
+    print(id_2)
     print('-------------',file=None)
     
+    #- Append mode: only windows after the time covered by the earlier stack
+    startdate=UTCDateTime(inp.startdate)
+    if inp.append:
+        if inp.corrtype=='pcc':
+            old=existing_stack(id_1,id_2,'pcc',corrname)
+        else:
+            old=existing_stack(id_1,id_2,'ccc',corrname)
+        if old is not None:
+            startdate=max(startdate,old[4])
+    
    
-    startday=UTCDateTime(inp.startdate)
-    endday=UTCDateTime(inp.enddate)
-    t1=startday
     Fs_new=inp.Fs
     tlen=int(inp.max_lag*Fs_new[-1])*2+1
     
     # Initialize arrays and variables
     pcccnt=0
     ccccnt=0
-    n1=0
-    n2=0
     cccstack=np.zeros(tlen)
     pccstack=np.zeros(tlen,dtype=np.float64)
     cstack_ccc=np.zeros(tlen,dtype=np.complex128)
     cstack_pcc=np.zeros(tlen,dtype=np.complex128)
+    substacks=dict()
+    qcrows=list()
     
     # Collect intermediate traces in a binary file.
     if inp.write_all:
@@ -580,38 +855,20 @@ def corr_pairs(str1,str2,corrname,geoinf):
             msg = 'Saving intermediate windows of phase weighted stack\
 is not implemented yet. Intermediate windows will be saved as linear stack.'
         
-        # set the size of float
-        
-        # set size of character array for processing string
-        
-        # format of file:
-        # header consisting of float, float, float, string of 256, string of 256
-        # traces, traces, traces...
-        # header values: Sampling rate Fs, number of samples in each trace,  Nr. of windows in intermediate stacks, Endianness, preprocessing string
-        interm_fs = Fs_new[-1]
-        interm_nsam = tlen
-        interm_nwin = inp.interm_nstack
-        
-        if cccstack.dtype.byteorder == '=':
-            interm_endian = sys.byteorder
-        elif cccstack.dtype.byteorder == '<':
-            interm_endian = 'little'
-        elif cccstack.dtype.byteorder == '>':
-            interm_endian = 'big'
-            
-        interm_preproc = get_prepstring()
+        # format of file: see TOOLS/corr_windows.py. A header with sampling 
+        # rate, number of samples in each trace, nr. of windows in 
+        # intermediate stacks and preprocessing string; float32 traces; an 
+        # index of window start and end times.
         
         # open the file(s)
         if inp.corrtype in ['both','pcc','ccc']:
             
             outdir = os.path.join(cfg.datadir,'correlations',inp.corrname)
-            interm_file=os.path.join(outdir,str1[0].id+'.'+str2[0].id+'.'+inp.corrtype+'.'+\
+            interm_file=os.path.join(outdir,id_1+'.'+id_2+'.'+inp.corrtype+'.'+\
             inp.corrname+'.windows.bin')
-            interm_file = open(interm_file,'wb')
-            header_1 = np.array([interm_fs,interm_nsam,interm_nwin],dtype='f4')
-            header_2 = np.array([interm_endian,interm_preproc],dtype='S256')
-            header_1.tofile(interm_file)
-            header_2.tofile(interm_file)
+            interm_file = cw.WindowWriter(interm_file,Fs_new[-1],tlen,\
+            inp.interm_nstack,get_prepstring(),id_1,id_2,inp.corrtype,\
+            inp.append)
             
         else:
             print('Correlation type not recognized. Correlation types are:\
@@ -620,247 +877,392 @@ ccc, pcc or both.')
             
             
          
-    while n1<len(str1) and n2<len(str2):
-    
-        # Check if the end of one of the traces has been reached
-        if str1[n1].stats.endtime-t1<inp.winlen-1:
-            n1+=1
-            print('No more windows in trace 1..',file=None)
-            continue
-        elif str2[n2].stats.endtime-t1<inp.winlen-1:
-            n2+=1
-            print('No more windows in trace 2..',file=None)
-            continue
-        
-        # Check the starttime of the potentially new trace
-        t1=max(t1,str1[n1].stats.starttime,str2[n2].stats.starttime)
-        #print(t1,file=None)
-        t2=t1+inp.winlen
-        print(t1)
-        # Check if the end of the desired stacking window is reached
-        if t2>endday: 
-            #print('At end of correlation time',file=None)
-            break
-        
-        
-        tr1=str1[n1].slice(starttime=t1,endtime=t2-1/Fs_new[-1])
-        tr2=str2[n2].slice(starttime=t1,endtime=t2-1/Fs_new[-1])
+    #- Windows are taken on a common grid of sample indices; a batch of 
+    #- windows at a time is a strided view of the station data, and is 
+    #- treated and correlated as one 2-D array (window, sample).
+    if stores is None:
+        batches=common_windows(str1,str2,inp.fft_batch,startdate)
+    else:
+        batches=stored_windows(stores[0],stores[1],inp.fft_batch,startdate)
+    for batch in batches:
         
-        if tr1.stats.npts != tr2.stats.npts:
-            t1 = t2 - inp.olap
+        #- Spectra of the treated windows, from the spectra store
+        if stores is not None:
+            (fs,starts,spec1,spec2,prm1,prm2)=batch
+            nwin=int(round(inp.winlen*fs))
+            mlag=int(inp.max_lag*fs)
+            if nwin<=2*mlag:
+                print('Windows too short for max_lag',file=None)
+                break
+            ccc=correlate_spectra(spec1,spec2,nwin,mlag)/\
+            (prm1['scale']*prm2['scale'])[:,np.newaxis]
+            params=(np.sqrt(prm1['energy']/nwin),np.sqrt(prm2['energy']/nwin),\
+            prm1['energy'],prm2['energy'],prm1['rng'],prm2['rng'])
+            del spec1,spec2
             
-            continue
-       # tr1.plot()
-        #tr2.plot()
-        
-        #- Downsampling ===============================================================
-        if len(tr1.data)>40 and len(tr2.data)>40:
-            k=0
-            while k<len(Fs_new):
-                if Fs_new[k]<tr1.stats.sampling_rate:
-                    tr1=proc.trim_next_sec(tr1,False,None)
-                    tr1=proc.downsample(tr1,Fs_new[k],False,None)
-                if Fs_new[k]<tr2.stats.sampling_rate:
-                    tr2=proc.trim_next_sec(tr2,False,None)
-                    tr2=proc.downsample(tr2,Fs_new[k],False,None)
-                k+=1
+            #- Only good windows are stored; zeros and clipping are not known
+            if inp.window_qc:
+                qc=wq.new_rows(starts/float(fs),(starts+nwin)/float(fs))
+                qcrows.append(qc)
+                qcidx=np.arange(len(starts))
         else:
-            t1 = t2 - inp.olap
-            continue   
-        #==============================================================================
-        #- Checks     
-        #============================================================================== 
-        if tr1.data.any()==np.nan or tr2.data.any()==np.nan:
-            t1 = t2 - inp.olap
-            print('Encountered nan, skipping this trace pair...',file=None)
-            continue
-        if tr1.data.any()==np.inf or tr2.data.any()==np.inf:
-            t1 = t2 - inp.olap
-            print('Encountered inf, skipping this trace pair...',file=None)
-            continue
-            
-        if len(tr1.data) == len(tr2.data):
-            mlag = inp.max_lag / tr1.stats.delta
-            mlag=int(mlag)
-            
-        # Check if the traces are both long enough
-        if len(tr1.data)<=2*mlag or len(tr2.data)<=2*mlag:
-            t1 = t2 - inp.olap
-            print('One or both traces too short',file=None)
-            continue
-        # Check if too many zeros
-        # I use epsilon for this check. That is convenient but not strictly right. It seems to do the job though. min doesn't work.
+            (fs,starts,win1,win2)=batch
         
-        if np.sum(np.abs(tr1.data)<sys.float_info.epsilon) > 0.1*tr1.stats.npts or \
-        np.sum(np.abs(tr2.data)<sys.float_info.epsilon) > 0.1*tr2.stats.npts:
-            t1 = t2 - inp.olap
-            
-            if inp.verbose: print('More than 10% of trace equals 0, skipping.',file=None)
-            continue
+            #- The station data were downsampled when they were read; the windows
+            #- are copied here, so that the station data remain unchanged.
+            if fs != Fs_new[-1]:
+                print('Sampling rate %g Hz differs from the target rate %g Hz, \
+not correlated.' %(fs,Fs_new[-1]),file=None)
+                break
+            dat1=np.array(win1,dtype=np.float64)
+            dat2=np.array(win2,dtype=np.float64)
+            fs_new=fs
         
-         #==============================================================================
-        #- Data treatment        
-        #==============================================================================
-
-
-        #- Glitch correction ==========================================================
-        if inp.cap_glitches:
-            std1 = np.std(tr1.data*1.e6)
-            gllow = inp.glitch_thresh * -std1
-            glupp = inp.glitch_thresh * std1
-            tr1.data = np.clip(tr1.data*1.e6,gllow,glupp)/1.e6
-            
-            std2 = np.std(tr2.data*1.e6)
-            gllow = inp.glitch_thresh * -std2
-            glupp = inp.glitch_thresh * std2
-            tr2.data = np.clip(tr2.data*1.e6,gllow,glupp)/1.e6
-            
+            nwin=win1.shape[1]
+            nsmp=dat1.shape[1]
+            mlag=int(inp.max_lag*fs_new)
         
+            #==============================================================================
+            #- Checks     
+            #============================================================================== 
+            # Check if the traces are both long enough
+            if nsmp<=2*mlag:
+                print('One or both traces too short',file=None)
+                continue
             
-#        #- Whitening            ==================================================================
+            #- Quality table: all windows of the batch, before any rejection
+            if inp.window_qc:
+                qc=wq.new_rows(starts/float(fs),(starts+nwin)/float(fs))
+                qc['zero1']=wq.zero_fraction(dat1)
+                qc['zero2']=wq.zero_fraction(dat2)
+                qc['clip1']=wq.clip_fraction(dat1)
+                qc['clip2']=wq.clip_fraction(dat2)
+                qcrows.append(qc)
         
-        if inp.apply_white:
-            tr1 = whiten(tr1)
-            tr2 = whiten(tr2)
+            ok=np.all(np.isfinite(dat1),axis=1) & np.all(np.isfinite(dat2),axis=1)
+            if not ok.all():
+                print('Encountered nan or inf, skipping %g trace pair(s)...' \
+                %np.sum(~ok),file=None)
             
-        #- One-bitting ================================================================
+            # Check if too many zeros
+            # I use epsilon for this check. That is convenient but not strictly right. It seems to do the job though. min doesn't work.
+            zero=(np.sum(np.abs(dat1)<sys.float_info.epsilon,axis=1) > 0.1*nsmp) | \
+            (np.sum(np.abs(dat2)<sys.float_info.epsilon,axis=1) > 0.1*nsmp)
+            if zero.any() and inp.verbose: 
+                print('More than 10% of trace equals 0, skipping %g window(s).' \
+                %np.sum(zero),file=None)
         
-        if inp.apply_onebit:
-            tr1.data = np.sign(tr1.data)
-            tr2.data = np.sign(tr2.data)
+            ok &= ~zero
+            if not ok.any():
+                continue
+            dat1=dat1[ok]
+            dat2=dat2[ok]
+            starts=starts[ok]
+            qcidx=np.flatnonzero(ok)
         
-#- RAM normalization...who wants to do all this stuff!! ================================================================
-        if inp.apply_ram:
-            tr1 = ram_norm(tr1,inp.ram_window,prefilt=inp.ram_filter)
-            tr2 = ram_norm(tr2,inp.ram_window,prefilt=inp.ram_filter)
+            #==============================================================================
+            #- Data treatment        
+            #==============================================================================
+            dat1=treat_windows(dat1,fs_new)
+            dat2=treat_windows(dat2,fs_new)
         
-       
         #==============================================================================
         #- Correlations proper 
-        #==============================================================================        #- Taper
-        if inp.taper_traces == True:
-            tr1.taper(type='cosine',max_percentage=inp.perc_taper)
-            tr2.taper(type='cosine',max_percentage=inp.perc_taper)
+        #============================================================================== 
         
     #-   Classical correlation part =====================================
         if inp.corrtype == 'ccc' or inp.corrtype == 'both':
-            #ccc=classic_xcorr(tr1, tr2, mlag)
-            (ccc, params) = cross_covar(tr1.data, \
-            tr2.data, mlag,inp.normalize_correlation)
-            
-            
+            if stores is None:
+                (ccc, params) = cross_covar_batch(dat1,dat2,mlag,\
+                inp.normalize_correlation)
             
-            if ccc.any() == np.nan:
+            good = ~np.isnan(ccc).any(axis=1)
+            if not good.all():
                 msg='NaN encountered, omitting correlation from stack.'
                 warn(msg)
-                print(tr1)
-                print(tr2)
-                t1 = t2 - inp.olap
-                continue
                 
             # normalization by trace energy
             en1 = params[2]
             en2 = params[3]
             if inp.normalize_correlation:
-                ccc/=(sqrt(en1)*sqrt(en2))
+                ccc/=(np.sqrt(en1)*np.sqrt(en2))[:,np.newaxis]
             
-            cccstack+=ccc
-            ccccnt+=1
-           
-            print('Finished a correlation window',file=None)
-            # Make this faster by zero padding
+            if inp.window_qc:
+                wq.set_params(qc,qcidx,params,good)
+            
+            ccc=ccc[good]
+            cccstack+=np.sum(ccc,axis=0)
             
+            print('Finished %g correlation windows' %len(ccc),file=None)
             
             if inp.get_pws == True:
-                coh_ccc = np.zeros(nextpow2(len(ccc)))
-                startindex = int(0.5*(len(coh_ccc) - len(ccc)))
-                coh_ccc[startindex:startindex+len(ccc)] += ccc*np.hanning(len(ccc))
-                coh_ccc = hilbert(coh_ccc)
-                tol = np.max(coh_ccc)/10000.
-                #if tol < 1e-9:
-                #    tol = 1e-9
-                coh_ccc = coh_ccc/(np.absolute(coh_ccc)+tol)
-                coh_ccc = coh_ccc[startindex:startindex+len(ccc)]
-                cstack_ccc+=coh_ccc
-                
-            else: 
-                coh_ccc = None
-                cstack_ccc = None
-                
-            if inp.write_all==True and ccccnt % inp.interm_nstack == 0:
-                trcname = t2.strftime("end%Y.%j.%H.%M.%S")
-                trcname = np.array([trcname],dtype='S24')
-                trcname.tofile(interm_file)
-                ccc = np.array(ccc,dtype='f4')
-                ccc.tofile(interm_file)
-                
-                #id1=str1[n1].id.split('.')[0]+'.'+str1[n1].id.split('.')[1]
-                #id2=str2[n2].id.split('.')[0]+'.'+str2[n2].id.split('.')[1]
-                #win_dir = cfg.datadir+'/correlations/interm/'+id1+\
-                #    '_'+id2+'/'
-                
-                #if os.path.exists(win_dir)==False:
-                #    os.mkdir(win_dir)
-                
-                #timestring = tr1.stats.starttime.strftime('.%Y.%j.%H.%M.%S')
-                #savecorrs(ccc,coh_ccc,1,tr1.id,tr2.id,geoinf,\
-                #corrname,'ccc',win_dir,params,timestring,startday=t1,endday=t2)
-                        
+                coh=phase_coherence(ccc)
+                cstack_ccc+=np.sum(coh,axis=0)
+            else:
+                coh=None
+            if len(substack_levels()) > 0:
+                add_substacks(substacks,starts[good]/float(fs),ccc,coh,'ccc')
                 
+            if inp.write_all==True:
+                for k in np.arange(len(starts))[good]:
+                    ccccnt+=1
+                    if ccccnt % inp.interm_nstack == 0:
+                        interm_file.write(starts[k]/float(fs),\
+                        (starts[k]+nwin)/float(fs),ccc[np.sum(good[:k])])
+            else:
+                ccccnt+=len(ccc)
+                    
                 #- Phase correlation part =========================================
                 # To be implemented: Getting trace energy
         
         elif inp.corrtype == 'pcc' or inp.corrtype == 'both':
-            pcc=phase_xcorr(tr1.data, tr2.data, mlag, inp.pcc_nu)
-            pccstack+=pcc
-            pcccnt+=1
-            
-            
-            
-            if inp.get_pws == True:
-                coh_pcc = np.zeros(nextpow2(len(pcc)))
-                startindex = int(0.5*(len(coh_pcc) - len(pcc)))
-                coh_pcc[startindex:startindex+len(pcc)] += pcc*np.hanning(len(pcc))  # Tapering and zero padding to make hilbert trafo faster
-                coh_pcc = hilbert(coh_pcc)
-                tol = np.max(coh_pcc)/10000.
-                #if tol < 1e-9:
-                #    tol = 1e-9
-                coh_pcc = coh_pcc/(np.absolute(coh_pcc)+tol)
-                coh_pcc = coh_pcc[startindex:startindex+len(pcc)]
-                cstack_pcc+=coh_pcc
-            else: 
-                coh_pcc = None
-                cstack_pcc = None
-            if inp.write_all==True:
-                trcname = t2.strftime("end%Y.%j.%H.%M.%S")
-                trcname = np.array([trcname],dtype='S24')
-                trcname.tofile(interm_file)
-                pcc = np.array(pcc,dtype='f4')
-                pcc.tofile(interm_file)
-                #id1=str1[n1].id.split('.')[0]+'.'+str1[n1].id.split('.')[1]
-                #id2=str2[n2].id.split('.')[0]+'.'+str2[n2].id.split('.')[1]
-                #win_dir = cfg.datadir+'/correlations/interm/'+id1+\
-                #    '_'+id2+'/'
-                #
-                #if os.path.exists(win_dir)==False:
-                #    os.mkdir(win_dir)
-                #timestring = tr1.stats.starttime.strftime('.%Y.%j.%H.%M.%S')  
-                #savecorrs(pcc,coh_pcc,1,tr1.id,tr2.id,geoinf,\
-                #corrname,'pcc',win_dir,None,timestring,startday=t1,endday=t2)
-                   
-           
-        #Update starttime
-        t1 = t2 - inp.olap
+            if inp.window_qc:
+                wq.set_params(qc,qcidx,wq.window_params(dat1,dat2),\
+                np.ones(len(starts),dtype=bool))
+            for k in range(len(starts)):
+                pcc=phase_xcorr(dat1[k], dat2[k], mlag, inp.pcc_nu)
+                pccstack+=pcc
+                pcccnt+=1
+                
+                if inp.get_pws == True:
+                    coh=phase_coherence(pcc[np.newaxis,:])
+                    cstack_pcc+=coh[0]
+                else:
+                    coh=None
+                if len(substack_levels()) > 0:
+                    add_substacks(substacks,starts[k:k+1]/float(fs),\
+                    pcc[np.newaxis,:],coh,'pcc')
+                
+                if inp.write_all==True:
+                    interm_file.write(starts[k]/float(fs),\
+                    (starts[k]+nwin)/float(fs),pcc)
+               
     if 'interm_file' in locals():  
         interm_file.close()
-    return(cccstack,pccstack,cstack_ccc,cstack_pcc,ccccnt,pcccnt)
+    if len(qcrows) > 0:
+        qcfile=os.path.join(cfg.datadir,'correlations',corrname,id_1+'.'+\
+        id_2+'.'+inp.corrtype+'.'+corrname+'.qc.npz')
+        wq.save(qcfile,np.concatenate(qcrows),inp.append)
+    if inp.get_pws == False:
+        cstack_ccc = None
+        cstack_pcc = None
+    return(cccstack,pccstack,cstack_ccc,cstack_pcc,ccccnt,pcccnt,substacks)
+    
     
+def sample_index(t,fs):
+    """
+    Index of the sample at time t (UTCDateTime), on a grid of sampling rate fs 
+    that starts at 1970-01-01.
+    """
+    return int(round(t.timestamp*fs))
     
     
+def window_view(seg,i0,nw,nwin,step):
+    """
+    2-D array (window, sample) of nw windows of length nwin, starting at sample
+    index i0 every step samples. The windows are a read-only strided view of 
+    the segment data; no data are copied.
+    """
+    data=np.asarray(seg.samples(i0,i0+(nw-1)*step+nwin))
+    return as_strided(data,shape=(nw,nwin),\
+    strides=(step*data.strides[0],data.strides[0]),writeable=False)
     
     
+def common_windows(str1,str2,nbatch=None,startdate=None):
+    """
+    Find the correlation windows in the common time of two lists of 
+    segments (gap-free Segments or LazySegments, sorted by time).
+    
+    Windows of winlen seconds are shifted by winlen-olap seconds, from startdate
+    until enddate. They are counted in samples, so windows of both stations
+    always have the same number of samples.
+    
+    input:
+    str1, str2: segments of station 1 and station 2
+    nbatch: maximum number of windows to return at a time (None: all windows
+    of a common segment)
+    startdate: UTCDateTime of the first window (None: startdate of the input
+    file)
+    
+    output (generator):
+    sampling rate, array of window start sample indices, 2-D arrays (window,
+    sample) of station 1 and station 2
+    """
+    
+    fs=str1[0].fs
+    if str2[0].fs != fs:
+        print('Sampling rates of the two stations differ, not correlated.',\
+        file=None)
+        return
+    
+    nwin=int(round(inp.winlen*fs))
+    step=int(round((inp.winlen-inp.olap)*fs))
+    if startdate is None:
+        startdate=UTCDateTime(inp.startdate)
+    last=sample_index(UTCDateTime(inp.enddate),fs)
+    t=sample_index(startdate,fs)
+    
+    n1=0
+    n2=0
+    while n1<len(str1) and n2<len(str2):
+        a1=str1[n1].start
+        a2=str2[n2].start
+        e1=str1[n1].end
+        e2=str2[n2].end
+        
+        # Check if the end of one of the segments has been reached
+        if e1-t<nwin:
+            n1+=1
+            continue
+        elif e2-t<nwin:
+            n2+=1
+            continue
+        
+        t=max(t,a1,a2)
+        # Check if the end of the desired stacking window is reached
+        if t+nwin>last:
+            break
+        
+        e=min(e1,e2,last)
+        if e-t<nwin:
+            if e1<=e2:
+                n1+=1
+            else:
+                n2+=1
+            continue
+        
+        nw=(e-t-nwin)//step+1
+        starts=t+step*np.arange(nw)
+        if nbatch is None:
+            nb=nw
+        else:
+            nb=nbatch
+        
+        for i in range(0,nw,nb):
+            s=starts[i:i+nb]
+            yield (fs,s,window_view(str1[n1],s[0],len(s),nwin,step),\
+            window_view(str2[n2],s[0],len(s),nwin,step))
+        
+        t=starts[-1]+step
+    
+    
+def use_spectra_store():
+    """
+    True if the correlations are formed from the spectra store (see 
+    spectra_store in the input file).
+    """
+    return inp.spectra_store and inp.components=='Z' and \
+    inp.corrtype in ('ccc','both')
+    
+    
+def spectra_grid(fs,startdate=None):
+    """
+    Window length and step in samples, and the range [k0, k1) of the numbers
+    of the windows between startdate (None: startdate of the input file) and
+    enddate on the grid of the spectra store: window k starts at sample 
+    k*step, counted from 1970-01-01.
+    """
+    nwin=int(round(inp.winlen*fs))
+    step=int(round((inp.winlen-inp.olap)*fs))
+    if startdate is None:
+        startdate=UTCDateTime(inp.startdate)
+    first=sample_index(startdate,fs)
+    last=sample_index(UTCDateTime(inp.enddate),fs)
+    k0=-(-first//step)
+    k1=(last-nwin)//step+1
+    return (nwin,step,k0,max(k0,k1))
+    
+    
+def open_store(id):
+    """
+    Spectra store of one channel, in datadir/spectra. Every set of data and 
+    processing parameters that changes the spectra has its own store; its
+    name starts with prepname and the processing string (get_prepstring).
+    """
+    params=dict(indir=inp.indir,prepname=inp.prepname,asdf_tag=inp.asdf_tag,\
+    Fs=inp.Fs,apply_bandpass=inp.apply_bandpass,filter=inp.filter,\
+    winlen=inp.winlen,olap=inp.olap,cap_glitches=inp.cap_glitches,\
+    glitch_thresh=inp.glitch_thresh,apply_white=inp.apply_white,\
+    white_freqs=inp.white_freqs,white_tape=inp.white_tape,\
+    apply_onebit=inp.apply_onebit,apply_ram=inp.apply_ram,\
+    ram_window=inp.ram_window,ram_filter=inp.ram_filter,\
+    taper_traces=inp.taper_traces,perc_taper=inp.perc_taper,\
+    normalize_correlation=inp.normalize_correlation)
+    root=ss.store_dir(os.path.join(cfg.datadir,'spectra'),\
+    inp.prepname+'.'+get_prepstring(),params)
+    nwin=int(round(inp.winlen*inp.Fs[-1]))
+    return ss.SpectraStore(root,id,next_fast_len(2*nwin-1)//2+1)
+    
+    
+def fill_store(store,shared,cache,getdata,ofid=None):
+    """
+    Add the spectra of the windows between startdate and enddate that are not
+    in the store yet. The station data are only read if there are such 
+    windows.
+    
+    Windows are checked (nan, inf, more than 10% zeros) and treated as in 
+    corr_pairs, one batch of fft_batch windows at a time.
+    """
+    fs=inp.Fs[-1]
+    (nwin,step,k0,k1)=spectra_grid(fs)
+    missing=store.missing(k0,k1)
+    if len(missing)==0:
+        return
+    
+    segs=station_data(store.id,shared,cache,getdata,ofid)
+    for (m0,m1) in missing:
+        for seg in segs:
+            if seg.fs != fs:
+                print('Sampling rate %g Hz differs from the target rate %g Hz, \
+not stored.' %(seg.fs,fs),file=None)
+                continue
+            #- Windows of the grid within this segment
+            a=max(m0,-(-seg.start//step))
+            b=min(m1,(seg.end-nwin)//step+1)
+            for i in range(a,b,inp.fft_batch):
+                ks=np.arange(i,min(i+inp.fft_batch,b))
+                dat=np.array(window_view(seg,ks[0]*step,len(ks),nwin,step),\
+                dtype=np.float64)
+                ok=np.all(np.isfinite(dat),axis=1) & \
+                (np.sum(np.abs(dat)<sys.float_info.epsilon,axis=1)<=0.1*nwin)
+                
+                entries=np.zeros(len(ks),dtype=ss.INDEX_DTYPE)
+                entries['k']=ks
+                entries['ok']=ok
+                spec=np.zeros((len(ks),store.nfreq),dtype=np.complex64)
+                if ok.any():
+                    (spec[ok],entries['scale'][ok],entries['energy'][ok],\
+                    entries['rng'][ok])=window_spectra(treat_windows(dat[ok],\
+                    fs),inp.normalize_correlation)
+                store.add(ks[0],ks[-1]+1,entries,spec)
+        #- The whole range is processed, also where there are no data
+        store.add(m0,m1,np.zeros(0,dtype=ss.INDEX_DTYPE),\
+        np.zeros((0,store.nfreq),dtype=np.complex64))
+    
+    
+def stored_windows(store1,store2,nbatch,startdate=None):
+    """
+    Windows between startdate (None: startdate of the input file) and 
+    enddate that are good in both of two spectra stores.
+    
+    output (generator):
+    sampling rate, array of window start sample indices, 2-D arrays (window,
+    frequency) of the spectra of station 1 and station 2, and their index 
+    entries (scale, energy...)
+    """
+    fs=inp.Fs[-1]
+    (nwin,step,k0,k1)=spectra_grid(fs,startdate)
+    w1=store1.windows(k0,k1)
+    w2=store2.windows(k0,k1)
+    (ks,i1,i2)=np.intersect1d(w1['k'],w2['k'],return_indices=True)
+    
+    for i in range(0,len(ks),nbatch):
+        e1=w1[i1[i:i+nbatch]]
+        e2=w2[i2[i:i+nbatch]]
+        yield (fs,ks[i:i+nbatch]*step,store1.spectra(e1['row']),\
+        store2.spectra(e2['row']),e1,e2)
+    
     
-
 def addtr(id,rank):
     
     """
@@ -871,7 +1273,10 @@ def addtr(id,rank):
     
     """
     print('Rank %g: Reading noise data...\n' %rank,file=None)
-    traces=glob(inp.indir+'/'+id+'.*.'+inp.prepname+'.*')
+    if ah.is_container(inp.indir):
+        traces=[inp.indir]
+    else:
+        traces=glob(inp.indir+'/'+id+'.*.'+inp.prepname+'.*')
     traces.sort()
     readone=False
     endday=UTCDateTime(inp.enddate)
@@ -879,12 +1284,11 @@ def addtr(id,rank):
     if len(traces) == 0:
         return (Trace(),False)
              
-    #- collect a trace with masked samples where gaps are.
-    #- This is convenient because we then get only one trace that can be 
-    #- handled with an index 
-    #- inside the datstr objects more easily (rather than having a stream with 
-    #- variable number of traces)
+    files=list()
     for filename in traces: 
+        if filename==inp.indir:
+            files.append(filename)
+            continue
         
         (sy,sm)=filename.split('/')[-1].split('.')[4:6]
         (ey,em)=filename.split('/')[-1].split('.')[9:11]
@@ -892,36 +1296,38 @@ def addtr(id,rank):
         ef=UTCDateTime(ey+','+em)
         if sf>endday or ef<startday:
             continue
-        
+        files.append(filename)
+    
+    #- Read, decode and filter the files in a pool of read_threads threads
+    if inp.read_threads>1 and len(files)>1:
+        pool=ThreadPool(min(inp.read_threads,len(files)))
         try:
-            newtr=read(filename)
-            print(newtr[0].stats.starttime)
-        except:
-            print('Problems opening data file:\n',file=None)
-            print(tr,file=None)
-            continue
-        
-        for tr in newtr:
-            #- Check if at least one window contained
-            if len(tr.data)*tr.stats.delta<inp.winlen-tr.stats.delta:
-                continue
-            
+            streams=pool.map(lambda f: readprep(f,id),files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        streams=[readprep(filename,id) for filename in files]
+    newtraces=sorted([tr for st in streams for tr in st],\
+    key=lambda tr: tr.stats.starttime)
+    del streams
+             
+    #- collect a trace with masked samples where gaps are.
+    #- This is convenient because we then get only one trace that can be 
+    #- handled with an index 
+    #- inside the datstr objects more easily (rather than having a stream with 
+    #- variable number of traces)
+    for tr in newtraces:
             
-            #- Bandpass filter
-            if inp.apply_bandpass:
-                tr.filter('bandpass',freqmin=inp.filter[0],freqmax=inp.filter[1],\
-                corners=inp.filter[2],zerophase=True)
-                
+        if readone==False:
+            colltr=tr.copy()
+            readone=True
             
-            if readone==False:
-                colltr=tr.copy()
-                readone=True
-                
-            else:
-                try:
-                    colltr+=tr
-                except TypeError:
-                    continue   
+        else:
+            try:
+                colltr+=tr
+            except TypeError:
+                continue   
      
     if readone == True:           
         return (colltr,readone)
@@ -929,6 +1335,80 @@ def addtr(id,rank):
         return(Trace(),readone)
     
    
+def readfile(filename,id=None):
+    """
+    Read one data file. With record_index, only the miniSEED records between
+    startdate and enddate are decoded (see mseed_index); otherwise the whole
+    file is read. From an ASDF input file, all data of channel id between
+    startdate and enddate are read.
+    """
+    if filename==inp.indir and ah.is_container(filename):
+        return ah.read_channel(filename,id,UTCDateTime(inp.startdate),\
+        UTCDateTime(inp.enddate),inp.asdf_tag)
+    if inp.record_index and filename.split('.')[-1].upper() == 'MSEED':
+        return mi.read_span(filename,UTCDateTime(inp.startdate),\
+        UTCDateTime(inp.enddate))
+    return read(filename)
+    
+    
+def readprep(filename,id=None):
+    """
+    Read one data file (or the data of channel id from an ASDF input file)
+    and prepare its traces (see preptr). Traces shorter than one correlation
+    window are left out.
+    
+    output:
+    obspy stream, empty if the file could not be read
+    """
+    try:
+        newtr=readfile(filename,id)
+        print(newtr[0].stats.starttime)
+    except:
+        print('Problems opening data file:\n',file=None)
+        print(filename,file=None)
+        return Stream()
+    
+    traces=Stream()
+    for tr in newtr:
+        #- Check if at least one window contained
+        if len(tr.data)*tr.stats.delta<inp.winlen-tr.stats.delta:
+            continue
+        traces+=preptr(tr)
+    return traces
+    
+    
+def preptr(tr):
+    """
+    Treatment of every trace right after reading: bandpass filter, and 
+    downsampling to the sampling rate(s) in Fs, one after another. 
+    
+    The trace is trimmed to start on the sample grid of the new sampling rate
+    (counted from 1970-01-01), so that all downsampled traces share one grid.
+    """
+    if inp.apply_bandpass:
+        fb.apply_filter(tr,'bandpass',inp.filter[0:2],inp.filter[2],\
+        zerophase=True)
+    for Fs in inp.Fs:
+        if Fs<tr.stats.sampling_rate:
+            tr=proc.trim_next_sec(tr,False,None)
+            t=tr.stats.starttime.timestamp
+            if abs(round(t*Fs)-t*Fs)>0.01:
+                tr.trim(starttime=UTCDateTime(np.ceil(t*Fs)/Fs),\
+                nearest_sample=True)
+            tr=proc.downsample(tr,Fs,False,None)
+    return tr
+    
+    
+def prep_rate(fs):
+    """
+    Sampling rate of data of sampling rate fs after preptr.
+    """
+    for Fs in inp.Fs:
+        if Fs<fs:
+            fs=Fs
+    return fs
+    
+    
 def savecorrs(correlation,phaseweight,n_stack,id1,id2,geoinf,\
     corrname,corrtype,outdir,params=None,timestring='',startday=None,\
     endday=None):
@@ -941,9 +1421,6 @@ def savecorrs(correlation,phaseweight,n_stack,id1,id2,geoinf,\
 #==============================================================================
 
     
-    tr=Trace(data=correlation)
-    tr.stats.sac={}
-    
     if startday == None:
         startday=UTCDateTime(inp.startdate)
     if endday == None:
@@ -951,7 +1428,25 @@ def savecorrs(correlation,phaseweight,n_stack,id1,id2,geoinf,\
         
     (lat1, lon1, lat2, lon2, dist, az, baz)=geoinf
     
+    #- Append mode: add the stack of the earlier run
+    if inp.append and not timestring.startswith('.roll'):
+        old=existing_stack(id1,id2,corrtype,corrname,timestring)
+        if old is not None:
+            if len(old[0]) != len(correlation):
+                msg='Earlier stack of '+id1+'.'+id2+' has a different length \
+(max_lag or Fs changed), cannot append.'
+                raise ValueError(msg)
+            correlation=correlation+old[0]
+            if phaseweight is not None and old[1] is not None:
+                phaseweight=phaseweight+old[1]
+            n_stack+=old[2]
+            startday=old[3]
+    
+    
+    tr=Trace(data=correlation)
+    tr.stats.sac={}
     
+
     # Add a preprocessing string:
     prepstring = get_prepstring()
     
@@ -972,6 +1467,8 @@ def savecorrs(correlation,phaseweight,n_stack,id1,id2,geoinf,\
     tr.stats.sac['e']=inp.max_lag
     tr.stats.sac['kt0']=startday.strftime('%Y%j')
     tr.stats.sac['kt1']=endday.strftime('%Y%j')
+    # seconds of the end day, so that the covered time is exact
+    tr.stats.sac['user9']=endday.timestamp % 86400.
     tr.stats.sac['iftype']=1
     tr.stats.sac['stla']=lat1
     tr.stats.sac['stlo']=lon1
@@ -985,6 +1482,16 @@ def savecorrs(correlation,phaseweight,n_stack,id1,id2,geoinf,\
     tr.stats.sac['kuser1']=id2.split('.')[2]
     tr.stats.sac['kuser2']=id2.split('.')[3]
     
+    #- Container output: append the correlation to the shard of this rank
+    if inp.output_format=='container':
+        if params is None:
+            params=[np.nan]*6
+        header=(id1,id2,corrtype,timestring,startday.strftime('%Y%j'),\
+        endday.strftime('%Y%j'),prepstring,n_stack,lat1,lon1,lat2,lon2,dist,\
+        az,baz)+tuple(params[0:6])+(phaseweight is not None,)
+        ct.writer(outdir,corrname).add(header,correlation,phaseweight)
+        return
+    
     if params is not None:
         tr.stats.sac['user3']=params[0]
         tr.stats.sac['user4']=params[1]
@@ -1008,6 +1515,197 @@ def savecorrs(correlation,phaseweight,n_stack,id1,id2,geoinf,\
     
     
     
+def calendar_bin(t,level):
+    """
+    Start and end (UTCDateTime) of the calendar bin of time t (epoch seconds)
+    for a substack level: 'day', 'month' or 'year'.
+    """
+    t=UTCDateTime(t)
+    if level=='day':
+        start=UTCDateTime(t.year,t.month,t.day)
+        end=start+86400
+    elif level=='month':
+        start=UTCDateTime(t.year,t.month,1)
+        if t.month==12:
+            end=UTCDateTime(t.year+1,1,1)
+        else:
+            end=UTCDateTime(t.year,t.month+1,1)
+    else:
+        start=UTCDateTime(t.year,1,1)
+        end=UTCDateTime(t.year+1,1,1)
+    return (start,end)
+    
+    
+def substack_levels():
+    """
+    Substack levels to collect: those in inp.substacks, and days for rolling
+    stacks.
+    """
+    levels=list(inp.substacks)
+    if inp.rolling_days > 0 and 'day' not in levels:
+        levels.append('day')
+    return levels
+    
+    
+def add_substacks(substacks,t,corr,coh,corrtype):
+    """
+    Add correlation windows to the substacks of all levels in 
+    substack_levels().
+    
+    substacks: dictionary of (level, corrtype, start of the bin in epoch 
+    seconds) and [stack, phase weight stack or None, number of windows]
+    t: start times of the windows (epoch seconds)
+    corr: 2-D array (window, lag) of correlations
+    coh: 2-D array of their phase coherence (phase_coherence), or None
+    """
+    #- Windows are grouped by day first; days are then mapped to their bins
+    days=np.floor(np.asarray(t)/86400.)
+    for day in np.unique(days):
+        sel=(days==day)
+        stack=np.sum(corr[sel],axis=0)
+        if coh is not None:
+            cstack=np.sum(coh[sel],axis=0)
+        for level in substack_levels():
+            key=(level,corrtype,calendar_bin(day*86400.,level)[0].timestamp)
+            if key not in substacks:
+                substacks[key]=[np.zeros(corr.shape[1]),None,0]
+                if coh is not None:
+                    substacks[key][1]=np.zeros(corr.shape[1],\
+                    dtype=np.complex128)
+            substacks[key][0]+=stack
+            if coh is not None:
+                substacks[key][1]+=cstack
+            substacks[key][2]+=int(np.sum(sel))
+    
+    
+def save_substacks(substacks,id1,id2,geoinf,corrname,dir):
+    """
+    Write the substacks of a pair (see add_substacks). The bin is added to
+    the name of the correlation: corrname.day2014002, corrname.month201401,
+    corrname.year2014; the times covered are those of the bin, within 
+    startdate and enddate. Rolling stacks are written as well, if 
+    inp.rolling_days is set.
+    """
+    fmt={'day':'%Y%j','month':'%Y%m','year':'%Y'}
+    for key in sorted(substacks):
+        (level,corrtype,t0)=key
+        if level not in inp.substacks:
+            continue
+        (stack,cstack,n)=substacks[key]
+        (start,end)=calendar_bin(t0,level)
+        savecorrs(stack,cstack,n,id1,id2,geoinf,corrname,corrtype,dir,\
+        timestring='.'+level+start.strftime(fmt[level]),\
+        startday=max(start,UTCDateTime(inp.startdate)),\
+        endday=min(end,UTCDateTime(inp.enddate)))
+    
+    if inp.rolling_days > 0:
+        for corrtype in ['ccc','pcc']:
+            #- Append mode: daily substacks of the earlier run
+            if inp.append:
+                earlier=lambda day: existing_stack(id1,id2,corrtype,\
+                corrname,'.day'+UTCDateTime(day).strftime('%Y%j'))
+            else:
+                earlier=None
+            for (start,end,stack,cstack,n) in rolling_stacks(substacks,\
+            corrtype,inp.rolling_days,earlier):
+                savecorrs(stack,cstack,n,id1,id2,geoinf,corrname,corrtype,\
+                dir,timestring='.roll%gd' %inp.rolling_days+\
+                (end-86400).strftime('%Y%j'),\
+                startday=max(start,UTCDateTime(inp.startdate)),\
+                endday=min(end,UTCDateTime(inp.enddate)))
+    
+    
+def rolling_stacks(substacks,corrtype,ndays,earlier=None):
+    """
+    Stacks over ndays days, stepped daily, from the daily substacks (see 
+    add_substacks). The daily stacks of the last ndays days are kept in a 
+    ring buffer; at every step, the newest day is added to the running sum
+    and the oldest one is subtracted from it.
+    
+    earlier: function returning the daily stack of an earlier run for a day
+    (epoch seconds) as (stack, phase weight stack or None, number of 
+    windows,...), or None if there is none. The days before the first day 
+    are then taken into the ring buffer, and the earlier stacks are added to
+    those of the same days.
+    
+    output:
+    generator of (start, end (UTCDateTime), stack, phase weight stack or 
+    None, number of windows), for every day from the first to the last day
+    with data; days without windows in the last ndays days are left out
+    """
+    days=sorted([key[2] for key in substacks if key[0]=='day' and \
+    key[1]==corrtype])
+    if len(days)==0:
+        return
+    first=days[0]
+    if earlier is not None:
+        first-=(ndays-1)*86400.
+    ring=deque()
+    (stack,cstack,n)=(0.,0.,0)
+    for day in np.arange(first,days[-1]+1.,86400.):
+        if len(ring)==ndays:
+            old=ring.popleft()
+            if old is not None:
+                stack-=old[0]
+                if old[1] is not None:
+                    cstack-=old[1]
+                n-=old[2]
+        new=substacks.get(('day',corrtype,day))
+        if earlier is not None:
+            old=earlier(day)
+            if old is not None and new is None:
+                new=list(old[0:3])
+            elif old is not None:
+                new=[new[0]+old[0],new[1],new[2]+old[2]]
+                if new[1] is not None and old[1] is not None:
+                    new[1]=new[1]+old[1]
+        ring.append(new)
+        if new is not None:
+            stack+=new[0]
+            if new[1] is not None:
+                cstack+=new[1]
+            n+=new[2]
+        if n > 0 and day >= days[0]:
+            if np.iscomplexobj(cstack):
+                pws=np.array(cstack)
+            else:
+                pws=None
+            yield (UTCDateTime(day)-(len(ring)-1)*86400,\
+            UTCDateTime(day)+86400,np.array(stack),pws,n)
+    
+    
+def existing_stack(id1,id2,corrtype,corrname,timestring=''):
+    """
+    Stack (or substack, see savecorrs) of a pair from an earlier run of 
+    corrname (for append mode).
+    
+    output:
+    None if there is none; otherwise correlation stack, phase weight stack 
+    (None if there is none), number of windows, start and end of the time 
+    covered (UTCDateTime, from kt0, kt1 and user9)
+    """
+    fileid=os.path.join(cfg.datadir,'correlations',corrname,id1+'.'+id2+\
+    '.'+corrtype+'.'+corrname+timestring+'.SAC')
+    if not os.path.exists(fileid):
+        return None
+    tr=read(fileid,format='SAC')[0]
+    sac=tr.stats.sac
+    
+    startday=UTCDateTime.strptime(sac['kt0'].strip(),'%Y%j')
+    endday=UTCDateTime.strptime(sac['kt1'].strip(),'%Y%j')
+    # Stacks written before user9 was set end at the start of the end day
+    if sac.get('user9',-12345.) != -12345.:
+        endday+=sac['user9']
+    
+    fileid_cwt=fileid[:-len('.SAC')]+'.npy'
+    if os.path.exists(fileid_cwt):
+        phaseweight=np.load(fileid_cwt)
+    else:
+        phaseweight=None
+    return (np.array(tr.data,dtype=np.float64),phaseweight,\
+    int(sac['user0']),startday,endday)
+    
+    
 def classic_xcorr(trace1, trace2, max_lag_samples):
    
     x_corr = xcorr(trace1.data, trace2.data,\
@@ -1016,59 +1714,143 @@ def classic_xcorr(trace1, trace2, max_lag_samples):
     return x_corr
     
 def cross_covar(data1, data2, max_lag_samples, normalize_traces):
+    """
+    Cross-covariance of two single windows; see cross_covar_batch.
+    """
+    (ccv,params) = cross_covar_batch(np.atleast_2d(data1),\
+    np.atleast_2d(data2),max_lag_samples,normalize_traces)
+    return ccv[0], tuple([p[0] for p in params])
+    
+    
+def cross_covar_batch(data1, data2, max_lag_samples, normalize_traces):
+    """
+    Cross-covariance of windows of two stations, all windows at once.
+    
+    input:
+    data1, data2: 2-D arrays (window, sample) of equal shape (not changed)
+    max_lag_samples: maximum lag in samples
+    normalize_traces: scale windows to maximum 1 before correlating
+    
+    output:
+    2-D array (window, lag) of correlations, and tuple of arrays (one value 
+    per window): rms1, rms2, energy1, energy2, std range1, std range2
+    
+    The FFTs of all windows are done in one call along axis 1.
+    """
+    
+    n = data1.shape[1]
+    (spec1,scale1,ren1,rng1) = window_spectra(data1,normalize_traces)
+    (spec2,scale2,ren2,rng2) = window_spectra(data2,normalize_traces)
+    ccv = correlate_spectra(spec1,spec2,n,max_lag_samples)
+    del spec1, spec2
+    ccv /= (scale1*scale2)[:,np.newaxis]
     
+    # Get the window rms
+    rms1 = np.sqrt(ren1 / n)
+    rms2 = np.sqrt(ren2 / n) 
+    params = (rms1,rms2,ren1,ren2,rng1,rng2)
     
+    return ccv,params
+    
+    
+def window_spectra(data, normalize_traces):
+    """
+    Spectra of the windows of one station, as used for the correlation.
+    
+    input:
+    data: 2-D array (window, sample) (not changed)
+    normalize_traces: scale windows to maximum 1 before the FFT
+    
+    output:
+    2-D array (window, frequency) of spectra of the scaled windows, zero 
+    padded to next_fast_len(2*nsamples-1); and arrays (one value per window) 
+    of the scale, the energy of the unscaled window, and the range of 
+    standard deviations
+    """
     
 # remove mean and normalize; this should have no effect on the energy-normalized #correlation result, but may avoid precision issues if trace values are very small
     if normalize_traces:
-        scale1 = 1./np.max(np.abs(data1))
-        scale2 = 1./np.max(np.abs(data2))
-        data1*=scale1
-        data2*=scale2
-        
-    data1-=np.mean(data1)
-    data2-=np.mean(data2)
-        
-    # Make the data more convenient for C function np.correlate
-    data1 = np.ascontiguousarray(data1, np.float32)
-    data2 = np.ascontiguousarray(data2, np.float32)
-    
-    # Obtain correlation via np.correlate (relatively fast)
-    #ccv = np.correlate(data1,data2,mode='same')
-    # scipy.fftconvolve is way faster!
-    ccv = fftconvolve(data1,data2[::-1],mode='same')
-    if normalize_traces:
-        ccv /= (scale1*scale2) 
-   
-    # Get the signal energy; most people normalize by the square root of that
-    ren1 = np.correlate(data1,data1,mode='valid')[0]
-    ren2 = np.correlate(data2,data2,mode='valid')[0]
+        scale = 1./np.max(np.abs(data),axis=1)
+    else:
+        scale = np.ones(len(data))
+    data = data*scale[:,np.newaxis]
+    data -= np.mean(data,axis=1,keepdims=True)
+    data = np.ascontiguousarray(data, np.float32)
     
+    n = data.shape[1]
+    spec = rfft(data,next_fast_len(2*n-1),axis=1,**fft_opts)
     
-    # Get the window rms
-    rms1 = sqrt(ren1 / len(data1))
-    rms2 = sqrt(ren2 / len(data2)) 
+    # Get the signal energy; most people normalize by the square root of that
+    # Energy refers to the unscaled data, like the correlation
+    ren = np.sum(np.square(data,dtype=np.float64),axis=1) / scale**2
     
     # A further parameter to 'see' impulsive events: range of standard deviations
-    nsmp = int(len(data1)/4)
-    std1 = np.zeros(4)
-    std2 = np.zeros(4)
-    for i in range(4):
-        std1[i] = np.std(data1[i*nsmp:(i+1)*nsmp])
-        std2[i] = np.std(data2[i*nsmp:(i+1)*nsmp])
-
-    rng1 = np.max(std1)/np.min(std1)
-    rng2 = np.max(std2)/np.min(std2)
-    params = (rms1,rms2,ren1,ren2,rng1,rng2)
+    nsmp = int(n/4)
+    std = np.std(data[:,0:4*nsmp].reshape(-1,4,nsmp),axis=2)
+    rng = np.max(std,axis=1)/np.min(std,axis=1)
+    
+    return spec,scale,ren,rng
+    
+    
+def correlate_spectra(spec1, spec2, n, max_lag_samples):
+    """
+    Correlations of windows of n samples from their spectra (see 
+    window_spectra), at lags -max_lag_samples to max_lag_samples. 
     
+    output:
+    2-D array (window, lag)
+    """
+    
+    nfft = next_fast_len(2*n-1)
+    ccv = irfft(spec1*np.conj(spec2),nfft,axis=1,**fft_opts)
+    # Negative lags are at the end of the circular correlation
+    return np.concatenate((ccv[:,nfft-max_lag_samples:],\
+    ccv[:,0:max_lag_samples+1]),axis=1).astype(np.float64)
+    
+    
+def treat_windows(data,fs):
+    """
+    Treatment of windows before correlation, as set in the input file: 
+    glitch correction, whitening, one-bitting, RAM normalization, taper.
+    
+    data: 2-D array (window, sample); may be changed
+    fs: sampling rate
+    """
+    
+    #- Glitch correction ==========================================================
+    if inp.cap_glitches:
+        std = np.std(data*1.e6,axis=1,keepdims=True)
+        data = np.clip(data*1.e6,inp.glitch_thresh * -std,\
+        inp.glitch_thresh * std)/1.e6
+        
+    #- Whitening            ==================================================================
+    if inp.apply_white:
+        data = whiten(data,1./fs)
+        
+    #- One-bitting ================================================================
+    if inp.apply_onebit:
+        data = np.sign(data)
+    
+    #- RAM normalization...who wants to do all this stuff!! ================================================================
+    if inp.apply_ram:
+        data = ram_norm(data,fs,inp.ram_window,prefilt=inp.ram_filter)
+    
+    #- Taper
+    if inp.taper_traces == True:
+        data *= tukeywin(data.shape[-1],2*inp.perc_taper)
     
-    #return ccv[i1:i2], params
-    return my_centered(ccv,2*max_lag_samples+1),params
+    return data
     
     
-def whiten(tr):
-    df = 1/(tr.stats.npts*tr.stats.delta)
-    freqaxis=np.fft.fftfreq(tr.stats.npts,tr.stats.delta)
+def whiten(data,delta):
+    """
+    Spectral whitening of windows between white_freqs.
+    
+    data: window samples, 1-D or 2-D (window, sample)
+    delta: sampling interval
+    """
+    npts = data.shape[-1]
+    df = 1/(npts*delta)
     
     ind_fw1 = int(round(inp.white_freqs[0]/df))
     ind_fw2 = int(round(inp.white_freqs[1]/df))
@@ -1083,47 +1865,52 @@ def whiten(tr):
     taper_right = np.linspace(np.pi/2,np.pi,length_taper)
     taper_right = np.square(np.sin(taper_right))
     
-    taper = np.zeros(tr.stats.npts)
+    taper = np.zeros(npts)
     taper[ind_fw1:ind_fw2] += 1.
     taper[ind_fw1:ind_fw1+length_taper] = taper_left
     taper[ind_fw2-length_taper:ind_fw2] = taper_right
     
-    tr.taper(max_percentage=0.05, type='cosine')
-    
-    
-    
-    spec = fftpack.fft(tr.data)
+    spec = np.fft.fft(data*tukeywin(npts,0.1),axis=-1)
     
     # Don't divide by 0
-    tol = np.max(np.abs(spec)) / 1e5
+    tol = np.max(np.abs(spec),axis=-1,keepdims=True) / 1e5
     spec /= np.abs(spec+tol)
     spec *= taper
    
     
-    tr.data = np.real(fftpack.ifft(spec,n=len(tr.data)))
-    return tr
+    return np.real(np.fft.ifft(spec,n=npts,axis=-1))
     
     
-def ram_norm(trace,winlen,prefilt=None):
+def ram_norm(data,fs,winlen,prefilt=None):
+    """
+    Running absolute mean normalization of windows: divide by the running
+    mean of the envelope over winlen seconds.
     
-    trace_orig = trace.copy()
-    hlen = int(winlen*trace.stats.sampling_rate/2.)
-    weighttrace = np.zeros(trace.stats.npts)
+    data: window samples, 1-D or 2-D (window, sample) (not changed)
+    fs: sampling rate
+    prefilt: (freqmin,freqmax,corners) of a bandpass applied before taking 
+    the envelope, or None
+    """
+    hlen = int(winlen*fs/2.)
+    npts = data.shape[-1]
+    weighttrace = np.zeros(data.shape)
     
     if prefilt is not None:
-        trace.filter('bandpass',freqmin=prefilt[0],freqmax=prefilt[1],\
-        corners=prefilt[2],zerophase=True)
-        
-    envlp = envelope(trace.data)
-
-    for n in xrange(hlen,trace.stats.npts-hlen):
-        weighttrace[n] = np.sum(envlp[n-hlen:n+hlen+1]/(2.*hlen+1))
+        envlp = np.abs(hilbert(fb.filter_data(data,'bandpass',prefilt[0:2],\
+        prefilt[2],fs,zerophase=True),axis=-1))
+    else:
+        envlp = np.abs(hilbert(data,axis=-1))
+    
+    # Running mean via cumulative sum
+    csum = np.cumsum(envlp,axis=-1)
+    csum = np.concatenate((np.zeros(csum.shape[:-1]+(1,)),csum),axis=-1)
+    weighttrace[...,hlen:npts-hlen] = (csum[...,2*hlen+1:] - \
+    csum[...,:npts-2*hlen])/(2.*hlen+1)
         
-    weighttrace[0:hlen] = weighttrace[hlen]
-    weighttrace[-hlen:] = weighttrace[-hlen-1]
+    weighttrace[...,0:hlen] = weighttrace[...,hlen:hlen+1]
+    weighttrace[...,-hlen:] = weighttrace[...,-hlen-1:-hlen]
     
-    trace_orig.data /= weighttrace
-    return(trace_orig)
+    return data / weighttrace
 
 def get_prepstring():
     
@@ -1152,10 +1939,11 @@ def get_prepstring():
     return prepstring
 
 def my_centered(arr, newsize):
-    # get the center portion of a 1-dimensional array
-    n = len(arr)
+    # get the center portion of a 1-dimensional array, or of each row of a 
+    # 2-dimensional array
+    n = arr.shape[-1]
     i0 = (n - newsize) // 2
     if n%2 == 0:
         i0 += 1
     i1 = i0 + newsize
-    return arr[i0:i1]
+    return arr[...,i0:i1]
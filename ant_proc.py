@@ -17,6 +17,7 @@ import numpy as np
 from ANTS.TOOLS import processing as proc
 from ANTS.TOOLS import mergetraces as mt
 from ANTS.TOOLS import event_excluder as ee
+from ANTS.TOOLS import mseed_index as mi
 
 from ANTS import antconfig as cfg
 from ANTS.INPUT import input_correction as inp
@@ -121,6 +122,7 @@ def ic(rank,size):
     mydir=datadir+'processed/'+prepname+'/rank'+str(rank)
     if os.path.exists(mydir)==False:
         os.mkdir(mydir)
+    written=list()
         
     
     for filepath in mycontent:
@@ -344,6 +346,7 @@ def ic(rank,size):
                 #- write to file
                 colloc_data[trace_index_2].write(filepathnew,\
                 format=colloc_data[trace_index_2].stats._format)
+                written.append(filepathnew)
                        
                 if verbose==True:
                     print('* renamed file: '+filepathnew,file=ofid)
@@ -356,6 +359,17 @@ def ic(rank,size):
         ofid.close()
     os.system('mv '+mydir+'/* '+mydir+'/../')
     os.system('rmdir '+mydir)    
+    
+    #- Record index of the new miniSEED files, so that ant_corr can read
+    #- parts of them (see mseed_index)
+    for filepathnew in written:
+        if filepathnew.split('.')[-1].upper() != 'MSEED':
+            continue
+        try:
+            mi.build_index(os.path.join(os.path.dirname(mydir),\
+            os.path.basename(filepathnew)))
+        except Exception:
+            print('Could not index '+filepathnew,file=None)
         
 def getfilepath(mydir,stats,prepname,startonly=False):
     
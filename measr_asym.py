@@ -180,6 +180,8 @@ def seg_measr(input=None,plotstyle='points',plot_off=False):
     avgwin = 0
     # station pairs
     stas = []
+    # selected measurements
+    selected = []
     
     for entry in data:
         entry=entry.split()
@@ -212,11 +214,17 @@ def seg_measr(input=None,plotstyle='points',plot_off=False):
         mp = gl.get_midpoint(lat1,lon1,lat2,lon2)
         # find antipode of midpoint
         ap = gl.get_antipode(mp[0],mp[1])
-        #find distance to antipode of midpoint
-        dist = geodesic.Geodesic.WGS84.Inverse(ap[0],ap[1],lat1,lon1)\
-        ['s12']/1000.
-        dist2 = geodesic.Geodesic.WGS84.Inverse(ap[0],ap[1],lat2,lon2)\
-        ['s12']/1000.
+        selected.append((lat1,lon1,lat2,lon2,mesr,sta_dist,ap[0],ap[1]))
+        
+    #find distance to antipode of midpoint, for all pairs at once
+    selected = np.array(selected).reshape(-1,8)
+    dists = gl.inverse(selected[:,6],selected[:,7],selected[:,0],\
+    selected[:,1])[0]/1000.
+    
+    for k in range(len(selected)):
+        (lat1,lon1,lat2,lon2,mesr,sta_dist) = selected[k,0:6]
+        ap = selected[k,6:8]
+        dist = dists[k]
         # (half) Nr of segments
         numseg = int(dist/minp.segper)
         if numseg == 0: